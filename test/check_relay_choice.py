@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+'''
+  Checks that generate samples and chooses the same relays for a given relay info file and
+  seed as the original implementation, which sampled relays one at a time and chose the median
+  relay of each bin after sorting the relays of each position and splitting them with numpy's
+  array_split. The original implementation is kept here as the reference.
+
+  usage: check_relay_choice.py RELAY_INFO_PATH [SEED ...]
+'''
+
+import sys
+
+from numpy import array_split
+from numpy.random import choice, uniform
+from numpy.random import seed as numpyseed
+
+from tornettools import generate_tor
+from tornettools.generate_defaults import RUN_FREQ_THRESH, TOR_GUARD_MIN_CONSBW
+from tornettools.util import load_json_data
+
+NETWORK_SCALES = [0.001, 0.01, 0.1, 0.5, 1.0]
+DEFAULT_SEEDS = [1, 42, 2021]
+POSITIONS = ['g', 'e', 'ge', 'm']
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return 1
+
+    data = load_json_data(sys.argv[1])
+    relays, sample_size = data['relays'], data['network_stats']['med_count_total']
+    seeds = [int(s) for s in sys.argv[2:]] or DEFAULT_SEEDS
+
+    num_failed = 0
+    for seed in seeds:
+        numpyseed(seed)
+        ref_sampled, ref_weights = __sample_relays_reference(relays, sample_size)
+        numpyseed(seed)
+        sampled, weights = getattr(generate_tor, '__sample_relays')(relays, sample_size)
+
+        if not __same_sample(ref_sampled, ref_weights, sampled, weights):
+            print(f"seed={seed}: the sampled relays or position weights differ")
+            num_failed += 1
+            continue
+
+        pos_ratios = {pos: len(sampled[pos]) / len(sampled['all']) for pos in POSITIONS}
+        for scale in NETWORK_SCALES:
+            n_relays = round(len(sampled['all']) * scale)
+            num_bins = {pos: max(1, round(n_relays * pos_ratios[pos])) for pos in POSITIONS}
+            if any([num_bins[pos] > len(sampled[pos]) for pos in POSITIONS]):
+                # the reference raised an IndexError on the empty bins
+                print(f"seed={seed} scale={scale}: skipped, some positions have fewer relays than bins")
+                continue
+
+            ref_chosen = {pos: __choose_bin_medians_reference(sampled[pos], num_bins[pos]) for pos in POSITIONS}
+            chosen, _ = getattr(generate_tor, '__choose_relays')(n_relays, sampled, weights, pos_ratios)
+            chosen = {pos: list(chosen[pos].keys()) for pos in POSITIONS}
+
+            if chosen == ref_chosen:
+                print(f"seed={seed} scale={scale}: chose the same {sum([len(fps) for fps in chosen.values()])} relays")
+            else:
+                print(f"seed={seed} scale={scale}: the chosen relays differ")
+                num_failed += 1
+
+    return 0 if num_failed == 0 else 1
+
+def __same_sample(ref_sampled, ref_weights, sampled, weights):
+    for pos in ['all'] + POSITIONS:
+        if list(ref_sampled[pos].keys()) != list(sampled[pos].keys()) or ref_weights[pos] != weights[pos]:
+            return False
+    return True
+
+def __sample_relays_reference(relays, sample_size):
+    all_fingerprints = list(relays.keys())
+    run_freqs = []
+    for fp in all_fingerprints:
+        freq = float(relays[fp]['running_frequency'])
+        weight = float(relays[fp]['weight'])
+        bandwidth_capacity = float(relays[fp]['bandwidth_capacity'])
+        if freq < RUN_FREQ_THRESH or weight == 0.0 or bandwidth_capacity == 0.0:
+            freq = 0.0
+        run_freqs.append(freq)
+    run_freqs_normed = [freq / sum(run_freqs) for freq in run_freqs]
+    sampled_fingerprints = list(choice(all_fingerprints, p=run_freqs_normed, replace=False, size=sample_size))
+
+    min_weight_sampled = min([relays[fp]['weight'] for fp in sampled_fingerprints])
+    sampled_relays = {'all': {}, 'g': {}, 'e': {}, 'ge': {}, 'm': {}}
+    sampled_weights = {'all': 0, 'g': 0, 'e': 0, 'ge': 0, 'm': 0}
+    for fp in sampled_fingerprints:
+        relay, weight = relays[fp], relays[fp]['weight']
+
+        sampled_relays['all'][fp] = relay
+        sampled_weights['all'] += weight
+        has_guard_f = True if relays[fp]['weight'] > 0 and \
+            int(round(relays[fp]['weight'] / min_weight_sampled)) >= TOR_GUARD_MIN_CONSBW\
+            and uniform() <= relays[fp]['guard_frequency'] else False
+        has_exit_f = True if uniform() <= relays[fp]['exit_frequency'] else False
+
+        if has_guard_f and has_exit_f:
+            pos = 'ge'
+        elif has_exit_f:
+            pos = 'e'
+        elif has_guard_f:
+            pos = 'g'
+        else:
+            pos = 'm'
+        sampled_relays[pos][fp] = relay
+        sampled_weights[pos] += weight
+    for pos in POSITIONS:
+        sampled_weights[pos] /= sampled_weights['all']
+    sampled_weights['all'] /= sampled_weights['all']
+
+    return sampled_relays, sampled_weights
+
+def __choose_bin_medians_reference(relays, num_bins):
+    items_sorted = sorted(relays.items(), key=lambda kv: kv[1]['weight'])
+    bins = array_split(items_sorted, num_bins)
+    return [bin[len(bin) // 2][0] for bin in bins]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
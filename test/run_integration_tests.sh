@@ -49,6 +49,9 @@ tornettools stage \
     --bandwidth_data_path bandwidth-2020-11.csv \
     --geoip_path tor/src/config/geoip
 
+# generate must choose the same relays for a seed as the original implementation did
+python ../test/check_relay_choice.py relayinfo_staging_2020-11-01--2020-12-01.json
+
 for n in 0.01 0.1
 do
     for p in 0.01 0.1
@@ -76,6 +79,25 @@ do
     done
 done
 
+# tor is the reference for the keys that 'generate --keygen python' writes without it: tor
+# must load them and report the fingerprint that tornettools wrote
+tornettools generate \
+    relayinfo_staging_2020-11-01--2020-12-01.json \
+    userinfo_staging_2020-11-01--2020-12-01.json \
+    tmodel-ccs2018.github.io \
+    --network_scale 0.01 \
+    --keygen python \
+    --atlas tmodel-ccs2018.github.io/data/shadow/network/atlas-lossless.201801.shadow113.graphml.xml \
+    --prefix tornet-keygen-python
+printf "DirServer test 127.0.0.1:5000 0000 0000 0000 0000 0000 0000 0000 0000 0000 0000\nORPort 5000\n" > keygen.torrc
+for datadir in tornet-keygen-python/shadow.data.template/hosts/relay*
+do
+    nickname=`basename ${datadir}`
+    expected=`cat ${datadir}/fingerprint`
+    actual=`tor --list-fingerprint --DataDirectory ${datadir} --Nickname ${nickname} -f keygen.torrc | tail -n 1 | tr -d ' ' | sed "s/^${nickname}/${nickname} /"`
+    test "${expected}" = "${actual}"
+done
+
 tornettools simulate tornet-0.01n-0.01p-0.01s-0.01t-1.0l
 tornettools parse tornet-0.01n-0.01p-0.01s-0.01t-1.0l
 tornettools plot tornet-0.01n-0.01p-0.01s-0.01t-1.0l --tor_metrics_path tor_metrics_2020-11-01--2020-11-30.json --prefix pdfs
@@ -1,15 +1,14 @@
 import os
 import logging
 import shutil
-import subprocess
 
-from tornettools.util import which, cmdsplit
+from tornettools.util import which, run_commands
 
 def run(args):
     logging.info("Starting to archive simulation results now.")
 
-    if which('xz') is None or which('tar') is None or which('dd') is None:
-        logging.warning("We require the tar, xz, and dd tools to archive the results.")
+    if which('xz') is None or which('tar') is None:
+        logging.warning("We require the tar and xz tools to archive the results.")
         logging.critical("Unable to archive with missing tools.")
         return
 
@@ -18,70 +17,56 @@ def run(args):
     except FileNotFoundError as e:
         logging.debug("Could not copy 'cached-consensus': %s", e)
 
-    logging.info("Compressing consensus.")
-    __xz_parallel(args, "consensus")
-    logging.info("Compressing shadow config.")
-    __xz_parallel(args, "shadow.config.xml") # for shadow v1.15.x
-    __xz_parallel(args, "shadow.config.yaml") # for shadow v2.x.x
-    logging.info("Compressing dstat log.")
-    __xz_parallel(args, "dstat.log")
-    logging.info("Compressing free log.")
-    __xz_parallel(args, "free.log")
-    logging.info("Compressing shadow log.")
-    __xz_parallel(args, "shadow.log")
-
-    logging.info("Compressing conf dir.")
-    if __tar_xz_parallel(args, "conf"):
-        shutil.rmtree(f"{args.prefix}/conf")
+    # xz -9 needs hundreds of MiB of memory per thread, so we never run more than nprocesses xz
+    # threads at once: the small files are compressed at the same time with one thread each,
+    # and then the large inputs are compressed one at a time with all of the threads
+    logging.info("Compressing consensus, shadow config, and resource usage logs.")
+    __xz_parallel(args, ["consensus",
+                         "shadow.config.xml", # for shadow v1.15.x
+                         "rusage.csv", "rusage_shadow_tree.csv",
+                         "dstat.log", "free.log"]) # for simulations run with older tornettools
+    __xz_parallel(args, ["shadow.config.yaml"], large=True) # for shadow v2.x.x
 
-    logging.info("Compressing shadow template dir.")
-    if __tar_xz_parallel(args, "shadow.data.template"):
-        shutil.rmtree(f"{args.prefix}/shadow.data.template")
+    logging.info("Compressing shadow log.")
+    __xz_parallel(args, ["shadow.log"], large=True)
 
-    logging.info("Compressing shadow data dir.")
-    if __tar_xz_parallel(args, "shadow.data", excludes=['cached-*', 'diff-cache', 'keys', 'lock']):
-        shutil.rmtree(f"{args.prefix}/shadow.data")
+    logging.info("Compressing conf, shadow template, and shadow data dirs.")
+    archived = __tar_xz_parallel(args, ["conf"])
+    archived += __tar_xz_parallel(args, ["shadow.data.template", "shadow.data"], large=True,
+                                  excludes={"shadow.data": ['cached-*', 'diff-cache', 'keys', 'lock']})
+    for dirname in archived:
+        shutil.rmtree(f"{args.prefix}/{dirname}")
 
+    # this includes our own log, so we do it last
     logging.info("Compressing remaining log files.")
-    for name in os.listdir(args.prefix):
-        if name.endswith(".log"):
-            __xz_parallel(args, name)
-
-def __xz_parallel(args, filename):
-    path = f"{args.prefix}/{filename}"
-    if os.path.exists(path):
-        xz_cmd = cmdsplit(f"xz -9 --threads={args.nprocesses} {path}")
-        comproc = subprocess.run(xz_cmd, cwd=args.prefix, stdout=subprocess.DEVNULL)
-        if comproc.returncode == 0:
-            return True
-    return False
-
-def __tar_xz_parallel(args, dirname, excludes=[]):
-    dirpath = f"{args.prefix}/{dirname}"
-    if not os.path.exists(dirpath):
-        return False
-
-    # we are basically trying to do something like:
-    # tar cf - FLAGS dirname | xz -8e --threads=N > dirname.tar.xz
-
-    flags = [f"--exclude='{e}'" for e in excludes]
-    flag_str = ' '.join(flags)
-
-    tar_cmd = cmdsplit(f"tar cf - {flag_str} {dirname}")
-    tarproc = subprocess.Popen(tar_cmd, cwd=args.prefix, stdout=subprocess.PIPE)
-
-    xz_cmd = cmdsplit(f"xz -9 --threads={args.nprocesses} -")
-    xzproc = subprocess.Popen(xz_cmd, cwd=args.prefix, stdin=tarproc.stdout, stdout=subprocess.PIPE)
-
-    dd_cmd = cmdsplit(f"dd of={dirname}.tar.xz")
-    ddproc = subprocess.Popen(dd_cmd, cwd=args.prefix, stdin=xzproc.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    # wait for the above and collec the return codes
-    tar_rc = tarproc.wait()
-    xz_rc = xzproc.wait()
-    dd_rc = ddproc.wait()
-
-    if tar_rc == 0 and xz_rc == 0 and dd_rc == 0:
-        return True
-    else:
-        return False
+    __xz_parallel(args, [name for name in os.listdir(args.prefix) if name.endswith(".log")])
+
+def __get_xz_parallelism(args, large):
+    # returns how many threads each xz job uses, and how many jobs we run at once
+    return (args.nprocesses, 1) if large else (1, args.nprocesses)
+
+def __xz_parallel(args, filenames, large=False):
+    # returns the names of the files that we compressed
+    filenames = [name for name in filenames if os.path.exists(f"{args.prefix}/{name}")]
+    threads, max_parallel = __get_xz_parallelism(args, large)
+    commands = [{'args': ['xz', '-9', f"--threads={threads}", name], 'cwd': args.prefix} for name in filenames]
+    results = run_commands(commands, max_parallel=max_parallel)
+    return [name for name, r in zip(filenames, results) if r.returncode == 0]
+
+def __tar_xz_parallel(args, dirnames, large=False, excludes={}):
+    # returns the names of the directories that we archived
+    dirnames = [name for name in dirnames if os.path.exists(f"{args.prefix}/{name}")]
+    threads, max_parallel = __get_xz_parallelism(args, large)
+
+    # store the contents of symlinked files (e.g., inputs linked from a cache) instead of the
+    # links, which would dangle on other machines; files that generate hard linked or reflinked
+    # from the tmodel cache are stored like any other file. tar pipes the archive through xz
+    # itself, so that its return code covers the compression too.
+    commands = []
+    for name in dirnames:
+        flags = ["--dereference", f"--use-compress-program=xz -9 --threads={threads}"]
+        flags += [f"--exclude={e}" for e in excludes.get(name, [])]
+        commands.append({'args': ['tar', 'cf', f"{name}.tar.xz"] + flags + [name], 'cwd': args.prefix})
+
+    results = run_commands(commands, max_parallel=max_parallel)
+    return [name for name, r in zip(dirnames, results) if r.returncode == 0]
@@ -0,0 +1,210 @@
+import os
+import glob
+import json
+import logging
+import re
+import signal
+import threading
+
+from collections import deque
+
+from numpy import quantile
+
+from tornettools.watchdog import WATCHDOG_KILL_SECONDS
+
+# the file in the tornet prefix where simulate records whether and when the metrics converged
+CONVERGENCE_FILENAME = "convergence.json"
+# how often we read the new perf client output and check whether the metrics converged
+CONVERGENCE_INTERVAL_SECONDS = 10.0
+# we don't judge a metric until it is computed from at least this many streams
+CONVERGENCE_MIN_STREAMS = 100
+# the quantiles of the time to last byte and goodput distributions that must converge
+CONVERGENCE_QUANTILES = (0.1, 0.5, 0.9)
+# error rates are in percent; small error rates swing a lot relative to their value, so changes
+# are judged relative to at least this rate
+CONVERGENCE_MIN_ERROR_RATE = 1.0
+# we compute goodput from streams that download at least this many bytes
+GOODPUT_MIN_BYTES = 2**20
+# the unix time at which shadow simulations start, 2000-01-01 00:00:00 UTC
+SIMULATION_EPOCH = 946684800
+
+# the tgen output of the perf clients in the shadow data directory
+PERFCLIENT_TGEN_RE = re.compile(r'perfclient[0-9]+(exit|onionservice)?/tgen\.[0-9]+\.stdout$')
+TGEN_STREAM_VALUE_RE = re.compile(r'([a-z-]+)=([^,\]]+)')
+
+# Reads the tgen output of the perf clients as shadow writes it, and stops shadow once the
+# performance metrics have converged, so that a simulation doesn't run longer than it needs to
+# for stable results. We track the quantiles of the time to last byte of each transfer size and
+# of the goodput, and the error rate, of the streams that finish after converge_time. The metrics
+# have converged once every one of them stayed within tolerance (a fraction of its current value)
+# for window_seconds of simulated time. Shadow is then asked to exit with SIGTERM, and killed if
+# it doesn't exit in time, like the watchdog does. The evidence is written to the convergence file
+# in the prefix when we stop, and parse copies it into simulation_info.json.
+class ConvergenceMonitor():
+    def __init__(self, prefix, monitor, tolerance=None, window_seconds=1800.0, converge_time=1200):
+        self.converged_sim_seconds = None
+        self.__prefix = prefix
+        self.__path = f"{prefix}/{CONVERGENCE_FILENAME}"
+        self.__monitor = monitor
+        self.__tolerance = tolerance
+        self.__window_seconds = window_seconds
+        self.__converge_time = converge_time
+        self.__offsets = {} # path -> (bytes read, partial last line)
+        self.__ttlb = {} # transfer size -> seconds
+        self.__goodput = [] # Mibps, like parse computes it
+        self.__num_succeeded = 0
+        self.__num_failed = 0
+        self.__history = deque() # (sim seconds, metrics)
+        self.__pid = None
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def is_enabled(self):
+        return self.__tolerance is not None
+
+    def start(self, pid):
+        self.__pid = pid
+        # don't let parse find the evidence of an earlier run
+        if os.path.exists(self.__path):
+            os.remove(self.__path)
+        if self.is_enabled():
+            self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+        if self.is_enabled():
+            self.__write()
+
+    def __run(self):
+        while not self.__stop_event.wait(CONVERGENCE_INTERVAL_SECONDS):
+            self.__read_streams()
+            if self.__check():
+                break
+
+        if self.converged_sim_seconds is None:
+            return
+
+        logging.info("Stopping shadow at {:.1f} simulated seconds because the performance metrics converged".format(
+            self.converged_sim_seconds))
+        self.__signal(signal.SIGTERM)
+        if not self.__stop_event.wait(WATCHDOG_KILL_SECONDS):
+            logging.critical(f"Killing shadow, which did not exit within {WATCHDOG_KILL_SECONDS} seconds")
+            self.__signal(signal.SIGKILL)
+
+    def __read_streams(self):
+        # the perf clients only append to their logs, so we only read what is new since last time
+        paths = glob.glob(f"{self.__prefix}/shadow.data/hosts/perfclient*/tgen.*.stdout")
+        for path in [p for p in paths if PERFCLIENT_TGEN_RE.search(p) is not None]:
+            offset, partial = self.__offsets.get(path, (0, b''))
+            try:
+                with open(path, 'rb') as inf:
+                    inf.seek(offset)
+                    data = inf.read()
+            except OSError:
+                continue
+
+            lines = (partial + data).split(b'\n')
+            self.__offsets[path] = (offset + len(data), lines.pop())
+            for line in lines:
+                if b'[stream-success]' in line or b'[stream-error]' in line:
+                    self.__handle_stream(line.decode('utf-8', errors='replace'))
+
+    def __handle_stream(self, line):
+        # e.g., 2000-01-01 00:20:01 946685201.000000 [message] ... [stream-success] transport [...] stream
+        # [...,recvsize=5242880,...] bytes [...] times [...,usecs-to-last-byte-recv=...]
+        parts = line.split()
+        try:
+            sim_seconds = float(parts[2]) - SIMULATION_EPOCH
+        except (IndexError, ValueError):
+            return
+        if sim_seconds < self.__converge_time:
+            return
+
+        if '[stream-error]' in line:
+            self.__num_failed += 1
+            return
+
+        values = dict(TGEN_STREAM_VALUE_RE.findall(line))
+        try:
+            ttfb = int(values['usecs-to-first-byte-recv']) / 1000000.0
+            ttlb = int(values['usecs-to-last-byte-recv']) / 1000000.0
+            num_bytes = int(values['payload-bytes-recv'])
+            size = values['recvsize']
+        except (KeyError, ValueError):
+            return
+
+        self.__num_succeeded += 1
+        self.__ttlb.setdefault(size, []).append(ttlb)
+        # we don't follow the progress of each stream, so this is the goodput of the whole
+        # transfer rather than of a part of it like parse computes
+        if num_bytes >= GOODPUT_MIN_BYTES and ttlb > ttfb:
+            self.__goodput.append(num_bytes * 8.0 / (ttlb - ttfb) / 2**20)
+
+    def __check(self):
+        # returns True once the metrics converged
+        sim_seconds = self.__monitor.get_status()['sim_seconds']
+        if sim_seconds < self.__converge_time:
+            return False
+
+        metrics = self.__get_metrics()
+        self.__history.append((sim_seconds, metrics))
+        # keep just enough history to cover the window
+        while len(self.__history) > 1 and self.__history[1][0] <= sim_seconds - self.__window_seconds:
+            self.__history.popleft()
+
+        if None in metrics.values() or self.__history[0][0] > sim_seconds - self.__window_seconds:
+            return False
+
+        for (_, past) in self.__history:
+            for (name, value) in metrics.items():
+                if past.get(name) is None or not self.__is_close(name, past[name], value):
+                    return False
+
+        self.converged_sim_seconds = sim_seconds
+        return True
+
+    def __get_metrics(self):
+        # the current value of each metric, or None if it is computed from too few streams yet
+        metrics = {}
+        for (size, ttlbs) in self.__ttlb.items():
+            metrics.update(self.__get_quantiles(f"time_to_last_byte_recv.{size}", ttlbs))
+        metrics.update(self.__get_quantiles("perfclient_goodput", self.__goodput))
+
+        num_streams = self.__num_succeeded + self.__num_failed
+        enough = num_streams >= CONVERGENCE_MIN_STREAMS
+        metrics['error_rate'] = 100.0 * self.__num_failed / num_streams if enough else None
+        return metrics
+
+    def __is_close(self, name, past, value):
+        scale = max(abs(value), CONVERGENCE_MIN_ERROR_RATE) if name == 'error_rate' else abs(value)
+        return abs(past - value) <= self.__tolerance * scale
+
+    def __write(self):
+        history = list(self.__history)
+        info = {
+            'tolerance': self.__tolerance,
+            'window_seconds': self.__window_seconds,
+            'converge_time': self.__converge_time,
+            'converged': self.converged_sim_seconds is not None,
+            'converged_sim_seconds': self.converged_sim_seconds,
+            'stop_sim_seconds': self.__monitor.get_status()['sim_seconds'],
+            'num_streams_succeeded': self.__num_succeeded,
+            'num_streams_failed': self.__num_failed,
+            'metrics': history[-1][1] if len(history) > 0 else self.__get_metrics(),
+            'history': [{'sim_seconds': sim_seconds, 'metrics': metrics} for (sim_seconds, metrics) in history],
+        }
+        with open(self.__path, 'w') as outf:
+            json.dump(info, outf, sort_keys=True, separators=(',', ': '), indent=2)
+
+    def __signal(self, signum):
+        try:
+            os.kill(self.__pid, signum)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def __get_quantiles(name, values):
+        qs = quantile(values, CONVERGENCE_QUANTILES) if len(values) >= CONVERGENCE_MIN_STREAMS else [None] * len(CONVERGENCE_QUANTILES)
+        return {f"{name}.p{int(q * 100)}": None if v is None else float(v) for (q, v) in zip(CONVERGENCE_QUANTILES, qs)}
@@ -0,0 +1,219 @@
+import os
+import logging
+
+from numpy import array, linspace, mean
+from scipy.optimize import nnls
+
+from tornettools.generate_defaults import SIMULATION_LENGTH_SECONDS
+from tornettools.parse import parse_tornettools_generate_log
+from tornettools.util import dump_json_data, load_json_data
+
+# the properties of a generated network that we use to model its resource cost
+FEATURES = ['num_relays', 'num_tgen_processes', 'relay_capacity_gbit', 'load_scale']
+
+def run(args):
+    runs = __load_runs(args.tornet_collection_path)
+    if len(runs) == 0:
+        logging.critical("Unable to find any parsed simulations with resource usage data")
+        return 1
+
+    logging.info(f"Fitting resource usage models to {len(runs)} simulations")
+    if len(runs) <= len(FEATURES):
+        logging.warning(f"We fit {len(FEATURES) + 1} coefficients per model, so the models will be "
+                        f"poorly constrained with only {len(runs)} simulations")
+
+    models = {
+        'ram_gib': __fit_model(runs, 'ram_gib'),
+        'run_time_hours': __fit_model(runs, 'run_time_hours'),
+    }
+    for (name, model) in models.items():
+        coefs = ', '.join([f"{k}={v:.6g}" for (k, v) in model['coefficients'].items()])
+        logging.info(f"Model for {name}: {coefs} (max relative error {model['max_rel_error']:.3f})")
+
+    estimate = {'num_simulations': len(runs), 'models': models}
+
+    # predict the cost of a network that was already generated, or of a set of generate parameters
+    if args.predict_path is not None:
+        info = __load_info(args.predict_path)
+        if info is None or not all(k in info for k in __required_info_keys()):
+            logging.critical(f"Unable to find the generate parameters of the network at {args.predict_path}")
+            return 1
+        features = __get_features(info)
+        target = args.predict_path
+    else:
+        reference = __get_reference(runs)
+        features = __get_param_features(reference, args.network_scale, args.process_scale, args.load_scale)
+        target = f"network_scale={args.network_scale}, process_scale={args.process_scale}, load_scale={args.load_scale}"
+
+    prediction = __predict(models, features)
+    logging.info(f"Predicted cost for {target}: {prediction['ram_gib']:.2f} GiB of RAM "
+                 f"and {prediction['run_time_hours']:.2f} hours of run time")
+    estimate['prediction'] = {'target': target, 'features': features, 'cost': prediction}
+
+    if args.ram_budget is not None or args.time_budget is not None:
+        estimate['solution'] = __solve_budget(args, runs, models)
+
+    outpath = f"{args.prefix}/resource_estimate.json"
+    dump_json_data(estimate, outpath, compress=False)
+    logging.info(f"Wrote resource estimate to {outpath}")
+
+def fit_ram_model(collection_paths):
+    # returns the model of RAM usage fit to the parsed simulations, or None if there are none
+    runs = __load_runs(collection_paths)
+    if len(runs) == 0:
+        return None
+    return __fit_model(runs, 'ram_gib')
+
+def predict_ram_gib(model, path):
+    # returns the RAM that the generated network at path is predicted to use, or None if we
+    # could not find its generate parameters
+    info = __load_info(path)
+    if info is None or not all(k in info for k in __required_info_keys()):
+        return None
+    return __predict({'ram_gib': model}, __get_features(info))['ram_gib']
+
+def get_ram_gib_used(rusage):
+    # returns the peak RAM of a simulation from its parsed resource usage. the machine-wide usage
+    # also counts everything else that ran at the same time (e.g., the other simulations in
+    # simulate-batch), so we only fall back to it for runs parsed before we sampled shadow's
+    # own process tree
+    if 'shadow_tree' in rusage:
+        return rusage['shadow_tree']['pss_bytes_max'] / (1024.0**3)
+    return rusage['ram']['gib_used_max']
+
+def __load_runs(collection_paths):
+    # each path is either a simulation directory, or a collection of simulation directories
+    run_paths = []
+    for path in collection_paths:
+        if os.path.exists(f"{path}/tornet.plot.data/resource_usage.json"):
+            run_paths.append(path)
+        else:
+            for name in sorted(os.listdir(path)):
+                if os.path.exists(f"{path}/{name}/tornet.plot.data/resource_usage.json"):
+                    run_paths.append(f"{path}/{name}")
+
+    runs = []
+    for path in run_paths:
+        info = __load_info(path)
+        if info is None or not all(k in info for k in __required_info_keys()):
+            logging.warning(f"Skipping {path} because we could not find its generate parameters")
+            continue
+
+        rusage = load_json_data(f"{path}/tornet.plot.data/resource_usage.json")
+        sim_seconds = max([float(s) for s in rusage['run_time']['real_seconds_per_sim_second']], default=0)
+        if sim_seconds <= 0:
+            logging.warning(f"Skipping {path} because it has no run time data")
+            continue
+
+        # normalize the run time to a full-length simulation, in case the run ended early
+        run_time_seconds = rusage['run_time']['seconds'] * SIMULATION_LENGTH_SECONDS / sim_seconds
+
+        runs.append({
+            'path': path,
+            'info': info,
+            'features': __get_features(info),
+            'ram_gib': get_ram_gib_used(rusage),
+            'run_time_hours': run_time_seconds / 3600.0,
+        })
+        logging.info(f"Loaded resource usage from {path}")
+
+    return runs
+
+def __load_info(path):
+    # use the parsed simulation info if it is complete, otherwise read the generate log directly
+    # (e.g., for networks that were generated but not yet simulated, or parsed with older versions)
+    info_path = f"{path}/tornet.plot.data/simulation_info.json"
+    if os.path.exists(info_path):
+        info = load_json_data(info_path)
+        if all(k in info for k in __required_info_keys()):
+            return info
+    return parse_tornettools_generate_log(path)
+
+def __required_info_keys():
+    return ['num_sampled_relays', 'num_public_relays', 'net_scale', 'num_dir_authorities',
+            'num_tgen_exit_markov_clients', 'num_tgen_hs_markov_clients',
+            'num_tgen_exit_emulated_users', 'num_tgen_hs_emulated_users',
+            'num_tgen_exit_perf_clients', 'num_tgen_hs_perf_clients',
+            'num_tgen_exit_servers', 'num_tgen_onionservice_servers',
+            'process_scale', 'load_scale', 'full_network_relay_capacity_gbit']
+
+def __get_features(info):
+    num_markov = info['num_tgen_exit_markov_clients'] + info['num_tgen_hs_markov_clients']
+    num_perf = info['num_tgen_exit_perf_clients'] + info['num_tgen_hs_perf_clients']
+    num_servers = info['num_tgen_exit_servers'] + info['num_tgen_onionservice_servers']
+    return {
+        'num_relays': info['num_sampled_relays'] + info['num_dir_authorities'],
+        'num_tgen_processes': num_markov + num_perf + num_servers,
+        'relay_capacity_gbit': info['full_network_relay_capacity_gbit'] * info['net_scale'],
+        'load_scale': info['load_scale'],
+    }
+
+def __get_reference(runs):
+    # the properties of a full-scale network, averaged over the simulations we have, which
+    # let us approximate the features of a network that was not yet generated
+    infos = [r['info'] for r in runs]
+    num_markov = [i['num_tgen_exit_markov_clients'] + i['num_tgen_hs_markov_clients'] for i in infos]
+    num_servers = [i['num_tgen_exit_servers'] + i['num_tgen_onionservice_servers'] for i in infos]
+    num_users = [i['num_tgen_exit_emulated_users'] + i['num_tgen_hs_emulated_users'] for i in infos]
+    return {
+        'num_public_relays': mean([i['num_public_relays'] for i in infos]),
+        'num_dir_authorities': mean([i['num_dir_authorities'] for i in infos]),
+        'full_network_relay_capacity_gbit': mean([i['full_network_relay_capacity_gbit'] for i in infos]),
+        'num_users_per_network_scale': mean([u / i['net_scale'] for (u, i) in zip(num_users, infos)]),
+        'num_servers_per_markov_client': mean([s / m for (s, m) in zip(num_servers, num_markov) if m > 0] or [0]),
+        'num_perf_clients': mean([i['num_tgen_exit_perf_clients'] + i['num_tgen_hs_perf_clients'] for i in infos]),
+    }
+
+def __get_param_features(reference, network_scale, process_scale, load_scale):
+    num_markov = reference['num_users_per_network_scale'] * network_scale * process_scale
+    num_servers = num_markov * reference['num_servers_per_markov_client']
+    return {
+        'num_relays': round(reference['num_public_relays'] * network_scale) + reference['num_dir_authorities'],
+        'num_tgen_processes': num_markov + num_servers + reference['num_perf_clients'],
+        'relay_capacity_gbit': reference['full_network_relay_capacity_gbit'] * network_scale,
+        'load_scale': load_scale,
+    }
+
+def __fit_model(runs, target):
+    # a linear model with non-negative coefficients, so that bigger networks never cost less
+    x = array([[1.0] + [r['features'][f] for f in FEATURES] for r in runs])
+    y = array([r[target] for r in runs])
+    coefs, _ = nnls(x, y)
+
+    model = {'coefficients': dict(zip(['intercept'] + FEATURES, coefs.tolist()))}
+    predicted = x.dot(coefs)
+    model['max_rel_error'] = max([abs(p - v) / v if v > 0 else 0.0 for (p, v) in zip(predicted, y)])
+    return model
+
+def __predict(models, features):
+    prediction = {}
+    for (name, model) in models.items():
+        coefs = model['coefficients']
+        prediction[name] = coefs['intercept'] + sum([coefs[f] * features[f] for f in FEATURES])
+    return prediction
+
+def __solve_budget(args, runs, models):
+    # find the largest scale that fits the budget, holding the other parameters fixed
+    reference = __get_reference(runs)
+    params = {'network_scale': args.network_scale, 'process_scale': args.process_scale, 'load_scale': args.load_scale}
+
+    best = None
+    for scale in linspace(0.0001, 1.0, 10000).tolist():
+        params[args.solve_for] = scale
+        features = __get_param_features(reference, **params)
+        cost = __predict(models, features)
+        if args.ram_budget is not None and cost['ram_gib'] > args.ram_budget:
+            continue
+        if args.time_budget is not None and cost['run_time_hours'] > args.time_budget:
+            continue
+        best = {'parameters': dict(params), 'cost': cost}
+
+    budget = f"{args.ram_budget} GiB of RAM" if args.ram_budget is not None else "unlimited RAM"
+    budget += f" and {args.time_budget} hours" if args.time_budget is not None else " and unlimited time"
+    if best is None:
+        logging.warning(f"No {args.solve_for} fits within {budget}")
+    else:
+        logging.info(f"The largest {args.solve_for} that fits within {budget} is "
+                     f"{best['parameters'][args.solve_for]:.4f}, which is predicted to use "
+                     f"{best['cost']['ram_gib']:.2f} GiB of RAM and {best['cost']['run_time_hours']:.2f} hours")
+    return best
@@ -1,16 +1,22 @@
 import os
 import yaml
 import logging
-import shutil
-import random
 from ipaddress import IPv4Address
 import base64
 
+from argparse import Namespace
+from functools import lru_cache
+from multiprocessing import Pool
+
 import networkx as nx
 
-from tornettools.generate_tgen import generate_tgen_config, get_clients, get_servers
+from numpy import arange, array_split
+
+from tornettools.generate_tgen import generate_tgen_config, get_clients, get_servers, link_tmodel_topology
 from tornettools.generate_defaults import (BOOTSTRAP_LENGTH_SECONDS, BW_1GBIT_KBIT, BW_1MBIT_KBIT,
-                                           BW_RATE_MIN, CONFIG_DIRNAME, SHADOW_CONFIG_FILENAME,
+                                           BW_RATE_MIN, CONFIG_DIRNAME, FILE_WRITER_MAX_QUEUED_JOBS,
+                                           FILE_WRITER_NUM_THREADS, HOST_BUILD_MAX_CHUNKSIZE,
+                                           SHADOW_CONFIG_FILENAME,
                                            SHADOW_HOSTS_PATH, SHADOW_INSTALL_PREFIX,
                                            SHADOW_TEMPLATE_PATH, SIMULATION_LENGTH_SECONDS,
                                            TGENRC_MARKOVCLIENT_FILENAME, TGENRC_PERFCLIENT_EXIT_FILENAME,
@@ -24,17 +30,24 @@ from tornettools.generate_defaults import (BOOTSTRAP_LENGTH_SECONDS, BW_1GBIT_KB
                                            TORRC_RELAY_FILENAME, TORRC_RELAY_GUARDONLY_FILENAME,
                                            TORRC_RELAY_OTHER_FILENAME, TOR_CONTROL_PORT,
                                            TOR_ONIONSERVICE_DIR, get_host_rel_conf_path)
-from tornettools.generate_tor import generate_tor_config, generate_tor_keys, get_relays
+from tornettools.generate_tor import (generate_tor_config, generate_tor_keys, get_relays, load_relay_set,
+                                      save_relay_set)
+from tornettools.util import ParallelFileWriter, get_host_rng
 
-def run(args):
+def check_executables(args):
     if args.torexe is None:
         logging.critical("Unable to find a 'tor' executable in PATH, but we need it to generate keys. Did you build 'tor'? Did you set your PATH or provide the path to the 'tor' executable?")
         logging.critical("Refusing to generate a network without 'tor'.")
-        return
+        return False
     if args.torgencertexe is None:
         logging.critical("Unable to find a 'tor-gencert' executable in PATH, but we need it to generate keys. Did you build 'tor-gencert'? Did you set your PATH or provide the path to the 'tor-gencert' executable?")
         logging.critical("Refusing to generate a network without 'tor-gencert'.")
-        return
+        return False
+    return True
+
+def run(args):
+    if not check_executables(args):
+        return 1
 
     logging.info(f"Generating network using tor and tor-gencert at {args.torexe} and {args.torgencertexe}")
 
@@ -43,23 +56,32 @@ def run(args):
     # only copy the compressed atlas file if the user did not give us a custom path
     if args.atlas_path is None:
         logging.info("Copying atlas topology file (use the '-a/--atlas' option to disable)")
-        topology_src_path = "{}/data/shadow/network/{}.xz".format(args.tmodel_git_path, TMODEL_TOPOLOGY_FILENAME)
         topology_dst_path = "{}/{}/{}.xz".format(args.prefix, CONFIG_DIRNAME, TMODEL_TOPOLOGY_FILENAME)
-        shutil.copy2(topology_src_path, topology_dst_path)
+        link_tmodel_topology(args, topology_dst_path)
         args.atlas_path = topology_dst_path
 
     # read the staged network info graph, which contains all of the atlas graph nodes
-    logging.info(f"Reading staged network info {args.network_info_path}")
-    network = nx.readwrite.gml.read_gml(args.network_info_path, label='id')
-    logging.info("Finished reading staged network info")
+    placement = load_placement_index(args.network_info_path)
+
+    if args.reuse_from_path is not None:
+        # the relays do not depend on the other options, so take them (and their key material)
+        # from a network that we already generated
+        logging.info("Reusing the Tor relays and key material of the network at {}".format(args.reuse_from_path))
+        relay_set = load_relay_set(args, args.reuse_from_path)
+        if relay_set is None:
+            return 1
+        authorities, relays, sample_info = relay_set
+    else:
+        # get the set of relays we will create in shadow
+        logging.info("Sampling Tor relays now")
+        relays, sample_info = get_relays(args)
 
-    # get the set of relays we will create in shadow
-    logging.info("Sampling Tor relays now")
-    relays, relay_count = get_relays(args)
+        # generate key material and fingerprints for these relays
+        logging.info("Generating Tor key material now, this may take awhile...")
+        authorities, relays = generate_tor_keys(args, relays)
 
-    # generate key material and fingerprints for these relays
-    logging.info("Generating Tor key material now, this may take awhile...")
-    authorities, relays = generate_tor_keys(args, relays)
+    # so that this network can be reused too
+    save_relay_set(args, authorities, relays, sample_info)
 
     # each client and server operates as either an onion-service client/server, or
     # a non-onion-service (exit) client/server (never both)
@@ -71,29 +93,110 @@ def run(args):
 
     # onion-service clients should only connect to onion-service servers, and non-onion-service clients should only
     # connect to non-onion-service servers
-    exit_peers = ["{}:{}".format(server['name'], TGEN_SERVER_PORT) for server in tgen_servers if not server['is_hs_server']]
-    hs_peers = ["{}:{}".format(server['hs_hostname'], TGEN_ONIONSERVICE_PORT) for server in tgen_servers if server['is_hs_server']]
+    exit_peers = tuple(["{}:{}".format(server['name'], TGEN_SERVER_PORT) for server in tgen_servers if not server['is_hs_server']])
+    hs_peers = tuple(["{}:{}".format(server['hs_hostname'], TGEN_ONIONSERVICE_PORT) for server in tgen_servers if server['is_hs_server']])
+
+    # the (hostname, torrc-defaults) of every host that needs them, which we produce as they
+    # are written instead of keeping them all in memory
+    host_torrc_defaults = __iter_host_torrc_defaults(args, authorities, relays, tgen_servers, perf_clients, tgen_clients)
+
+    # the per-host files are written in the background while we generate the rest of the network
+    with ParallelFileWriter(FILE_WRITER_NUM_THREADS, FILE_WRITER_MAX_QUEUED_JOBS) as writer:
+        logging.info("Generating Tor configuration files")
+        generate_tor_config(args, authorities, relays, host_torrc_defaults, writer)
+
+        logging.info("Generating TGen configuration files")
+        generate_tgen_config(args, tgen_clients, exit_peers, hs_peers, writer)
+
+        traced_relays = __get_traced_relays(args, relays)
+
+        logging.info("Constructing Shadow config YAML file")
+        __generate_shadow_config(args, placement, authorities, relays, tgen_servers, perf_clients, tgen_clients, traced_relays, writer)
+
+def __iter_host_torrc_defaults(args, authorities, relays, tgen_servers, perf_clients, tgen_clients):
+    # reused relays already have their torrc-defaults
+    if args.reuse_from_path is None:
+        for x in authorities.values():
+            yield (x['nickname'], {'includes': [TORRC_RELAY_FILENAME, TORRC_RELAY_AUTHORITY_FILENAME]})
+        for y in relays.values():
+            for x in y.values():
+                yield (x['nickname'], __relay_host_torrc_defaults(x))
+    for x in perf_clients:
+        yield (x['name'], {'includes': [TORRC_CLIENT_FILENAME, TORRC_CLIENT_PERF_FILENAME]})
+    for x in tgen_clients:
+        yield (x['name'], {'includes': [TORRC_CLIENT_FILENAME, TORRC_CLIENT_MARKOV_FILENAME]})
+    for x in tgen_servers:
+        if x['is_hs_server']:
+            yield (x['name'], {'includes': [TORRC_ONIONSERVICE_FILENAME]})
+
+# The staged network info graph is large, so we only read and index it once per process (e.g.,
+# once for all of the networks in a sweep). The returned index is shared and must not be modified.
+@lru_cache(maxsize=None)
+def load_placement_index(network_info_path):
+    logging.info(f"Reading staged network info {network_info_path}")
+    network = nx.readwrite.gml.read_gml(network_info_path, label='id')
+    logging.info("Finished reading staged network info")
 
-    # perf-clients do not have host-specific tgen configs, so we can't set individual peer lists
-    for client in tgen_clients:
-        client['peers'] = exit_peers if not client['is_hs_client'] else hs_peers
+    # networkx stores the node 'id' separately, so take the node id from the tuple and combine it
+    # with the other node properties
+    all_nodes = [{'id': node_id, **node} for (node_id, node) in network.nodes(data=True)]
 
-    # a map from hostnames to the host's torrc-defaults
-    host_torrc_defaults = {}
-    host_torrc_defaults.update({x['nickname']: {'includes': [TORRC_RELAY_FILENAME, TORRC_RELAY_AUTHORITY_FILENAME]} for x in authorities.values()})
-    host_torrc_defaults.update({x['nickname']: __relay_host_torrc_defaults(x) for y in relays.values() for x in y.values()})
-    host_torrc_defaults.update({x['name']: {'includes': [TORRC_CLIENT_FILENAME, TORRC_CLIENT_PERF_FILENAME]} for x in perf_clients})
-    host_torrc_defaults.update({x['name']: {'includes': [TORRC_CLIENT_FILENAME, TORRC_CLIENT_MARKOV_FILENAME]} for x in tgen_clients})
-    host_torrc_defaults.update({x['name']: {'includes': [TORRC_ONIONSERVICE_FILENAME]} for x in tgen_servers if x['is_hs_server']})
+    # all of the lists in the index keep the node order of the graph, so that choosing from them
+    # is deterministic for a given seed
+    placement = {'all': all_nodes, 'by_ip': {}, 'by_country': {}, 'ip_by_id': {}}
+    for node in all_nodes:
+        if 'ip_address' in node:
+            ip = int(IPv4Address(node['ip_address']))
+            placement['by_ip'].setdefault(ip, []).append(node)
+            placement['ip_by_id'][node['id']] = ip
+        if 'country_code' in node:
+            placement['by_country'].setdefault(node['country_code'].casefold(), []).append(node)
+
+    logging.info("Indexed {} network nodes in {} countries".format(len(all_nodes), len(placement['by_country'])))
+    return placement
+
+def __build_hosts(args, placement, host_jobs):
+    # yields the YAML of each host in the order of the jobs, so that the caller can write each
+    # host as soon as it is built instead of keeping all of them in memory; the YAML text is
+    # much smaller than the host dicts, and is produced by the workers in parallel
+    if args.nprocesses <= 1 or len(host_jobs) <= 1:
+        for job in host_jobs:
+            yield __dump_yaml_nested(__build_host(args, placement, job))
+        return
 
-    logging.info("Generating Tor configuration files")
-    generate_tor_config(args, authorities, relays, host_torrc_defaults)
+    # the command handler and help formatter are only used by the main script
+    worker_args = Namespace(**{k: v for (k, v) in vars(args).items() if k not in ['func', 'formatter_class']})
+    chunksize = max(1, min(HOST_BUILD_MAX_CHUNKSIZE, len(host_jobs) // (args.nprocesses * 4)))
+
+    logging.info("Building {} Shadow hosts with {} processes".format(len(host_jobs), args.nprocesses))
+    with Pool(processes=args.nprocesses) as pool:
+        yield from pool.imap(__build_host_worker, ((worker_args, job) for job in host_jobs), chunksize=chunksize)
+
+def __build_host_worker(params):
+    # the workers load the (cached, if forked) placement index instead of receiving it with every job
+    (args, job) = params
+    return __dump_yaml_nested(__build_host(args, load_placement_index(args.network_info_path), job))
+
+def __build_host(args, placement, job):
+    (kind, node, kwargs) = job
+    if kind == 'relay':
+        return __tor_relay(args, placement, node, **kwargs)
+    elif kind == 'server':
+        return __server(args, placement, node)
+    elif kind == 'perfclient':
+        return __perfclient(args, placement, node)
+    else:
+        return __markovclient(args, placement, node)
 
-    logging.info("Generating TGen configuration files")
-    generate_tgen_config(args, tgen_clients, exit_peers, hs_peers)
+def __choose_node(args, hostname, candidate_nodes):
+    # each host draws from its own PRNG stream, so it does not matter in which order we place them
+    rng = get_host_rng(args.seed, hostname, 'placement')
+    return candidate_nodes[rng.integers(len(candidate_nodes))]
 
-    logging.info("Constructing Shadow config YAML file")
-    __generate_shadow_config(args, network, authorities, relays, tgen_servers, perf_clients, tgen_clients)
+def __assign_relay_address(used_addresses, relay):
+    if 'address' not in relay:
+        return None
+    return str(__assign_address(used_addresses, IPv4Address(relay['address'])))
 
 def __assign_address(used_addresses, ip_address_hint):
     offset = 0
@@ -124,13 +227,42 @@ def __relay_host_torrc_defaults(relay):
 
     return {'includes': includes, 'bandwidth_rate': rate, 'bandwidth_burst': burst}
 
-def __generate_shadow_config(args, network, authorities, relays, tgen_servers, perf_clients, tgen_clients):
+def __get_traced_relays(args, relays):
+    # returns the nicknames of the relays on which we run oniontrace. to keep the sample
+    # representative, we sort each position by bandwidth, split it into bins, and trace the
+    # median relay of each bin (which does not use the PRNGs, so the rest of the network is
+    # the same as without sampling).
+    traced_relays = set()
+    total_capacity, traced_capacity = 0, 0
+
+    for pos in ['ge', 'e', 'g', 'm']:
+        pos_relays = sorted(relays[pos].values(), key=lambda relay: relay['weight'], reverse=True)
+        if len(pos_relays) == 0:
+            continue
+
+        n_traced = max(1, round(len(pos_relays) * args.oniontrace_relay_fraction))
+        for index_bin in array_split(arange(len(pos_relays)), n_traced):
+            traced_relays.add(pos_relays[index_bin[len(index_bin) // 2]]['nickname'])
+
+        for relay in pos_relays:
+            total_capacity += int(relay['bandwidth_capacity'])
+            if relay['nickname'] in traced_relays:
+                traced_capacity += int(relay['bandwidth_capacity'])
+
+    n_relays = sum([len(relays[pos]) for pos in ['ge', 'e', 'g', 'm']])
+    traced_fraction = traced_capacity / total_capacity if total_capacity > 0 else 1.0
+    if args.events_csv is not None or args.do_trace:
+        logging.info("We will run oniontrace on {} of {} relays with {} of the relay capacity".format(
+            len(traced_relays), n_relays, traced_fraction))
+
+    return traced_relays
+
+def __generate_shadow_config(args, placement, authorities, relays, tgen_servers, perf_clients, tgen_clients, traced_relays, writer):
     # create the YAML for the shadow.config.yaml file
 
     config = {}
     config["general"] = {}
     config["network"] = {}
-    config["hosts"] = {}
 
     config["general"]["bootstrap_end_time"] = BOOTSTRAP_LENGTH_SECONDS # disable bandwidth limits and packet loss for first 5 minutes
     config["general"]["stop_time"] = SIMULATION_LENGTH_SECONDS # stop after 1 hour of simulated time
@@ -150,28 +282,66 @@ def __generate_shadow_config(args, network, authorities, relays, tgen_servers, p
     config["network"]["graph"]["file"]["path"] = str(args.atlas_path)
     config["network"]["graph"]["file"]["compression"] = "xz"
 
+    # relay addresses must be unique, so we assign them in order before building the hosts
     used_addresses = set()
+    host_jobs = []
+    hosts_prefix = "{}/{}/{}".format(args.prefix, SHADOW_TEMPLATE_PATH, SHADOW_HOSTS_PATH)
 
     for (fp, authority) in sorted(authorities.items(), key=lambda kv: kv[1]['nickname']):
-        config["hosts"].update(__tor_relay(args, network, used_addresses, authority, fp, is_authority=True))
+        ip_addr = __assign_relay_address(used_addresses, authority)
+        writer.write("{}/{}/fingerprint-public-tor".format(hosts_prefix, authority['nickname']), f"{fp}\n")
+        host_jobs.append(('relay', authority, {'ip_addr': ip_addr, 'is_authority': True, 'do_oniontrace': True}))
 
     for pos in ['ge', 'e', 'g', 'm']:
         # use reverse to sort each class from fastest to slowest when assigning the id counter
         for (fp, relay) in sorted(relays[pos].items(), key=lambda kv: kv[1]['weight'], reverse=True):
-            config["hosts"].update(__tor_relay(args, network, used_addresses, relay, fp, is_authority=False))
+            ip_addr = __assign_relay_address(used_addresses, relay)
+            do_oniontrace = relay['nickname'] in traced_relays
+            writer.write("{}/{}/fingerprint-public-tor".format(hosts_prefix, relay['nickname']), f"{fp}\n")
+            host_jobs.append(('relay', relay, {'ip_addr': ip_addr, 'is_authority': False, 'do_oniontrace': do_oniontrace}))
 
     for server in tgen_servers:
-        config["hosts"].update(__server(args, network, server))
+        if server['is_hs_server']:
+            # prepare the hostname and hs_ed25519_secret_key files for the onion service
+            hs_prefix = "{}/{}/{}".format(hosts_prefix, server['name'], TOR_ONIONSERVICE_DIR)
+            secret_key = b"== ed25519v1-secret: type0 ==\x00\x00\x00" + base64.b64decode(server['hs_ed25519_secret_key'])
+            writer.write("{}/{}".format(hs_prefix, 'hostname'), server['hs_hostname'] + '\n', dir_mode=0o700)
+            writer.write("{}/{}".format(hs_prefix, 'hs_ed25519_secret_key'), secret_key, dir_mode=0o700)
 
-    for client in perf_clients:
-        config["hosts"].update(__perfclient(args, network, client))
+    host_jobs.extend([('server', server, {}) for server in tgen_servers])
+    host_jobs.extend([('perfclient', client, {}) for client in perf_clients])
+    host_jobs.extend([('markovclient', client, {}) for client in tgen_clients])
 
-    for client in tgen_clients:
-        config["hosts"].update(__markovclient(args, network, client))
+    for (section, options) in __get_shadow_options(args).items():
+        config.setdefault(section, {}).update(options)
 
     with open("{}/{}".format(args.prefix, SHADOW_CONFIG_FILENAME), 'w') as configfile:
         yaml.dump(config, configfile, sort_keys=False)
 
+        # a full network has too many hosts to keep all of them in memory, so we write each host
+        # under the 'hosts' key as it is built. every host draws from its own PRNG streams, so the
+        # hosts are the same no matter how many processes we use to build them.
+        configfile.write("hosts:\n")
+        for host_yaml in __build_hosts(args, placement, host_jobs):
+            configfile.write(host_yaml)
+
+def __dump_yaml_nested(mapping):
+    # the YAML of mapping, indented as the value of a top-level key; yaml wraps long lines at
+    # column 80 by default, so we shorten the width by the indent to wrap them at the same place
+    indent = 2
+    text = yaml.dump(mapping, sort_keys=False, width=80 - indent)
+    return ''.join([" " * indent + line for line in text.splitlines(keepends=True)])
+
+def __get_shadow_options(args):
+    # Shadow options that the user set with '--shadow_option'; the performance options that
+    # depend on the machine are chosen by simulate on the machine that runs the simulation
+    options = {}
+    for (name, value) in args.shadow_options:
+        (section, option) = name.split('.', 1)
+        logging.info("Using {}={} from --shadow_option".format(name, value))
+        options.setdefault(section, {})[option] = value
+    return options
+
 def __get_scaled_tgen_client_bandwidth_kbit(args):
     # 10 Mbit/s per "user" that a tgen client simulates
     n_users_per_tgen = round(1.0 / args.process_scale)
@@ -184,48 +354,43 @@ def __get_scaled_tgen_server_bandwidth_kbit(args):
     scaled_bw = scaled_client_bw * n_clients_per_server
     return scaled_bw
 
-def __filter_nodes(network, ip_address_hint, country_code_hint):
-    # networkx stores the node 'id' separately, so take the node id from the tuple and combine it
-    # with the other node properties
-    all_nodes = [{'id': node_id, **node} for (node_id, node) in network.nodes(data=True)]
-
+def __filter_nodes(placement, ip_address_hint, country_code_hint):
     if ip_address_hint is not None and not ip_address_hint.is_global:
         # ignore the hint if the IP address is not global
         logging.debug(f"Ignoring non-global address {ip_address_hint}")
         ip_address_hint = None
 
-    if country_code_hint is not None:
-        # normalize the country code
-        country_code_hint = country_code_hint.casefold()
-
     # are there any nodes with the same ip address?
-    ip_match_found = any('ip_address' in node and IPv4Address(node['ip_address']) == ip_address_hint for node in all_nodes)
-
-    if ip_match_found:
+    if ip_address_hint is not None and int(ip_address_hint) in placement['by_ip']:
         # get all nodes with exact IP matches, regardless of the country code
-        candidate_nodes = [node for node in all_nodes if 'ip_address' in node and IPv4Address(node['ip_address']) == ip_address_hint]
-    else:
-        # get all nodes with the same country code
-        candidate_nodes = [node for node in all_nodes if 'country_code' in node and node['country_code'].casefold() == country_code_hint]
+        return placement['by_ip'][int(ip_address_hint)]
+
+    # get all nodes with the same country code
+    candidate_nodes = []
+    if country_code_hint is not None:
+        # normalize the country code
+        candidate_nodes = placement['by_country'].get(country_code_hint.casefold(), [])
 
-        # if no node had the same country code, use all nodes
-        if len(candidate_nodes) == 0:
-            candidate_nodes = [node for node in all_nodes]
+    # if no node had the same country code, use all nodes
+    if len(candidate_nodes) == 0:
+        candidate_nodes = placement['all']
 
-        any_ip_found = any('ip_address' in node for node in candidate_nodes)
+    # if a node has an IP address and we were given an IP hint, perform longest prefix matching
+    if ip_address_hint is not None:
+        ip_by_id = placement['ip_by_id']
 
-        # if a node has an IP address and we were given an IP hint, perform longest prefix matching
-        if any_ip_found and ip_address_hint is not None:
-            # exclude nodes without an IP address
-            candidate_nodes = [node for node in candidate_nodes if 'ip_address' in node]
+        # exclude nodes without an IP address
+        nodes_with_ip = [node for node in candidate_nodes if node['id'] in ip_by_id]
 
+        if len(nodes_with_ip) > 0:
             # function to compute the prefix match between two IPv4 addresses
             # the 32-bit mask is required since python uses signed integers
             #   (see https://stackoverflow.com/questions/210629/python-unsigned-32-bit-bitwise-arithmetic/210740)
-            def compute_prefix_match(ip_1, ip_2): return ~(int(ip_1) ^ int(ip_2)) & 0xffffffff
+            def compute_prefix_match(ip_1, ip_2): return ~(ip_1 ^ ip_2) & 0xffffffff
 
             # get the prefix match for each node
-            prefix_matches = [(node, compute_prefix_match(IPv4Address(node['ip_address']), ip_address_hint)) for node in candidate_nodes]
+            hint = int(ip_address_hint)
+            prefix_matches = [(node, compute_prefix_match(ip_by_id[node['id']], hint)) for node in nodes_with_ip]
 
             # get the longest prefix match
             max_prefix_match = max(prefix_matches, key=lambda x: x[1])[1]
@@ -234,18 +399,18 @@ def __filter_nodes(network, ip_address_hint, country_code_hint):
             candidate_nodes = [node for (node, prefix_match) in prefix_matches if prefix_match == max_prefix_match]
 
             # given the 'compute_prefix_match' function above, these nodes should all have the same IP address
-            assert len(set([IPv4Address(node['ip_address']) for node in candidate_nodes])) == 1
+            assert len(set([ip_by_id[node['id']] for node in candidate_nodes])) == 1
 
     return candidate_nodes
 
-def __server(args, network, server):
+def __server(args, placement, server):
     # Make sure we have enough bandwidth for the expected number of clients
     scaled_bw_kbit = __get_scaled_tgen_server_bandwidth_kbit(args)
     host_bw_kbit = max(BW_1GBIT_KBIT, scaled_bw_kbit)
 
     # filter the network graph nodes by their country, and choose one node
     country_code_hint = server.get('country_code')
-    chosen_node = random.choice(__filter_nodes(network, None, country_code_hint))
+    chosen_node = __choose_node(args, server['name'], __filter_nodes(placement, None, country_code_hint))
 
     # add the host element and attributes
     host = {}
@@ -271,19 +436,6 @@ def __server(args, network, server):
     host["processes"].append(process)
 
     if server['is_hs_server']:
-        # prepare the hostname and hs_ed25519_secret_key files for the onion service
-        hosts_prefix = "{}/{}/{}".format(args.prefix, SHADOW_TEMPLATE_PATH, SHADOW_HOSTS_PATH)
-        server_prefix = "{}/{}".format(hosts_prefix, server['name'])
-        hs_prefix = "{}/{}".format(server_prefix, TOR_ONIONSERVICE_DIR)
-
-        if not os.path.exists(hs_prefix):
-            os.makedirs(hs_prefix, 0o700)
-
-        with open("{}/{}".format(hs_prefix, 'hostname'), 'w') as outf:
-            outf.write(server['hs_hostname'] + '\n')
-        with open("{}/{}".format(hs_prefix, 'hs_ed25519_secret_key'), 'wb') as outf:
-            outf.write(b"== ed25519v1-secret: type0 ==\x00\x00\x00" + base64.b64decode(server['hs_ed25519_secret_key']))
-
         # tor process for the onion service
         process = {}
         process["path"] = "{}/bin/tor".format(SHADOW_INSTALL_PREFIX)
@@ -296,20 +448,22 @@ def __server(args, network, server):
 
     return {server['name']: host}
 
-def __perfclient(args, network, client):
+def __perfclient(args, placement, client):
     # a perfclient can have one of two tgen configurations which specifies which servers it connects to
     if not client['is_hs_client']:
         tgenrc_fname = TGENRC_PERFCLIENT_EXIT_FILENAME
     else:
         tgenrc_fname = TGENRC_PERFCLIENT_HS_FILENAME
 
-    return __tgen_client(args, network, client['name'], client['country_code'],
-                         get_host_rel_conf_path(tgenrc_fname))
+    return __tgen_client(args, placement, client['name'], client['country_code'],
+                         get_host_rel_conf_path(tgenrc_fname), do_oniontrace=True)
 
-def __markovclient(args, network, client):
+def __markovclient(args, placement, client):
+    # when sampling, we only trace the perf clients and a subset of the relays
+    do_oniontrace = args.oniontrace_relay_fraction >= 1.0
     # these should be relative paths
-    return __tgen_client(args, network, client['name'], client['country_code'],
-                         TGENRC_MARKOVCLIENT_FILENAME)
+    return __tgen_client(args, placement, client['name'], client['country_code'],
+                         TGENRC_MARKOVCLIENT_FILENAME, do_oniontrace=do_oniontrace)
 
 def __format_tor_args(name):
     args = []
@@ -328,14 +482,14 @@ def __format_tor_args(name):
 
     return ' '.join(args)
 
-def __tgen_client(args, network, name, country, tgenrc_fname):
+def __tgen_client(args, placement, name, country, tgenrc_fname, do_oniontrace=True):
     # Make sure we have enough bandwidth for the simulated number of users
     scaled_bw_kbit = __get_scaled_tgen_client_bandwidth_kbit(args)
     host_bw_kbit = max(BW_1GBIT_KBIT, scaled_bw_kbit)
 
     # filter the network graph nodes by their country, and choose one node
     country_code_hint = country
-    chosen_node = random.choice(__filter_nodes(network, None, country_code_hint))
+    chosen_node = __choose_node(args, name, __filter_nodes(placement, None, country_code_hint))
 
     # add the host element and attributes
     host = {}
@@ -357,8 +511,9 @@ def __tgen_client(args, network, name, country, tgenrc_fname):
 
     host["processes"].append(process)
 
-    oniontrace_start_time = max(2, BOOTSTRAP_LENGTH_SECONDS - 60 + 1)
-    host["processes"].extend(__oniontrace(args, oniontrace_start_time, name))
+    if do_oniontrace:
+        oniontrace_start_time = max(2, BOOTSTRAP_LENGTH_SECONDS - 60 + 1)
+        host["processes"].extend(__oniontrace(args, oniontrace_start_time, name))
 
     process = {}
     process["path"] = "{}/bin/tgen".format(SHADOW_INSTALL_PREFIX)
@@ -371,25 +526,21 @@ def __tgen_client(args, network, name, country, tgenrc_fname):
 
     return {name: host}
 
-def __tor_relay(args, network, used_addresses, relay, orig_fp, is_authority=False):
+def __tor_relay(args, placement, relay, ip_addr=None, is_authority=False, do_oniontrace=True):
     # prepare items for the host element
     kbits = 8 * int(round(int(relay['bandwidth_capacity']) / 1000.0))
 
-    hosts_prefix = "{}/{}/{}".format(args.prefix, SHADOW_TEMPLATE_PATH, SHADOW_HOSTS_PATH)
-    with open("{}/{}/fingerprint-public-tor".format(hosts_prefix, relay['nickname']), 'w') as outf:
-        outf.write(f"{orig_fp}\n")
-
     # filter the network graph nodes by their IP address and country, and choose one node
     ip_address_hint = IPv4Address(relay['address']) if 'address' in relay else None
     country_code_hint = relay.get('country_code')
-    chosen_node = random.choice(__filter_nodes(network, ip_address_hint, country_code_hint))
+    chosen_node = __choose_node(args, relay['nickname'], __filter_nodes(placement, ip_address_hint, country_code_hint))
 
     # add the host element and attributes
     host = {}
     host['network_node_id'] = chosen_node['id']
 
-    if ip_address_hint:
-        host["ip_addr"] = str(__assign_address(used_addresses, ip_address_hint))
+    if ip_addr is not None:
+        host["ip_addr"] = ip_addr
 
     host["bandwidth_down"] = "{} kilobit".format(kbits)
     host["bandwidth_up"] = "{} kilobit".format(kbits)
@@ -416,8 +567,9 @@ def __tor_relay(args, network, used_addresses, relay, orig_fp, is_authority=Fals
 
     host['processes'].append(process)
 
-    oniontrace_start_time = starttime + 1
-    host['processes'].extend(__oniontrace(args, oniontrace_start_time, relay['nickname']))
+    if do_oniontrace:
+        oniontrace_start_time = starttime + 1
+        host['processes'].extend(__oniontrace(args, oniontrace_start_time, relay['nickname']))
 
     return {relay['nickname']: host}
 
@@ -12,6 +12,9 @@ SHADOW_INSTALL_PREFIX = "~/.local"
 SHADOW_HOSTS_PATH = "hosts"
 SHADOW_CONFIG_FILENAME = "shadow.config.yaml"
 
+# the full network sample in a relay cache directory (see generate's '--relay_cache' option)
+RELAY_CACHE_SAMPLE_FILENAME = "relay-sample.json"
+
 RESOLV_FILENAME = "shadowresolv.conf"
 BW_AUTHORITY_NAME = "bwauthority"
 
@@ -30,6 +33,23 @@ TORRC_CLIENT_MARKOV_FILENAME = "tor.client.markov.torrc"
 TORRC_CLIENT_PERF_FILENAME = "tor.client.perf.torrc"
 TORRC_ONIONSERVICE_FILENAME = "tor.onionservice.torrc"
 
+# The log settings for each of generate's '--log-profile' options. The parse command only
+# consumes the perf client tgen logs (which always log at 'info' so we can compute client
+# goodput), the oniontrace logs, and Shadow's own log, so these only affect debugging.
+#   full:    tor at 'notice' (authorities at 'info') with a heartbeat every second, the first
+#            markov client at tgen 'info', and the other tgen clients and servers at 'message'
+#   lean:    tor at 'notice' without the per-second heartbeat, all markov clients and servers
+#            at tgen 'message'
+#   minimal: tor at 'warn' without the heartbeat, markov clients and servers at tgen 'warning'
+LOG_PROFILES = {
+    'full': {'tor': 'notice', 'tor_authority': 'info', 'tor_heartbeat': True,
+             'tgen_first_markovclient': 'info', 'tgen_markovclient': 'message', 'tgen_server': 'message'},
+    'lean': {'tor': 'notice', 'tor_authority': 'notice', 'tor_heartbeat': False,
+             'tgen_first_markovclient': 'message', 'tgen_markovclient': 'message', 'tgen_server': 'message'},
+    'minimal': {'tor': 'warn', 'tor_authority': 'warn', 'tor_heartbeat': False,
+                'tgen_first_markovclient': 'warning', 'tgen_markovclient': 'warning', 'tgen_server': 'warning'},
+}
+
 TOR_SOCKS_PORT = 9050
 TOR_CONTROL_PORT = 9051
 TOR_OR_PORT = 9001
@@ -68,11 +88,36 @@ TMODEL_STREAMMODEL_FILENAME = "tgen.tor-streammodel-ccs2018.graphml"
 TMODEL_PACKETMODEL_FILENAME = "tgen.tor-packetmodel-ccs2018.graphml"
 TMODEL_TOPOLOGY_FILENAME = "atlas_v201801.shadow_v2.gml"
 
+# the privcount measurements in the tmodel-ccs2018 repository that we convert for tgen
+TMODEL_PACKETMODEL_SRC_PATH = "data/privcount/measurement8/9/privcount.traffic.model.1522196794-1522283493.json"
+TMODEL_STREAMMODEL_SRC_PATH = "data/privcount/measurement9/9/privcount.traffic.model.1524154791-1524241191.json"
+TMODEL_CLIENT_TALLY_SRC_PATH = "data/privcount/measurement1/privcount.tallies.1508707017-1508793717.json"
+TMODEL_CIRCUIT_TALLY_SRC_PATH = "data/privcount/measurement3/privcount.tallies.1515796790-1515883190.json"
+# the compressed atlas topology in the tmodel-ccs2018 repository
+TMODEL_TOPOLOGY_SRC_PATH = "data/shadow/network/{}.xz".format(TMODEL_TOPOLOGY_FILENAME)
+# the file in which we cache the scalars we extract from the tallies (see generate's '--tmodel_cache')
+TMODEL_CACHE_TALLIES_FILENAME = "tallies.json"
+
+# the relays and authorities of a generated network, which '--reuse-from' loads
+RELAY_SET_FILENAME = "relays.json"
+
+# the per-host files are small and mostly limited by file system latency, so we write them with
+# more threads than we have cores; the queue bounds the data waiting to be written
+FILE_WRITER_NUM_THREADS = 16
+FILE_WRITER_MAX_QUEUED_JOBS = 1024
+# the hosts that a worker builds at once; the built hosts wait in memory until they are written
+# to the shadow config in order, so this bounds how many of them we hold
+HOST_BUILD_MAX_CHUNKSIZE = 64
+
 # Timestamp passed to faketime(1) when generating certificates. Should be < 1
 # year before simulation start (which is currently hard-coded in shadow to
 # 2000-01-01).
 CERT_FAKETIMESTAMP = "1999-12-01"
 
+# Lifetime of the ed25519 signing key certificates that we write when generating relay keys
+# without tor ('--keygen python'); this is tor's default SigningKeyLifetime.
+ED25519_SIGNING_CERT_LIFETIME = 30 * 24 * 60 * 60
+
 def get_host_rel_conf_path(rc_filename, rc_subdirname=None):
     if rc_subdirname is None:
         return f"../../../{CONFIG_DIRNAME}/{rc_filename}"
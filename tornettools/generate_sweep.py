@@ -0,0 +1,177 @@
+import os
+import logging
+import argparse
+import itertools
+import multiprocessing
+import yaml
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from random import seed as stdseed
+from numpy.random import seed as numpyseed
+
+from tornettools import generate
+from tornettools.util import load_json_data_cached
+
+# the generate options that may be swept, and the abbreviations we use for them in the
+# prefix name of each generated network (e.g., 'tornet-0.01n-0.1p-1.0l')
+SWEEP_PARAMETERS = {
+    'network_scale': 'n',
+    'process_scale': 'p',
+    'server_scale': 's',
+    'load_scale': 'l',
+    'torperf_num_exit': 'te',
+    'torperf_num_onion_service': 'to',
+    'onion_service_user_scale': 'o',
+    'exit_user_scale': 'x',
+}
+
+def run(args):
+    if not generate.check_executables(args):
+        return 1
+
+    grid = __load_grid(args.sweep_path)
+    if grid is None:
+        return 1
+
+    points = __get_points(args, grid)
+    logging.info(f"Generating {len(points)} networks from the parameter grid in {args.sweep_path}")
+
+    # the shared inputs are loaded once here and then inherited by the worker processes
+    logging.info("Loading the shared generate inputs")
+    load_json_data_cached(args.relay_info_path)
+    load_json_data_cached(args.user_info_path)
+    generate.load_placement_index(args.network_info_path)
+
+    # networks with the same network scale are generated from the same relay sample (we use
+    # the same seed for every point), so only the first of them needs to sample relays and
+    # generate key material, and the others reuse its relays
+    first_points, other_points = [], []
+    reuse_prefixes = {}
+    for point in points:
+        network_scale = point['args'].network_scale
+        if network_scale not in reuse_prefixes:
+            reuse_prefixes[network_scale] = point['args'].prefix
+            first_points.append(point)
+        else:
+            point['args'].reuse_from_path = reuse_prefixes[network_scale]
+            other_points.append(point)
+
+    num_workers = max(1, min(args.nprocesses, len(points)))
+    logging.info(f"Generating networks with {num_workers} worker processes")
+
+    logging.info(f"Generating {len(first_points)} networks with new key material")
+    failed = __run_points(first_points, num_workers)
+
+    # a network whose relays could not be generated can't be reused
+    skipped = [point for point in other_points if point['args'].reuse_from_path in failed]
+    for point in skipped:
+        logging.error(f"Skipping {point['args'].prefix}, because generating {point['args'].reuse_from_path} failed")
+    other_points = [point for point in other_points if point not in skipped]
+
+    logging.info(f"Generating {len(other_points)} networks that reuse existing relays and key material")
+    failed.extend(__run_points(other_points, num_workers))
+
+    num_generated = len(points) - len(failed) - len(skipped)
+    logging.info(f"Done generating {num_generated} of {len(points)} networks in {args.prefix}")
+    if len(failed) > 0 or len(skipped) > 0:
+        logging.error(f"Failed to generate {len(failed)} networks and skipped {len(skipped)}: {', '.join(failed)}")
+        return 1
+    return 0
+
+def __load_grid(sweep_path):
+    # the grid is a YAML (or JSON) mapping from generate option names to lists of values
+    with open(sweep_path, 'r') as infile:
+        spec = yaml.safe_load(infile)
+
+    if not isinstance(spec, dict) or len(spec) == 0:
+        logging.critical(f"The sweep file {sweep_path} must map generate options to lists of values")
+        return None
+
+    grid = {}
+    for (key, values) in spec.items():
+        if key not in SWEEP_PARAMETERS:
+            logging.critical(f"Unable to sweep '{key}'; supported options are: {', '.join(SWEEP_PARAMETERS)}")
+            return None
+
+        values = values if isinstance(values, list) else [values]
+        cast = int if key.startswith('torperf_num') else float
+        grid[key] = [cast(v) for v in values]
+
+        if len(grid[key]) == 0 or any(v < 0 for v in grid[key]):
+            logging.critical(f"The sweep values for '{key}' must be a non-empty list of non-negative numbers")
+            return None
+
+    return grid
+
+def __get_points(args, grid):
+    points = []
+
+    keys = list(grid.keys())
+    for values in itertools.product(*[grid[k] for k in keys]):
+        point_args = argparse.Namespace(**vars(args))
+        # the command handler and help formatter are only used by the main script
+        vars(point_args).pop('func', None)
+        vars(point_args).pop('formatter_class', None)
+        for (key, value) in zip(keys, values):
+            setattr(point_args, key, value)
+
+        name = '-'.join([f"{v}{SWEEP_PARAMETERS[k]}" for (k, v) in zip(keys, values)])
+        point_args.prefix = f"{args.prefix}/tornet-{name}"
+        point_args.sweep_path = None
+
+        points.append({'args': point_args})
+
+    return points
+
+def __run_points(points, num_workers):
+    # returns the prefixes of the networks that we failed to generate
+    num_workers = min(num_workers, len(points))
+
+    # split the key generation processes among the workers
+    for point in points:
+        point['args'].nprocesses = max(1, point['args'].nprocesses // max(1, num_workers))
+
+    if num_workers <= 1:
+        results = [__generate_point(point) for point in points]
+    else:
+        # we fork so that the workers inherit the inputs that we already loaded
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=context) as pool:
+            futures = [pool.submit(__generate_point, point) for point in points]
+            # this raises any exception that occurred in the worker
+            results = [future.result() for future in futures]
+
+    # like the main script, generate returns None or 0 on success
+    failed = []
+    for (point, rv) in zip(points, results):
+        if rv is not None and rv != 0:
+            logging.error(f"Generating {point['args'].prefix} failed with code {rv}")
+            failed.append(point['args'].prefix)
+    return failed
+
+def __generate_point(point):
+    args = point['args']
+    os.makedirs(args.prefix, exist_ok=True)
+
+    # give each network its own generate log, because the parse command reads it later
+    root_logger, handler = logging.getLogger(), None
+    if args.quiet == 0:
+        datestr = datetime.now().strftime("%Y-%m-%d.%H.%M.%S")
+        handler = logging.FileHandler(filename=f"{args.prefix}/tornettools.generate.{datestr}.log")
+        if len(root_logger.handlers) > 0:
+            handler.setFormatter(root_logger.handlers[0].formatter)
+        root_logger.addHandler(handler)
+
+    try:
+        # every network uses the same seed, so each is the same as if we ran generate on its own
+        stdseed(args.seed)
+        numpyseed(args.seed)
+        logging.info("Seeded standard and numpy PRNGs with seed={}".format(args.seed))
+        logging.info("The argument namespace is: {}".format(str(args)))
+
+        return generate.run(args)
+    finally:
+        if handler is not None:
+            root_logger.removeHandler(handler)
+            handler.close()
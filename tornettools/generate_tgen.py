@@ -1,26 +1,32 @@
 import os
-import json
+import hashlib
 import logging
+import shutil
 import stem.process
 import stem.connection
 import tempfile
 
+from functools import lru_cache
 from math import ceil
 from numpy.random import choice, uniform
-from random import randrange
 
 from networkx import DiGraph, write_graphml
 
-from tornettools.generate_defaults import (CONFIG_DIRNAME, ONIONPERF_COUNTRY_CODES,
+from tornettools.generate_defaults import (CONFIG_DIRNAME, LOG_PROFILES, ONIONPERF_COUNTRY_CODES,
                                            PRIVCOUNT_PERIODS_PER_DAY, SHADOW_HOSTS_PATH,
                                            SHADOW_TEMPLATE_PATH, TGENRC_FLOWMODEL_FILENAME_FMT,
                                            TGENRC_MARKOVCLIENT_FILENAME,
                                            TGENRC_PERFCLIENT_EXIT_FILENAME,
                                            TGENRC_PERFCLIENT_HS_FILENAME, TGENRC_SERVER_FILENAME,
                                            TGEN_CLIENT_MIN_COUNT, TGEN_SERVER_PORT,
-                                           TMODEL_PACKETMODEL_FILENAME, TMODEL_STREAMMODEL_FILENAME,
-                                           TOR_SOCKS_PORT, get_host_rel_conf_path)
-from tornettools.util import load_json_data
+                                           TMODEL_CACHE_TALLIES_FILENAME,
+                                           TMODEL_CIRCUIT_TALLY_SRC_PATH,
+                                           TMODEL_CLIENT_TALLY_SRC_PATH,
+                                           TMODEL_PACKETMODEL_FILENAME, TMODEL_PACKETMODEL_SRC_PATH,
+                                           TMODEL_STREAMMODEL_FILENAME, TMODEL_STREAMMODEL_SRC_PATH,
+                                           TMODEL_TOPOLOGY_SRC_PATH, TOR_SOCKS_PORT,
+                                           get_host_rel_conf_path)
+from tornettools.util import dump_json_data, get_host_rng, link_or_copy_file, load_json_data, load_json_data_cached
 
 def __round_or_ceil(x):
     """Round to the nearest integer, except don't round down to zero.
@@ -39,7 +45,7 @@ def __round_or_ceil(x):
         res = ceil(x)
     return res
 
-def generate_tgen_config(args, tgen_clients, exit_peers, hs_peers):
+def generate_tgen_config(args, tgen_clients, exit_peers, hs_peers, writer):
     # make sure the config directory exists
     abs_conf_path = "{}/{}".format(args.prefix, CONFIG_DIRNAME)
     if not os.path.exists(abs_conf_path):
@@ -49,20 +55,24 @@ def generate_tgen_config(args, tgen_clients, exit_peers, hs_peers):
     if not os.path.exists(hosts_prefix):
         os.makedirs(hosts_prefix)
 
-    __generate_tgenrc_server(abs_conf_path)
-    __generate_tgenrc_perfclient(exit_peers, os.path.join(abs_conf_path, TGENRC_PERFCLIENT_EXIT_FILENAME))
-    __generate_tgenrc_perfclient(hs_peers, os.path.join(abs_conf_path, TGENRC_PERFCLIENT_HS_FILENAME))
-    __generate_tgenrc_markovclients(abs_conf_path, hosts_prefix, tgen_clients)
+    # onion-service clients should only connect to onion-service servers, and non-onion-service
+    # clients should only connect to non-onion-service servers. a full network has thousands of
+    # servers, so we build each peers string once and share it between all of the tgenrcs.
+    server_peers = {'exit': ','.join(exit_peers), 'hs': ','.join(hs_peers)}
+
+    __generate_tgenrc_server(abs_conf_path, LOG_PROFILES[args.log_profile]['tgen_server'])
+    __generate_tgenrc_perfclient(server_peers['exit'], os.path.join(abs_conf_path, TGENRC_PERFCLIENT_EXIT_FILENAME))
+    __generate_tgenrc_perfclient(server_peers['hs'], os.path.join(abs_conf_path, TGENRC_PERFCLIENT_HS_FILENAME))
+    __generate_tgenrc_markovclients(args, abs_conf_path, hosts_prefix, tgen_clients, server_peers, writer)
     __generate_tgen_traffic_models(args, abs_conf_path)
 
-def __generate_tgenrc_server(abs_conf_path):
+def __generate_tgenrc_server(abs_conf_path, log_level):
     G = DiGraph()
-    G.add_node("start", serverport="{}".format(TGEN_SERVER_PORT), loglevel="message", stallout="0 seconds", timeout="0 seconds")
+    G.add_node("start", serverport="{}".format(TGEN_SERVER_PORT), loglevel=log_level, stallout="0 seconds", timeout="0 seconds")
     path = "{}/{}".format(abs_conf_path, TGENRC_SERVER_FILENAME)
     write_graphml(G, path)
 
 def __generate_tgenrc_perfclient(server_peers, path):
-    server_peers = ','.join(server_peers)
     proxy = "localhost:{}".format(TOR_SOCKS_PORT)
 
     G = DiGraph()
@@ -92,12 +102,12 @@ def __generate_tgenrc_perfclient(server_peers, path):
 
     write_graphml(G, path)
 
-def __generate_tgenrc_markovclients(abs_conf_path, hosts_prefix, tgen_clients):
+def __generate_tgenrc_markovclients(args, abs_conf_path, hosts_prefix, tgen_clients, server_peers, writer):
     for tgen_client in tgen_clients:
-        __generate_tgenrc_markovclient(abs_conf_path, hosts_prefix, tgen_client)
+        peers = server_peers['hs'] if tgen_client['is_hs_client'] else server_peers['exit']
+        __generate_tgenrc_markovclient(args, abs_conf_path, hosts_prefix, tgen_client, peers, writer)
 
-def __generate_tgenrc_markovclient(abs_conf_path, hosts_prefix, tgen_client):
-    server_peers = ','.join(tgen_client['peers'])
+def __generate_tgenrc_markovclient(args, abs_conf_path, hosts_prefix, tgen_client, server_peers, writer):
     circuit_rate_exp = float(tgen_client['circuit_rate_exp'])
     usec_per_circ = int(round(1.0 / circuit_rate_exp))
 
@@ -110,8 +120,9 @@ def __generate_tgenrc_markovclient(abs_conf_path, hosts_prefix, tgen_client):
 
     # we need a new tgenrc for each markov client, even though some of them share the flow model,
     # because each of them gets new random seeds
-    socksauthseed = "{}".format(randrange(1, 1000000000))
-    markovmodelseed = "{}".format(randrange(1, 1000000000))
+    rng = get_host_rng(args.seed, tgen_client['name'], 'tgenrc')
+    socksauthseed = "{}".format(rng.integers(1, 1000000000))
+    markovmodelseed = "{}".format(rng.integers(1, 1000000000))
 
     # we use the following paths in the tgenrc, they should be relative
     fmodel_relpath = get_host_rel_conf_path(flowmodelname)
@@ -119,7 +130,7 @@ def __generate_tgenrc_markovclient(abs_conf_path, hosts_prefix, tgen_client):
     pmodel_relpath = get_host_rel_conf_path(TMODEL_PACKETMODEL_FILENAME)
 
     # at startup, delay walking the tgen graph for a random period in the range [1,60] seconds
-    startup_delay = "{}".format(randrange(60) + 1)
+    startup_delay = "{}".format(rng.integers(60) + 1)
 
     # now generate the tgenrc graphml file
     G = DiGraph()
@@ -149,12 +160,12 @@ def __generate_tgenrc_markovclient(abs_conf_path, hosts_prefix, tgen_client):
     G.add_edge("start", "traffic")
     G.add_edge("traffic", "traffic")
 
-    host_dir = "{}/{}".format(hosts_prefix, tgen_client['name'])
-    if not os.path.exists(host_dir):
-        os.makedirs(host_dir)
+    tgenrc_path = "{}/{}/{}".format(hosts_prefix, tgen_client['name'], TGENRC_MARKOVCLIENT_FILENAME)
+    writer.submit(__write_host_graphml, G, tgenrc_path)
 
-    tgenrc_path = "{}/{}".format(host_dir, TGENRC_MARKOVCLIENT_FILENAME)
-    write_graphml(G, tgenrc_path)
+def __write_host_graphml(G, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_graphml(G, path)
 
 def __generate_tgen_flowmodel(path, rate):
     G = DiGraph()
@@ -172,20 +183,77 @@ def __generate_tgen_flowmodel(path, rate):
     write_graphml(G, path)
 
 def __generate_tgen_traffic_models(args, abs_conf_path):
-    # packet model taken from measurement 8-9 in the tmodel ccs2018 paper
-    privcount_packetmodel_path = '{}/data/privcount/measurement8/9/privcount.traffic.model.1522196794-1522283493.json'.format(args.tmodel_git_path)
-    tgen_packetmodel_path = '{}/{}'.format(abs_conf_path, TMODEL_PACKETMODEL_FILENAME)
-    __generate_tgen_markov_model(privcount_packetmodel_path, "packet_model", tgen_packetmodel_path)
+    cache_path = __get_tmodel_cache_path(args.tmodel_git_path, args.tmodel_cache_path)
 
+    # packet model taken from measurement 8-9 in the tmodel ccs2018 paper
     # stream model taken from measurement 9-9 in the tmodel ccs2018 paper
-    privcount_streammodel_path = '{}/data/privcount/measurement9/9/privcount.traffic.model.1524154791-1524241191.json'.format(args.tmodel_git_path)
-    tgen_streammodel_path = '{}/{}'.format(abs_conf_path, TMODEL_STREAMMODEL_FILENAME)
-    __generate_tgen_markov_model(privcount_streammodel_path, "stream_model", tgen_streammodel_path)
+    for (src_rel_path, tmodel_key, dst_filename) in [(TMODEL_PACKETMODEL_SRC_PATH, "packet_model", TMODEL_PACKETMODEL_FILENAME),
+                                                     (TMODEL_STREAMMODEL_SRC_PATH, "stream_model", TMODEL_STREAMMODEL_FILENAME)]:
+        tgen_tmodel_path = '{}/{}'.format(abs_conf_path, dst_filename)
+
+        if cache_path is not None and os.path.exists('{}/{}'.format(cache_path, dst_filename)):
+            link_or_copy_file('{}/{}'.format(cache_path, dst_filename), tgen_tmodel_path)
+            continue
+
+        privcount_tmodel_path = '{}/{}'.format(args.tmodel_git_path, src_rel_path)
+        __generate_tgen_markov_model(privcount_tmodel_path, tmodel_key, tgen_tmodel_path)
+
+        if cache_path is not None:
+            __store_in_tmodel_cache(cache_path, dst_filename, lambda tmp_path: shutil.copyfile(tgen_tmodel_path, tmp_path))
+
+def link_tmodel_topology(args, dst_path):
+    # the atlas topology is large, so every network links to one copy in the tmodel cache
+    # instead of storing its own copy. links only work within a file system, so if the cache
+    # is on another one, caching would only store and copy the file once more
+    src_path = "{}/{}".format(args.tmodel_git_path, TMODEL_TOPOLOGY_SRC_PATH)
+    cache_path = __get_tmodel_cache_path(args.tmodel_git_path, args.tmodel_cache_path)
+    if cache_path is not None:
+        os.makedirs(cache_path, exist_ok=True)
+    if cache_path is None or os.stat(cache_path).st_dev != os.stat(os.path.dirname(dst_path)).st_dev:
+        shutil.copy2(src_path, dst_path)
+        return
+
+    filename = os.path.basename(TMODEL_TOPOLOGY_SRC_PATH)
+    if not os.path.exists('{}/{}'.format(cache_path, filename)):
+        __store_in_tmodel_cache(cache_path, filename, lambda tmp_path: shutil.copy2(src_path, tmp_path))
+
+    method = link_or_copy_file('{}/{}'.format(cache_path, filename), dst_path)
+    logging.info("Used a {} of the atlas topology file in the tmodel cache".format(method))
+
+# The converted traffic models, the tally scalars, and the atlas topology only depend on the
+# tmodel inputs, so we cache them on disk. The key covers the tmodel path and the contents of
+# every input (the size and modification time of the large topology file), so we never use a
+# stale entry after the tmodel repository changes.
+@lru_cache(maxsize=None)
+def __get_tmodel_cache_path(tmodel_git_path, tmodel_cache_path):
+    if tmodel_cache_path is None:
+        return None
+
+    key = hashlib.sha256(os.path.abspath(tmodel_git_path).encode())
+    for src_rel_path in [TMODEL_PACKETMODEL_SRC_PATH, TMODEL_STREAMMODEL_SRC_PATH,
+                         TMODEL_CLIENT_TALLY_SRC_PATH, TMODEL_CIRCUIT_TALLY_SRC_PATH]:
+        with open('{}/{}'.format(tmodel_git_path, src_rel_path), 'rb') as infile:
+            for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+                key.update(chunk)
+    topology_stat = os.stat('{}/{}'.format(tmodel_git_path, TMODEL_TOPOLOGY_SRC_PATH))
+    key.update('{}:{}'.format(topology_stat.st_size, topology_stat.st_mtime_ns).encode())
+
+    cache_path = '{}/tmodel-{}'.format(tmodel_cache_path, key.hexdigest()[:16])
+    logging.info("Using the tmodel cache at {}".format(cache_path))
+    return cache_path
+
+def __store_in_tmodel_cache(cache_path, filename, write_func):
+    # other generate processes may be writing the same file at the same time
+    os.makedirs(cache_path, exist_ok=True)
+    tmp_path = '{}/{}.tmp.{}'.format(cache_path, filename, os.getpid())
+    write_func(tmp_path)
+    # networks may hard link to the cached file, so make sure that it is not modified in place
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, '{}/{}'.format(cache_path, filename))
 
 def __generate_tgen_markov_model(privcount_tmodel_src_path, tmodel_key, tgen_tmodel_dst_path):
-    with open(privcount_tmodel_src_path, 'r') as privcount_tmodel_file:
-        tmodel = json.load(privcount_tmodel_file)
-        hmm = tmodel[tmodel_key]
+    tmodel = load_json_data_cached(privcount_tmodel_src_path)
+    hmm = tmodel[tmodel_key]
 
     state_ctr = 0
     obs_ctr = 0
@@ -299,9 +367,10 @@ def get_servers(args, clients):
     server_counter = 0
 
     for i in range(n_exit_servers):
-        chosen_country_code = choice(country_codes, p=country_probs)
+        name = 'server{}exit'.format(server_counter + 1)
+        chosen_country_code = __choose_country(args, name, country_codes, country_probs)
         server = {
-            'name': 'server{}exit'.format(server_counter + 1),
+            'name': name,
             'country_code': chosen_country_code,
             'is_hs_server': False,
         }
@@ -310,9 +379,10 @@ def get_servers(args, clients):
 
     for i in range(n_hs_servers):
         (privkey, onion_url) = keys[i]
-        chosen_country_code = choice(country_codes, p=country_probs)
+        name = 'server{}onionservice'.format(server_counter + 1)
+        chosen_country_code = __choose_country(args, name, country_codes, country_probs)
         server = {
-            'name': 'server{}onionservice'.format(server_counter + 1),
+            'name': name,
             'country_code': chosen_country_code,
             'hs_ed25519_secret_key': privkey,
             'hs_hostname': onion_url,
@@ -343,11 +413,10 @@ def get_clients(args):
       Period 7: scale=0.0254, path=data/privcount/measurement7/privcount.tallies.1516493936-1516580336.json
     '''
 
+    tally_counts = __load_tally_counts(args)
+
     # client counts taken from measurement 1 in the tmodel ccs2018 paper.
     measurement1_scale = 0.0126
-    tally_path = '{}/data/privcount/measurement1/privcount.tallies.1508707017-1508793717.json'.format(args.tmodel_git_path)
-    with open(tally_path, 'r') as tally_file:
-        measurement1 = json.load(tally_file)
 
     # circuits per client historgram taken from measurement 2 in the tmodel ccs2018 paper.
     # measurement2_scale = 0.0113
@@ -357,14 +426,11 @@ def get_clients(args):
 
     # exit circuit count taken from measurement 3 in the tmodel ccs2018 paper.
     measurement3_scale = 0.0213
-    tally_path = '{}/data/privcount/measurement3/privcount.tallies.1515796790-1515883190.json'.format(args.tmodel_git_path)
-    with open(tally_path, 'r') as tally_file:
-        measurement3 = json.load(tally_file)
 
-    n_total_users, n_active_users, n_inactive_users = __get_client_counts(measurement1, measurement1_scale, args.network_scale)
+    n_total_users, n_active_users, n_inactive_users = __scale_tally_counts(tally_counts['clients'], measurement1_scale, args.network_scale)
     logging.info("Privcount measurements scaled to {} Tor users, {} active and {} inactive".format(n_total_users, n_active_users, n_inactive_users))
 
-    n_total_exit_circs, n_active_exit_circs, n_inactive_exit_circs = __get_exit_circuit_counts(measurement3, measurement3_scale, args.network_scale)
+    n_total_exit_circs, n_active_exit_circs, n_inactive_exit_circs = __scale_tally_counts(tally_counts['exit_circuits'], measurement3_scale, args.network_scale)
     logging.info("Privcount measurements scaled to {} exit circuits, {} active and {} inactive".format(n_total_exit_circs, n_active_exit_circs, n_inactive_exit_circs))
 
     n_exit_users, n_hs_users, n_circuits_per_user = __get_tgen_users(args, n_active_users, n_active_exit_circs)
@@ -402,24 +468,29 @@ def __get_perf_clients(args, n_exit_users, n_hs_users):
                         f"torperf_num_exit={args.torperf_num_exit}")
 
     for (i, is_hs_client) in ((x, x >= args.torperf_num_exit) for x in range(n_perf)):
-        chosen_country_code = choice(ONIONPERF_COUNTRY_CODES)
+        if is_hs_client:
+            name = 'perfclient{}onionservice'.format(i + 1)
+        else:
+            name = 'perfclient{}exit'.format(i + 1)
+
+        chosen_country_code = __choose_country(args, name, ONIONPERF_COUNTRY_CODES)
         client = {
+            'name': name,
             'country_code': chosen_country_code,
             'is_hs_client': is_hs_client,
         }
 
-        if is_hs_client:
-            client['name'] = 'perfclient{}onionservice'.format(i + 1)
-        else:
-            client['name'] = 'perfclient{}exit'.format(i + 1)
-
         perf_clients.append(client)
 
     return perf_clients
 
+def __choose_country(args, name, country_codes, country_probs=None):
+    # each host draws from its own PRNG stream, so the choice does not depend on the other hosts
+    return str(get_host_rng(args.seed, name, 'country').choice(country_codes, p=country_probs))
+
 def __load_user_data(args):
     # geographical user info taken from stage command output, i.e., tor metrics
-    user_data = load_json_data(args.user_info_path)
+    user_data = load_json_data_cached(args.user_info_path)
 
     country_codes = sorted(user_data.keys())
     country_probs = [float(user_data[code]) for code in country_codes]
@@ -476,11 +547,18 @@ def __get_tgen_clients(args, n_exit_users, n_hs_users, n_circuits_per_user):
     # each client will be placed in a country
     country_codes, country_probs = __load_user_data(args)
 
+    log_profile = LOG_PROFILES[args.log_profile]
+
     total_exit_circuits_10_mins = 0
     total_hs_circuits_10_mins = 0
     for (i, is_hs_client) in ((x, x >= n_exit_tgen) for x in range(n_exit_tgen + n_hs_tgen)):
+        if is_hs_client:
+            name = 'markovclient{}onionservice'.format(i + 1)
+        else:
+            name = 'markovclient{}exit'.format(i + 1)
+
         # where to place the tgen process
-        chosen_country_code = choice(country_codes, p=country_probs)
+        chosen_country_code = __choose_country(args, name, country_codes, country_probs)
 
         # how many total circuits should the tgen process create
         # note - sampling the circuit-per-client distribution turns out to be inaccurate, likely
@@ -501,41 +579,39 @@ def __get_tgen_clients(args, n_exit_users, n_hs_users, n_circuits_per_user):
         exponential_rate = 1.0 / usec_per_circ
 
         client = {
+            'name': name,
             'circuit_rate_exp': exponential_rate,
             'country_code': chosen_country_code,
-            'log_level': 'info' if i == 0 else 'message',
+            'log_level': log_profile['tgen_first_markovclient'] if i == 0 else log_profile['tgen_markovclient'],
             'is_hs_client': is_hs_client,
         }
 
-        if is_hs_client:
-            client['name'] = 'markovclient{}onionservice'.format(i + 1)
-        else:
-            client['name'] = 'markovclient{}exit'.format(i + 1)
-
         tgen_clients.append(client)
 
     return tgen_clients, total_exit_circuits_10_mins, total_hs_circuits_10_mins
 
-def __get_client_counts(measurement, privcount_scale, tornet_scale):
-    # extract the counts from the tally file data
-    total_count = measurement['EntryClientIPCount']['bins'][0][2]
-    active_count = measurement['EntryActiveClientIPCount']['bins'][0][2]
-    inactive_count = measurement['EntryInactiveClientIPCount']['bins'][0][2]
+def __load_tally_counts(args):
+    cache_path = __get_tmodel_cache_path(args.tmodel_git_path, args.tmodel_cache_path)
+    if cache_path is not None and os.path.exists('{}/{}'.format(cache_path, TMODEL_CACHE_TALLIES_FILENAME)):
+        return load_json_data('{}/{}'.format(cache_path, TMODEL_CACHE_TALLIES_FILENAME))
 
-    # we need to convert the counts at the privcount scale, to counts at our tornet scale
-    scale_factor = tornet_scale / privcount_scale / PRIVCOUNT_PERIODS_PER_DAY
+    measurement1 = load_json_data_cached('{}/{}'.format(args.tmodel_git_path, TMODEL_CLIENT_TALLY_SRC_PATH))
+    measurement3 = load_json_data_cached('{}/{}'.format(args.tmodel_git_path, TMODEL_CIRCUIT_TALLY_SRC_PATH))
 
-    total_scaled = __round_or_ceil(total_count * scale_factor)
-    active_scaled = __round_or_ceil(active_count * scale_factor)
-    inactive_scaled = __round_or_ceil(inactive_count * scale_factor)
+    # extract the total, active, and inactive counts from the tally file data
+    tally_counts = {
+        'clients': [measurement1[k]['bins'][0][2] for k in ['EntryClientIPCount', 'EntryActiveClientIPCount', 'EntryInactiveClientIPCount']],
+        'exit_circuits': [measurement3[k]['bins'][0][2] for k in ['ExitCircuitCount', 'ExitActiveCircuitCount', 'ExitInactiveCircuitCount']],
+    }
 
-    return total_scaled, active_scaled, inactive_scaled
+    if cache_path is not None:
+        __store_in_tmodel_cache(cache_path, TMODEL_CACHE_TALLIES_FILENAME,
+                                lambda tmp_path: dump_json_data(tally_counts, tmp_path, compress=False))
+
+    return tally_counts
 
-def __get_exit_circuit_counts(measurement, privcount_scale, tornet_scale):
-    # extract the counts from the tally file data
-    total_count = measurement['ExitCircuitCount']['bins'][0][2]
-    active_count = measurement['ExitActiveCircuitCount']['bins'][0][2]
-    inactive_count = measurement['ExitInactiveCircuitCount']['bins'][0][2]
+def __scale_tally_counts(counts, privcount_scale, tornet_scale):
+    total_count, active_count, inactive_count = counts
 
     # we need to convert the counts at the privcount scale, to counts at our tornet scale
     scale_factor = tornet_scale / privcount_scale / PRIVCOUNT_PERIODS_PER_DAY
@@ -585,14 +661,21 @@ def __sample_bins(bins):
     return value
 
 def generate_onion_service_keys(tor_cmd, n):
+    # don't bother starting tor if there is nothing to do
+    if n == 0:
+        return []
+
     with tempfile.TemporaryDirectory(prefix='tornettools-hs-keygen-') as dir_name:
-        config = {'DisableNetwork': '1', 'DataDirectory': dir_name, 'ControlPort': '9030'}
+        # use a control socket inside the temporary directory rather than a fixed control port,
+        # so that multiple generate processes (e.g., in a sweep) can run at the same time
+        control_socket_path = "{}/control".format(dir_name)
+        config = {'DisableNetwork': '1', 'DataDirectory': dir_name, 'ControlSocket': control_socket_path}
         tor_process = stem.process.launch_tor_with_config(config,
                                                           tor_cmd=tor_cmd,
                                                           init_msg_handler=logging.debug,
                                                           take_ownership=True,
                                                           completion_percent=0)
-        controller = stem.connection.connect(control_port=('127.0.0.1', 9030))
+        controller = stem.connection.connect(control_socket=control_socket_path)
 
         keys = []
 
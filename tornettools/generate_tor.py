@@ -1,18 +1,25 @@
 import os
+import base64
+import hashlib
 import logging
-import subprocess
 import shlex
 import shutil
+import struct
 import sys
+import time
 
 from multiprocessing import Pool, cpu_count
 
-from numpy import array_split
-from numpy.random import choice, uniform
+from numpy import argsort, array, array_split, cumsum, full, select, uint32, where, zeros
+from numpy import round as npround
+from numpy.random import choice, get_state, set_state, uniform
 
 from tornettools.generate_defaults import (BW_1GBIT_BYTES, BW_AUTHORITY_NAME,
                                            CERT_FAKETIMESTAMP, CONFIG_DIRNAME,
-                                           DIRAUTH_COUNTRY_CODES, RESOLV_FILENAME, RUN_FREQ_THRESH,
+                                           DIRAUTH_COUNTRY_CODES, ED25519_SIGNING_CERT_LIFETIME,
+                                           LOG_PROFILES,
+                                           RELAY_CACHE_SAMPLE_FILENAME, RELAY_SET_FILENAME,
+                                           RESOLV_FILENAME, RUN_FREQ_THRESH,
                                            SHADOW_HOSTS_PATH, SHADOW_TEMPLATE_PATH,
                                            TGEN_ONIONSERVICE_PORT, TGEN_SERVER_PORT,
                                            TORRC_CLIENT_FILENAME, TORRC_CLIENT_MARKOV_FILENAME,
@@ -26,54 +33,165 @@ from tornettools.generate_defaults import (BW_1GBIT_BYTES, BW_AUTHORITY_NAME,
                                            TORRC_RELAY_OTHER_FILENAME, TOR_CONTROL_PORT,
                                            TOR_DIR_PORT, TOR_GUARD_MIN_CONSBW, TOR_ONIONSERVICE_DIR,
                                            TOR_OR_PORT, TOR_SOCKS_PORT, get_host_rel_conf_path)
-from tornettools.util import load_json_data, which
-
-def __generate_authority_keys(torgencertexe, datadir, torrc, pwpath):
+from tornettools.util import (ParallelFileWriter, dump_json_data, get_host_rng, load_json_data,
+                              load_json_data_cached, run_commands, which)
+
+# the cryptography module is only needed to generate relay keys without tor ('--keygen python')
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa, x25519
+except ImportError:
+    serialization = None
+
+# the fields of the relay table that we use to sample and choose relays; relay fingerprints
+# are 40 hex characters, and the position is one of 'g', 'e', 'ge', or 'm'
+RELAY_TABLE_DTYPE = [
+    ('fingerprint', 'U40'),
+    ('weight', 'f8'),
+    ('running_frequency', 'f8'),
+    ('guard_frequency', 'f8'),
+    ('exit_frequency', 'f8'),
+    ('bandwidth_capacity', 'f8'),
+    ('position', 'U2'),
+]
+
+def __get_authority_keys_command(torgencertexe, datadir, pwpath):
     faketime_exe = which('faketime')
     if faketime_exe is None:
         logging.critical("Couldn't locate faketime; needed for certificate generation")
         sys.exit(1)
 
+    # tor-gencert writes the certificate and keys into its working directory
     cmd = f"{faketime_exe} {CERT_FAKETIMESTAMP} {torgencertexe} --create-identity-key -m 24 --passphrase-fd 0"
+    return {'args': shlex.split(cmd), 'cwd': "{}/keys".format(datadir), 'stdin_path': pwpath}
 
-    with open(pwpath, 'r') as pwin:
-        proc = subprocess.run(shlex.split(cmd), stdin=pwin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    if proc.returncode != 0:
-        out = proc.stdout.decode('utf-8')
-        logging.critical("Error generating authority identity key using command line '{}': {}".format(cmd, out))
-
-    proc.check_returncode()
-
+def __read_v3ident(datadir):
     v3ident = ""
-    with open("authority_certificate", 'r') as certf:
+    with open("{}/keys/authority_certificate".format(datadir), 'r') as certf:
         for line in certf:
             if 'fingerprint' in line:
                 v3ident = line.strip().split()[1]
-
-    shutil.move("authority_certificate", "{}/keys".format(datadir))
-    shutil.move("authority_identity_key", "{}/keys".format(datadir))
-    shutil.move("authority_signing_key", "{}/keys".format(datadir))
-
     return v3ident
 
-def __generate_fingerprint(subproc_args):
-    torexe, datadir, nickname, torrc = subproc_args
+def __get_fingerprint_command(torexe, datadir, nickname, torrc):
     listfp_cmd = "{} --list-fingerprint --DataDirectory {} --Nickname {} -f {}".format(torexe, datadir, nickname, torrc)
-    completed_process = subprocess.run(shlex.split(listfp_cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    return completed_process
+    return {'args': shlex.split(listfp_cmd)}
+
+def __write_tor_keys(job):
+    # write the keys and fingerprint files that 'tor --list-fingerprint' would write for a
+    # relay, in tor's on-disk formats, without running tor
+    datadir, nickname = job
+
+    identity_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+    onion_key = rsa.generate_private_key(public_exponent=65537, key_size=1024)
+    ntor_key = x25519.X25519PrivateKey.generate()
+    master_key = ed25519.Ed25519PrivateKey.generate()
+    signing_key = ed25519.Ed25519PrivateKey.generate()
+
+    master_public = __raw_public_bytes(master_key)
+    signing_public = __raw_public_bytes(signing_key)
+
+    # tor clamps its curve25519 secret keys when it generates them, which does not change the
+    # public key
+    ntor_secret = bytearray(ntor_key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                                                   serialization.NoEncryption()))
+    ntor_secret[0] &= 248
+    ntor_secret[31] &= 127
+    ntor_secret[31] |= 64
+
+    # the master key certifies the signing key (see cert-spec.txt): version 1, cert type 4, the
+    # expiration in hours, key type 1, the signing key, and one extension that holds the master key
+    expiration_hours = (int(time.time()) + ED25519_SIGNING_CERT_LIFETIME + 3599) // 3600
+    signing_cert = struct.pack(">BBIB", 1, 4, expiration_hours, 1) + signing_public
+    signing_cert += struct.pack(">BHBB", 1, 32, 4, 0) + master_public
+    signing_cert += master_key.sign(signing_cert)
+
+    key_files = {
+        'secret_id_key': __pem_private_key(identity_key),
+        'secret_onion_key': __pem_private_key(onion_key),
+        'secret_onion_key_ntor': __tagged_key_file("c25519v1", "onion", bytes(ntor_secret) + __raw_public_bytes(ntor_key)),
+        'ed25519_master_id_public_key': __tagged_key_file("ed25519v1-public", "type0", master_public),
+        'ed25519_master_id_secret_key': __tagged_key_file("ed25519v1-secret", "type0", __expanded_ed25519_key(master_key)),
+        'ed25519_signing_secret_key': __tagged_key_file("ed25519v1-secret", "type0", __expanded_ed25519_key(signing_key)),
+        'ed25519_signing_cert': __tagged_key_file("ed25519v1-cert", "type4", signing_cert),
+    }
+
+    identity_der = identity_key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.PKCS1)
+    fingerprint = hashlib.sha1(identity_der).hexdigest().upper()
+    fingerprint_ed25519 = base64.b64encode(master_public).decode('utf-8').rstrip('=')
+
+    # tor keeps its data and keys directories private
+    os.makedirs(datadir, mode=0o700, exist_ok=True)
+    os.makedirs("{}/keys".format(datadir), mode=0o700, exist_ok=True)
+    for fname, data in key_files.items():
+        __write_private_file("{}/keys/{}".format(datadir, fname), data)
+    __write_private_file("{}/fingerprint".format(datadir), "{} {}\n".format(nickname, fingerprint).encode('utf-8'))
+    __write_private_file("{}/fingerprint-ed25519".format(datadir), "{} {}\n".format(nickname, fingerprint_ed25519).encode('utf-8'))
+
+def __raw_public_bytes(key):
+    return key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+def __pem_private_key(key):
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption())
+
+def __expanded_ed25519_key(key):
+    # tor stores the expanded form of ed25519 secret keys: the clamped sha512 hash of the seed
+    seed = key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+    expanded = bytearray(hashlib.sha512(seed).digest())
+    expanded[0] &= 248
+    expanded[31] &= 63
+    expanded[31] |= 64
+    return bytes(expanded)
+
+def __tagged_key_file(key_type, tag, data):
+    # tor's key files start with a header naming the key type, padded to 32 bytes
+    header = "== {}: {} ==".format(key_type, tag).encode('utf-8')
+    return header + b"\x00" * (32 - len(header)) + data
+
+def __write_private_file(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as outfile:
+        outfile.write(data)
+
+def __copy_tor_keys(src_datadir, datadir):
+    # copy the key material and fingerprint files that tor and tor-gencert wrote for the
+    # same node in another generated network
+    shutil.copytree("{}/keys".format(src_datadir), "{}/keys".format(datadir), dirs_exist_ok=True)
+    for fname in ["fingerprint", "fingerprint-ed25519"]:
+        if os.path.exists("{}/{}".format(src_datadir, fname)):
+            shutil.copy2("{}/{}".format(src_datadir, fname), "{}/{}".format(datadir, fname))
 
 def __read_fingerprint(datadir):
     with open("{0}/fingerprint".format(datadir), 'r') as f:
         tornet_fp = f.readline().strip().split()[1]
     return tornet_fp
 
+def __store_tor_keys(datadir, cache_datadir):
+    # store the key material of a node in the relay cache; other generate processes may be
+    # storing the same node at the same time, so write to a temporary dir and then rename it
+    if os.path.exists(cache_datadir):
+        return
+    tmp_datadir = "{}.tmp.{}".format(cache_datadir, os.getpid())
+    __copy_tor_keys(datadir, tmp_datadir)
+    try:
+        os.rename(tmp_datadir, cache_datadir)
+    except OSError:
+        shutil.rmtree(tmp_datadir, ignore_errors=True)
+
 def generate_tor_keys(args, relays):
     template_prefix = "{}/{}".format(args.prefix, SHADOW_TEMPLATE_PATH)
     hosts_prefix = "{}/{}".format(template_prefix, SHADOW_HOSTS_PATH)
     keygen_torrc = "{}/keygen.torrc".format(template_prefix)
     keygen_pw = "{}/keygen.pw".format(template_prefix)
 
+    # when using a relay cache, we reuse the key material of every node that we have seen before
+    cache_hosts_prefix = None
+    if args.relay_cache_path is not None:
+        cache_hosts_prefix = "{}/{}".format(args.relay_cache_path, SHADOW_HOSTS_PATH)
+        if not os.path.exists(cache_hosts_prefix):
+            os.makedirs(cache_hosts_prefix)
+
     # create directories that do not exist
     if not os.path.exists(hosts_prefix):
         os.makedirs(hosts_prefix)
@@ -83,47 +201,74 @@ def generate_tor_keys(args, relays):
           file=open(keygen_torrc, 'w'))
     print("shadowprivatenetwork\n", file=open(keygen_pw, 'w'))
 
-    # generate the list of commands we need to run to generate the fingerprints
-    work = []
+    nicknames = []
 
     # handle authorities, we need at least 3 to produce valid consensus
     n_authorities = max(3, round(10.0 * args.network_scale))
     for i in range(n_authorities):
-        nickname = "4uthority{}".format(i + 1)
-        datadir = "{}/{}".format(hosts_prefix, nickname)
-        subproc_args = [args.torexe, datadir, nickname, keygen_torrc]
-        work.append(subproc_args)
+        nicknames.append("4uthority{}".format(i + 1))
 
     # handle relays
     n_relays = 0
     for pos in ['g', 'e', 'ge', 'm']:
         for fp in relays[pos]:
             n_relays += 1
-            nickname = relays[pos][fp]["nickname"]
-            datadir = "{}/{}".format(hosts_prefix, nickname)
-            subproc_args = [args.torexe, datadir, nickname, keygen_torrc]
-            work.append(subproc_args)
+            nicknames.append(relays[pos][fp]["nickname"])
+
+    # copy the key material that already exists, and generate the list of commands we need to
+    # run to generate the remaining fingerprints
+    work = []
+    copied = set()
+    for nickname in nicknames:
+        datadir = "{}/{}".format(hosts_prefix, nickname)
+        if cache_hosts_prefix is not None and os.path.exists("{}/{}/fingerprint".format(cache_hosts_prefix, nickname)):
+            __copy_tor_keys("{}/{}".format(cache_hosts_prefix, nickname), datadir)
+            copied.add(nickname)
+        else:
+            work.append((datadir, nickname))
+
+    if len(copied) > 0:
+        logging.info("Copied existing key material for {} Tor nodes from {}".format(len(copied), args.relay_cache_path))
 
     # run the fingerprint generator
     num_processes = args.nprocesses if args.nprocesses > 0 else cpu_count()
-    results = []
 
-    if num_processes > 1:
-        # generate keys in parallel
-        with Pool(processes=num_processes) as pool:
-            results = pool.map(__generate_fingerprint, work)
+    if args.keygen_backend == 'python':
+        if serialization is None:
+            logging.critical("Couldn't import the cryptography python module; needed to generate keys with '--keygen python'")
+            sys.exit(1)
+
+        # key generation is cpu bound, so we spread it over processes
+        if num_processes > 1 and len(work) > 1:
+            with Pool(processes=num_processes) as pool:
+                for _ in pool.imap_unordered(__write_tor_keys, work, chunksize=max(1, len(work) // (4 * num_processes))):
+                    pass
+        else:
+            for job in work:
+                __write_tor_keys(job)
     else:
-        # generate keys synchronously
-        for subproc_args in work:
-            results.append(__generate_fingerprint(subproc_args))
+        commands = [__get_fingerprint_command(args.torexe, datadir, nickname, keygen_torrc) for (datadir, nickname) in work]
+        results = run_commands(commands, max_parallel=num_processes)
+
+        # make sure they all succeeded
+        for r in results:
+            if r.returncode != 0:
+                logging.critical("Error generating fingerprint using command line '{}'".format(' '.join(r.args)))
+            assert r.returncode == 0
 
-    # make sure they all succeeded
-    logging.info("Generated fingerprints and keys for {} Tor nodes ({} authorities and {} relays)".format(len(results), n_authorities, n_relays))
-    for r in results:
+    logging.info("Generated fingerprints and keys for {} Tor nodes ({} authorities and {} relays)".format(len(nicknames), n_authorities, n_relays))
+
+    # the authorities also need their v3 identity keys and certificates
+    work = []
+    for i in range(n_authorities):
+        nickname = "4uthority{}".format(i + 1)
+        if nickname not in copied:
+            work.append(__get_authority_keys_command(args.torgencertexe, "{}/{}".format(hosts_prefix, nickname), keygen_pw))
+
+    for r in run_commands(work, max_parallel=num_processes):
         if r.returncode != 0:
-            logging.critical("Error generating fingerprint using command line '{}': {}".format(
-                r.args, r.stdout.decode('utf-8')))
-        assert r.returncode == 0
+            logging.critical("Error generating authority identity key using command line '{}'".format(' '.join(r.args)))
+        r.check_returncode()
 
     # read, parse, and store the resulting fingerprint
     for pos in ['g', 'e', 'ge', 'm']:
@@ -140,12 +285,19 @@ def generate_tor_keys(args, relays):
         authorities[fp] = {
             "nickname": nickname,
             "tornet_fingerprint": fp,
-            "v3identity": __generate_authority_keys(args.torgencertexe, datadir, keygen_torrc, keygen_pw),
+            "v3identity": __read_v3ident(datadir),
             "bandwidth_capacity": BW_1GBIT_BYTES,
             "address": "100.0.0.{0}".format(i + 1),
-            "country_code": choice(DIRAUTH_COUNTRY_CODES),
+            "country_code": str(get_host_rng(args.seed, nickname, 'country').choice(DIRAUTH_COUNTRY_CODES)),
         }
 
+    # now that the authority keys exist too, remember the new key material for next time
+    if cache_hosts_prefix is not None:
+        new_nicknames = [nickname for nickname in nicknames if nickname not in copied]
+        logging.info("Storing new key material for {} Tor nodes in {}".format(len(new_nicknames), args.relay_cache_path))
+        for nickname in new_nicknames:
+            __store_tor_keys("{}/{}".format(hosts_prefix, nickname), "{}/{}".format(cache_hosts_prefix, nickname))
+
     if os.path.exists(keygen_torrc):
         os.remove(keygen_torrc)
     if os.path.exists(keygen_pw):
@@ -153,7 +305,75 @@ def generate_tor_keys(args, relays):
 
     return authorities, relays
 
-def generate_tor_config(args, authorities, relays, host_torrc_defaults):
+def save_relay_set(args, authorities, relays, sample_info):
+    # store everything that a later generate with '--reuse-from' needs to skip relay sampling
+    # and key generation; the PRNG state lets it draw the same clients and servers that a full
+    # generate with the same seed would draw. the relays are stored as lists because the order
+    # in which we iterate over them affects the generated configs.
+    relay_set = {
+        'relay_info_path': args.relay_info_path,
+        'seed': args.seed,
+        'network_scale': args.network_scale,
+        'sample_info': sample_info,
+        'authorities': list(authorities.items()),
+        'relays': {pos: list(relays[pos].items()) for pos in relays},
+    }
+    dump_json_data(relay_set, "{}/{}/{}".format(args.prefix, CONFIG_DIRNAME, RELAY_SET_FILENAME), compress=True)
+
+def load_relay_set(args, src_prefix):
+    relay_set_path = "{}/{}/{}".format(src_prefix, CONFIG_DIRNAME, RELAY_SET_FILENAME)
+    if not os.path.exists(relay_set_path) and not os.path.exists(relay_set_path + ".xz"):
+        logging.critical("Unable to find the relays of the network at {}; was it generated with this version of tornettools?".format(src_prefix))
+        return None
+
+    relay_set = load_json_data(relay_set_path)
+    if relay_set['network_scale'] != args.network_scale:
+        logging.critical("The network at {} has network scale {}, but we are generating a network with scale {}".format(
+            src_prefix, relay_set['network_scale'], args.network_scale))
+        return None
+    if relay_set['relay_info_path'] != args.relay_info_path:
+        logging.warning("The network at {} was sampled from {}, not from {}".format(
+            src_prefix, relay_set['relay_info_path'], args.relay_info_path))
+
+    authorities = dict(relay_set['authorities'])
+    relays = {pos: dict(relay_set['relays'][pos]) for pos in relay_set['relays']}
+    sample_info = relay_set['sample_info']
+
+    # these log messages are the same as those of a full generate, because parse reads them
+    logging.info("A full Tor network has {} relays with total capacity of {} Gbit/s".format(
+        sample_info['num_full_network_relays'], sample_info['full_network_capacity_gbit']))
+    logging.info("Chose {} of {} relays using scale factor {}".format(
+        sample_info['num_relays'], sample_info['num_full_network_relays'], args.network_scale))
+
+    if relay_set['seed'] == args.seed:
+        # continue from the point at which the full generate finished sampling relays
+        state = sample_info['prng_state']
+        set_state((state[0], array(state[1], dtype=uint32), state[2], state[3], state[4]))
+    else:
+        logging.info("The network at {} was generated with seed={}, so the clients and servers will differ from those of a full generate with seed={}".format(
+            src_prefix, relay_set['seed'], args.seed))
+        sample_info['prng_state'] = __get_prng_state()
+
+    # copy the host directories (key material, fingerprints, and torrcs) of the tor nodes
+    src_hosts_prefix = "{}/{}/{}".format(src_prefix, SHADOW_TEMPLATE_PATH, SHADOW_HOSTS_PATH)
+    hosts_prefix = "{}/{}/{}".format(args.prefix, SHADOW_TEMPLATE_PATH, SHADOW_HOSTS_PATH)
+    nicknames = [a['nickname'] for a in authorities.values()] + [r['nickname'] for pos in relays for r in relays[pos].values()]
+    with ParallelFileWriter() as writer:
+        for nickname in nicknames:
+            writer.submit(__copy_host_dir, "{}/{}".format(src_hosts_prefix, nickname), "{}/{}".format(hosts_prefix, nickname), num_files=None)
+
+    logging.info("Reused fingerprints and keys for {} Tor nodes ({} authorities and {} relays) from {}".format(
+        len(nicknames), len(authorities), sample_info['num_relays'], src_prefix))
+
+    return authorities, relays, sample_info
+
+def __copy_host_dir(src_path, dst_path):
+    # returns the number of files that we copied
+    copied = []
+    shutil.copytree(src_path, dst_path, dirs_exist_ok=True, copy_function=lambda src, dst: copied.append(shutil.copy2(src, dst)))
+    return len(copied)
+
+def generate_tor_config(args, authorities, relays, host_torrc_defaults, writer):
     # make sure the config directory exists
     abs_conf_path = "{}/{}".format(args.prefix, CONFIG_DIRNAME)
     if not os.path.exists(abs_conf_path):
@@ -163,9 +383,10 @@ def generate_tor_config(args, authorities, relays, host_torrc_defaults):
 
     __generate_resolv_file(args, abs_conf_path)
     __generate_tor_v3bw_file(args, authorities, relays)
-    __generate_torrc_common(abs_conf_path, authorities, args.geoip_path)
+    log_profile = LOG_PROFILES[args.log_profile]
+    __generate_torrc_common(abs_conf_path, authorities, args.geoip_path, log_profile)
     __generate_torrc_relay(abs_conf_path)
-    __generate_torrc_relay_authority(abs_conf_path, relays)
+    __generate_torrc_relay_authority(abs_conf_path, relays, log_profile)
     __generate_torrc_relay_exit(abs_conf_path)
     __generate_torrc_relay_exitguard(abs_conf_path)
     __generate_torrc_relay_guard(abs_conf_path)
@@ -175,12 +396,10 @@ def generate_tor_config(args, authorities, relays, host_torrc_defaults):
     __generate_torrc_client_perf(abs_conf_path)
     __generate_torrc_onionservice(abs_conf_path)
 
-    for hostname in host_torrc_defaults:
+    # host_torrc_defaults is an iterable of (hostname, torrc-defaults) pairs
+    for (hostname, torrc_defaults) in host_torrc_defaults:
         host_path = "{}/{}".format(hosts_prefix, hostname)
-        if not os.path.exists(host_path):
-            os.makedirs(host_path)
-
-        __generate_host_torrc(host_path, host_torrc_defaults[hostname])
+        writer.submit(__generate_host_torrc, host_path, torrc_defaults, num_files=2)
 
 def __generate_resolv_file(args, conf_path):
     with open("{}/{}".format(conf_path, RESOLV_FILENAME), "w") as resolvfile:
@@ -206,9 +425,14 @@ def __generate_tor_v3bw_file(args, authorities, relays):
             v3bwfile.write("node_id=${}\tbw={}\tnick={}\n".format(tornet_fp, cons_bw_weight, nickname))
 
         for pos in ['ge', 'e', 'g', 'm']:
-            # use reverse to sort each class from fastest to slowest when assigning the id counter
-            for (fp, relay) in sorted(relays[pos].items(), key=lambda kv: kv[1]['weight'], reverse=True):
-                cons_bw_weight = int(round(relay['weight'] / min_weight))
+            # sort each class from fastest to slowest when assigning the id counter; the stable sort
+            # keeps relays of equal weight in order, like sorted(..., reverse=True) did
+            fingerprints = list(relays[pos].keys())
+            weights = array([relays[pos][fp]['weight'] for fp in fingerprints], dtype=float)
+            order = argsort(-weights, kind='stable')
+            cons_bw_weights = npround(weights[order] / min_weight).astype(int).tolist()
+            for (i, cons_bw_weight) in zip(order.tolist(), cons_bw_weights):
+                relay = relays[pos][fingerprints[i]]
                 nickname = relay['nickname']
                 tornet_fp = relay['tornet_fingerprint']
                 v3bwfile.write("node_id=${}\tbw={}\tnick={}\n".format(tornet_fp, cons_bw_weight, nickname))
@@ -217,7 +441,7 @@ def __generate_tor_v3bw_file(args, authorities, relays):
     v3bw_path = "{}/v3bw".format(bwauth_dir)
     os.symlink("v3bw.init.consensus", v3bw_path)
 
-def __generate_torrc_common(conf_path, authorities, geoip_path):
+def __generate_torrc_common(conf_path, authorities, geoip_path, log_profile):
     auth_names = []
 
     torrc_file = open("{}/{}".format(conf_path, TORRC_COMMON_FILENAME), 'w')
@@ -245,10 +469,11 @@ def __generate_torrc_common(conf_path, authorities, geoip_path):
     torrc_file.write('ServerDNSDetectHijacking 0\n')
     torrc_file.write('AssumeReachable 1\n')
     torrc_file.write('NumCPUs 1\n')
-    torrc_file.write('Log notice stdout\n')
+    torrc_file.write('Log {} stdout\n'.format(log_profile['tor']))
     torrc_file.write('SafeLogging 0\n')
     torrc_file.write('LogTimeGranularity 1\n')
-    torrc_file.write('HeartbeatPeriod 1\n')
+    if log_profile['tor_heartbeat']:
+        torrc_file.write('HeartbeatPeriod 1\n')
     torrc_file.write('ContactInfo https://github.com/shadow/shadow-plugin-tor/issues\n')
     torrc_file.write('DisableDebuggerAttachment 0\n')
     torrc_file.write('CellStatistics 0\n')
@@ -283,7 +508,7 @@ def __generate_torrc_relay(conf_path):
 
     torrc_file.close()
 
-def __generate_torrc_relay_authority(conf_path, relays):
+def __generate_torrc_relay_authority(conf_path, relays, log_profile):
     tornet_fps_g = [relays['g'][fp]['tornet_fingerprint'] for fp in relays['g']]
     tornet_fps_e = [relays['e'][fp]['tornet_fingerprint'] for fp in relays['e']]
     tornet_fps_ge = [relays['ge'][fp]['tornet_fingerprint'] for fp in relays['ge']]
@@ -293,7 +518,7 @@ def __generate_torrc_relay_authority(conf_path, relays):
 
     torrc_file = open("{}/{}".format(conf_path, TORRC_RELAY_AUTHORITY_FILENAME), 'w')
 
-    torrc_file.write('Log info stdout\n')
+    torrc_file.write('Log {} stdout\n'.format(log_profile['tor_authority']))
     torrc_file.write('ExitPolicy "reject *:*"\n')
     torrc_file.write('\n')
     torrc_file.write('AuthoritativeDirectory 1\n')
@@ -363,6 +588,8 @@ def __generate_torrc_client_perf(conf_path):
     torrc_file.close()
 
 def __generate_host_torrc(host_path, torrc_defaults):
+    os.makedirs(host_path, exist_ok=True)
+
     with open(f"{host_path}/{TORRC_HOST_FILENAME}", "w") as outf:
         outf.write("# Enter any host-specific tor config options here.\n")
         outf.write(f"# Note that any option specified here may override a default from {TORRC_DEFAULTS_HOST_FILENAME}.\n")
@@ -392,15 +619,21 @@ def __generate_torrc_onionservice(conf_path):
     torrc_file.close()
 
 def get_relays(args):
-    data = load_json_data(args.relay_info_path)
+    data = load_json_data_cached(args.relay_info_path)
 
-    relays = data['relays']
+    # the cached relay data is shared with other generate runs in this process, so copy the
+    # relay dicts before we assign nicknames and renormalize weights
+    relays = {fp: dict(relay) for (fp, relay) in data['relays'].items()}
     stats = data['network_stats']
 
     # sample relays: take all relays that appeared in the input data, and select
     # a number that follows the median number of relays that are seen in a consensus.
     # this gives us the relays that would represent a full 100% Tor network
-    sampled_relays, sampled_weights = __sample_relays(relays, stats['med_count_total'])
+    if args.relay_cache_path is not None:
+        # reuse the full network sample (and the relay names) across networks of different scale
+        sampled_relays, sampled_weights = __get_cached_relay_sample(args, relays, stats['med_count_total'])
+    else:
+        sampled_relays, sampled_weights = __sample_relays(relays, stats['med_count_total'])
 
     # log some info
     n_relays = len(sampled_relays['all'])
@@ -423,102 +656,149 @@ def get_relays(args):
     relay_count = len(chosen_relays['g']) + len(chosen_relays['e']) + len(chosen_relays['ge']) + len(chosen_relays['m'])
     logging.info("Chose {} of {} relays using scale factor {}".format(relay_count, n_relays, args.network_scale))
 
-    # name the chosen relays
+    # relays from a cached sample were already named using their rank in the full network
+    if args.relay_cache_path is None:
+        __name_relays(chosen_relays)
+
+    sample_info = {
+        'num_relays': relay_count,
+        'num_full_network_relays': n_relays,
+        'full_network_capacity_gbit': gbit,
+        # the rest of the network is drawn from this PRNG state (see save_relay_set)
+        'prng_state': __get_prng_state(),
+    }
+
+    return chosen_relays, sample_info
+
+def __get_prng_state():
+    # the numpy PRNG state in a form that we can store as json
+    state = get_state()
+    return [state[0], state[1].tolist(), state[2], state[3], state[4]]
+
+def __name_relays(relays):
     relay_ctr = 1
     for pos in ['ge', 'e', 'g', 'm']:
         suffix = 'guard' if pos == 'g' else 'exit' if pos == 'e' else 'exitguard' if pos == 'ge' else 'middle'
         # use reverse to sort each class from fastest to slowest when assigning the id counter
-        for (fp, relay) in sorted(chosen_relays[pos].items(), key=lambda kv: kv[1]['weight'], reverse=True):
+        for (fp, relay) in sorted(relays[pos].items(), key=lambda kv: kv[1]['weight'], reverse=True):
             relay['nickname'] = "relay{}{}".format(relay_ctr, suffix)
             relay_ctr += 1
 
-    return chosen_relays, relay_count
+def __get_cached_relay_sample(args, relays, sample_size):
+    sample_path = "{}/{}".format(args.relay_cache_path, RELAY_CACHE_SAMPLE_FILENAME)
+
+    if not os.path.exists(sample_path):
+        logging.info("Sampling a full Tor network for the relay cache at {}".format(args.relay_cache_path))
+
+        # sample with a copy of the PRNG state, so that the rest of the network we generate is
+        # the same whether or not the sample was already cached
+        prng_state = get_state()
+        sampled_relays, _ = __sample_relays(relays, sample_size)
+        set_state(prng_state)
+
+        # name the relays by their rank in the full network, so that relays that appear in
+        # networks of different scale have the same name (and the same key material)
+        __name_relays(sampled_relays)
+
+        sample = {
+            'relay_info_path': args.relay_info_path,
+            'seed': args.seed,
+            'positions': {pos: {fp: relay['nickname'] for (fp, relay) in sampled_relays[pos].items()} for pos in ['g', 'e', 'ge', 'm']},
+        }
+
+        # other generate processes may be writing the same sample at the same time
+        tmp_path = "{}.tmp.{}".format(sample_path, os.getpid())
+        dump_json_data(sample, tmp_path, compress=False)
+        os.replace(tmp_path, sample_path)
+
+    sample = load_json_data(sample_path)
+    logging.info("Using the full Tor network sample from {} that was drawn with seed={}".format(sample_path, sample['seed']))
+
+    if sample['relay_info_path'] != args.relay_info_path:
+        logging.critical("The relay cache at {} was sampled from {}, not from {}".format(
+            args.relay_cache_path, sample['relay_info_path'], args.relay_info_path))
+        sys.exit(1)
+
+    sampled_relays = {'all': {}, 'g': {}, 'e': {}, 'ge': {}, 'm': {}}
+    for pos in ['g', 'e', 'ge', 'm']:
+        for (fp, nickname) in sample['positions'][pos].items():
+            relays[fp]['nickname'] = nickname
+            sampled_relays[pos][fp] = relays[fp]
+            sampled_relays['all'][fp] = relays[fp]
+
+    return sampled_relays, __get_position_weights(sampled_relays)
+
+def __get_relay_table(relays):
+    # an array-backed copy of the relay fields we use to sample and choose relays, in the
+    # same order as the relays dict
+    table = zeros(len(relays), dtype=RELAY_TABLE_DTYPE)
+    table['fingerprint'] = list(relays.keys())
+    for field in ['weight', 'running_frequency', 'guard_frequency', 'exit_frequency', 'bandwidth_capacity']:
+        table[field] = [float(relay[field]) for relay in relays.values()]
+    return table
 
 def __sample_relays(relays, sample_size):
-    # we need to make sure the relay ordering matches, so create a list of prints
-    all_fingerprints = list(relays.keys())
+    # the table keeps the relay ordering of the input data, which keeps the sample deterministic
+    table = __get_relay_table(relays)
     # pick relays weighted by their run frequency (uptime)
     # if it was not running long enough or has no bandwidth, it won't get selected
-    run_freqs = []
-    for fp in all_fingerprints:
-        freq = float(relays[fp]['running_frequency'])
-        weight = float(relays[fp]['weight'])
-        bandwidth_capacity = float(relays[fp]['bandwidth_capacity'])
-        if freq < RUN_FREQ_THRESH or weight == 0.0 or bandwidth_capacity == 0.0:
-            freq = 0.0
-        run_freqs.append(freq)
-    # normalize
-    run_freqs_normed = [freq / sum(run_freqs) for freq in run_freqs]
-    sampled_fingerprints = list(choice(all_fingerprints, p=run_freqs_normed, replace=False, size=sample_size))
-
-    min_weight_sampled = min([relays[fp]['weight'] for fp in sampled_fingerprints])
-    # track the results
-    sampled_relays = {'all': {}, 'g': {}, 'e': {}, 'ge': {}, 'm': {}}
-    sampled_weights = {'all': 0, 'g': 0, 'e': 0, 'ge': 0, 'm': 0}
-    for fp in sampled_fingerprints:
-        relay, weight = relays[fp], relays[fp]['weight']
-
-        # track list of all relays
-        sampled_relays['all'][fp] = relay
-        sampled_weights['all'] += weight
-        # Makes the flag assignment probabilistic w.r.t. relays' observed flag
-        # frequency. Relays receiving the guard flag must at least have
-        # TOR_GUARD_MIN_CONSBW
-        has_guard_f = True if relays[fp]['weight'] > 0 and \
-            int(round(relays[fp]['weight'] / min_weight_sampled)) >= TOR_GUARD_MIN_CONSBW\
-            and uniform() <= relays[fp]['guard_frequency'] else False
-        has_exit_f = True if uniform() <= relays[fp]['exit_frequency'] else False
-
-        # track relays by position too
-        if has_guard_f and has_exit_f:
-            sampled_relays['ge'][fp] = relay
-            sampled_weights['ge'] += weight
-        elif has_exit_f:
-            sampled_relays['e'][fp] = relay
-            sampled_weights['e'] += weight
-        elif has_guard_f:
-            sampled_relays['g'][fp] = relay
-            sampled_weights['g'] += weight
-        else:
-            sampled_relays['m'][fp] = relay
-            sampled_weights['m'] += weight
-    # normalize the weights
-    sampled_weights['g'] /= sampled_weights['all']
-    sampled_weights['e'] /= sampled_weights['all']
-    sampled_weights['ge'] /= sampled_weights['all']
-    sampled_weights['m'] /= sampled_weights['all']
+    not_selectable = (table['running_frequency'] < RUN_FREQ_THRESH) | (table['weight'] == 0.0) | (table['bandwidth_capacity'] == 0.0)
+    run_freqs = where(not_selectable, 0.0, table['running_frequency'])
+    # normalize; python's sum adds the frequencies in order, so the probabilities (and the
+    # sample) are identical to those of earlier versions
+    run_freqs_normed = run_freqs / sum(run_freqs.tolist())
+    sample = table[choice(len(table), p=run_freqs_normed, replace=False, size=sample_size)]
+
+    min_weight_sampled = sample['weight'].min()
+    # Makes the flag assignment probabilistic w.r.t. relays' observed flag
+    # frequency. Relays receiving the guard flag must at least have
+    # TOR_GUARD_MIN_CONSBW
+    guard_eligible = (sample['weight'] > 0) & (npround(sample['weight'] / min_weight_sampled) >= TOR_GUARD_MIN_CONSBW)
+    # draw the random values in the order we always have: a guard value for each eligible
+    # relay, followed by an exit value for every relay
+    draw_ends = cumsum(guard_eligible.astype(int) + 1)
+    draws = uniform(size=draw_ends[-1])
+    has_guard_f = guard_eligible & (draws[draw_ends - 2] <= sample['guard_frequency'])
+    has_exit_f = draws[draw_ends - 1] <= sample['exit_frequency']
+    sample['position'] = select([has_guard_f & has_exit_f, has_exit_f, has_guard_f], ['ge', 'e', 'g'], default='m')
+
+    # track the results; we sum the weights in sample order to get the same totals as before
+    sampled_relays = {'all': {fp: relays[fp] for fp in sample['fingerprint'].tolist()}}
+    sampled_weights = {'all': sum(sample['weight'].tolist())}
+    for pos in ['g', 'e', 'ge', 'm']:
+        pos_sample = sample[sample['position'] == pos]
+        sampled_relays[pos] = {fp: relays[fp] for fp in pos_sample['fingerprint'].tolist()}
+        # normalize the weights
+        sampled_weights[pos] = sum(pos_sample['weight'].tolist()) / sampled_weights['all']
     sampled_weights['all'] /= sampled_weights['all']
 
     return sampled_relays, sampled_weights
 
+def __get_position_weights(sampled_relays):
+    # the fraction of the total sampled weight in each position
+    sampled_weights = {pos: sum([relay['weight'] for relay in sampled_relays[pos].values()]) for pos in ['g', 'e', 'ge', 'm']}
+    total_weight = sum(sampled_weights.values())
+    sampled_weights = {pos: weight / total_weight for (pos, weight) in sampled_weights.items()}
+    sampled_weights['all'] = 1.0
+    return sampled_weights
+
 def __choose_relays(n_relays, sampled_relays, sampled_weights, pos_ratios):
-    # sort the relays by bandwidth weight
-    # returns (key, value) relay items, i.e., (fingerprint, relay_data_dict)
-    g_items_sorted = sorted(sampled_relays['g'].items(), key=lambda kv: kv[1]['weight'])
-    e_items_sorted = sorted(sampled_relays['e'].items(), key=lambda kv: kv[1]['weight'])
-    ge_items_sorted = sorted(sampled_relays['ge'].items(), key=lambda kv: kv[1]['weight'])
-    m_items_sorted = sorted(sampled_relays['m'].items(), key=lambda kv: kv[1]['weight'])
-
-    # split into k bins, and we need at least 1 bin (i.e., 1 relay of each type)
-    g_bins = array_split(g_items_sorted, max(1, round(n_relays * pos_ratios['g'])))
-    e_bins = array_split(e_items_sorted, max(1, round(n_relays * pos_ratios['e'])))
-    ge_bins = array_split(ge_items_sorted, max(1, round(n_relays * pos_ratios['ge'])))
-    m_bins = array_split(m_items_sorted, max(1, round(n_relays * pos_ratios['m'])))
-
-    # get the index of the median relay in each bin
-    g_bin_indices = [len(bin) // 2 for bin in g_bins]
-    e_bin_indices = [len(bin) // 2 for bin in e_bins]
-    ge_bin_indices = [len(bin) // 2 for bin in ge_bins]
-    m_bin_indices = [len(bin) // 2 for bin in m_bins]
+    # we need at least 1 bin (i.e., 1 relay of each type)
+    num_bins = {pos: max(1, round(n_relays * pos_ratios[pos])) for pos in ['g', 'e', 'ge', 'm']}
+    for (pos, k) in num_bins.items():
+        if len(sampled_relays[pos]) < k:
+            logging.warning("Only {} '{}' relays were sampled for {} bins, so the network will have fewer relays "
+                            "than requested".format(len(sampled_relays[pos]), pos, k))
+
+    # choose the median relay of each weight bin
+    g_fingerprints = __choose_bin_medians(sampled_relays['g'], num_bins['g'])
+    e_fingerprints = __choose_bin_medians(sampled_relays['e'], num_bins['e'])
+    ge_fingerprints = __choose_bin_medians(sampled_relays['ge'], num_bins['ge'])
+    m_fingerprints = __choose_bin_medians(sampled_relays['m'], num_bins['m'])
 
     __log_bwweights_sampled_network(sampled_relays, sampled_weights)
 
     while True:
-        # get the fingerprint of the median relay in each bin
-        g_fingerprints = [g_bins[i][g_bin_indices[i]][0] for i in range(len(g_bins))]
-        e_fingerprints = [e_bins[i][e_bin_indices[i]][0] for i in range(len(e_bins))]
-        ge_fingerprints = [ge_bins[i][ge_bin_indices[i]][0] for i in range(len(ge_bins))]
-        m_fingerprints = [m_bins[i][m_bin_indices[i]][0] for i in range(len(m_bins))]
         # add up the weights
         g_weight = sum([sampled_relays['g'][fp]['weight'] for fp in g_fingerprints])
         e_weight = sum([sampled_relays['e'][fp]['weight'] for fp in e_fingerprints])
@@ -582,6 +862,21 @@ def __choose_relays(n_relays, sampled_relays, sampled_weights, pos_ratios):
 
     return chosen_relays, max_divergence
 
+def __choose_bin_medians(relays, k):
+    # sort the relays by bandwidth weight (a stable sort, like sorted()), split them into k bins
+    # of the sizes that numpy's array_split would use, and return the median relay of each bin
+    table = __get_relay_table(relays)
+    order = argsort(table['weight'], kind='stable')
+
+    bin_size, n_larger_bins = divmod(len(order), k)
+    bin_sizes = full(k, bin_size)
+    bin_sizes[:n_larger_bins] += 1
+    bin_starts = cumsum(bin_sizes) - bin_sizes
+
+    # we have empty bins if there are fewer than k relays, and they have no median
+    bin_medians = (bin_starts + bin_sizes // 2)[bin_sizes > 0]
+    return table['fingerprint'][order[bin_medians]].tolist()
+
 # currently unused, but kept around for posterity
 def __choose_relays_old(n_relays, sampled_relays, sampled_weights, pos_ratios):
     # choose relays using the median bucketing approach
@@ -617,9 +912,7 @@ def __choose_relays_old(n_relays, sampled_relays, sampled_weights, pos_ratios):
 def __get_min(relays):
     min_weight = 1.0
     for pos in ['ge', 'e', 'g', 'm']:
-        sorted_relay_items = sorted(relays[pos].items(), key=lambda kv: kv[1]['weight'])
-        (fp, relay) = sorted_relay_items[0]
-        min_weight = min(min_weight, relay['weight'])
+        min_weight = min([min_weight] + [relay['weight'] for relay in relays[pos].values()])
     return min_weight
 
 # currently unused, but kept around for posterity
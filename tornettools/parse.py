@@ -2,25 +2,30 @@ import logging
 import os
 import re
 
-from tornettools.parse_oniontrace import parse_oniontrace_logs, extract_oniontrace_plot_data
-from tornettools.parse_tgen import parse_tgen_logs, extract_tgen_plot_data
+from tornettools.converge import CONVERGENCE_FILENAME
+from tornettools.parse_oniontrace import get_oniontrace_parse_command, extract_oniontrace_plot_data
+from tornettools.parse_tgen import get_tgen_parse_command, extract_tgen_plot_data
 from tornettools.parse_rusage import parse_resource_usage_logs, extract_resource_usage_plot_data
-from tornettools.util import open_readable_file, dump_json_data
+from tornettools.util import open_readable_file, load_json_data, dump_json_data, run_commands
 
 def run(args):
     logging.info("Parsing simulation output from {}".format(args.prefix))
 
-    logging.info("Parsing tgen logs.")
-    if args.skip_raw or parse_tgen_logs(args):
+    # the generate log tells us how the network was configured
+    sim_info = parse_tornettools_generate_log(args.prefix)
+    traced_fraction = 1.0 if sim_info is None else sim_info.get('oniontrace_relay_capacity_fraction', 1.0)
+
+    parsed = {'tgen': True, 'oniontrace': True} if args.skip_raw else __parse_raw_logs(args)
+
+    if parsed['tgen']:
         logging.info("Extracting tgen plot data.")
         extract_tgen_plot_data(args)
     else:
         logging.warning("Parsing tgen logs failed, so we cannot extract tgen plot data.")
 
-    logging.info("Parsing oniontrace logs.")
-    if args.skip_raw or parse_oniontrace_logs(args):
+    if parsed['oniontrace']:
         logging.info("Extracting oniontrace plot data.")
-        extract_oniontrace_plot_data(args)
+        extract_oniontrace_plot_data(args, traced_relay_capacity_fraction=traced_fraction)
     else:
         logging.warning("Parsing oniontrace logs failed, so we cannot extract oniontrace plot data.")
 
@@ -31,18 +36,49 @@ def run(args):
     else:
         logging.warning("Parsing resource usage logs failed, so we cannot extract resource usage plot data.")
 
-    __parse_tornettools_log(args)
+    __write_simulation_info(args, sim_info)
 
     logging.info("Done parsing!")
 
-def __parse_tornettools_log(args):
-    gen_logs = [f for f in os.listdir(args.prefix) if f.startswith('tornettools.generate.')]
-    if len(gen_logs) == 0:
+def __parse_raw_logs(args):
+    commands = {
+        'tgen': get_tgen_parse_command(args),
+        'oniontrace': get_oniontrace_parse_command(args),
+    }
+    names = [name for name in commands if commands[name] is not None]
+
+    # tgentools and oniontracetools read different log files, so we run them at the same time
+    if len(names) > 0:
+        logging.info("Parsing {} logs.".format(" and ".join(names)))
+    results = run_commands([commands[name] for name in names], max_parallel=len(names))
+
+    parsed = {name: False for name in commands}
+    for name, result in zip(names, results):
+        logging.info(f"{name}tools returned code {result.returncode}")
+        parsed[name] = result.returncode == 0
+    return parsed
+
+def __write_simulation_info(args, info):
+    # simulate records when it stopped shadow early because the metrics converged
+    convergence_path = f"{args.prefix}/{CONVERGENCE_FILENAME}"
+    if os.path.exists(convergence_path):
+        info = {} if info is None else info
+        info['convergence'] = load_json_data(convergence_path)
+
+    if info is None:
         logging.warning("Unable to find simulation info in tornettools.generate.log file")
         return
 
+    outpath = f"{args.prefix}/tornet.plot.data/simulation_info.json"
+    dump_json_data(info, outpath, compress=False)
+
+def parse_tornettools_generate_log(prefix):
+    gen_logs = sorted([f for f in os.listdir(prefix) if f.startswith('tornettools.generate.')])
+    if len(gen_logs) == 0:
+        return None
+
     info = {}
-    gen_log_path = f"{args.prefix}/{gen_logs[-1]}"
+    gen_log_path = f"{prefix}/{gen_logs[-1]}"
     with open_readable_file(gen_log_path) as inf:
         for line in inf:
 
@@ -50,13 +86,28 @@ def __parse_tornettools_log(args):
             if match:
                 info['tornettools_generate_seed'] = int(match.groups()[0])
                 continue
+            if 'The argument namespace is:' in line:
+                for key in ['process_scale', 'load_scale']:
+                    match = re.search(rf'\b{key}=([^,)]+)', line)
+                    if match:
+                        info[key] = float(match.groups()[0])
+                continue
+            match = re.search(r'We will run oniontrace on (\d+) of (\d+) relays with (\S+) of the relay capacity', line)
+            if match:
+                info['num_oniontrace_relays'] = int(match.groups()[0])
+                info['oniontrace_relay_capacity_fraction'] = float(match.groups()[2])
+                continue
+            match = re.search(r'A full Tor network has (\d+) relays with total capacity of (\S+) Gbit/s', line)
+            if match:
+                info['full_network_relay_capacity_gbit'] = float(match.groups()[1])
+                continue
             match = re.search(r'Chose (\d+) of (\d+) relays using scale factor (\S+)', line)
             if match:
                 info['num_sampled_relays'] = int(match.groups()[0])
                 info['num_public_relays'] = int(match.groups()[1])
                 info['net_scale'] = float(match.groups()[2])
                 continue
-            match = re.search(r'Generated fingerprints and keys for (\d+) Tor nodes \((\d+) authorities and (\d+) relays', line)
+            match = re.search(r'(?:Generated|Reused) fingerprints and keys for (\d+) Tor nodes \((\d+) authorities and (\d+) relays', line)
             if match:
                 info['num_dir_authorities'] = int(match.groups()[1])
                 continue
@@ -86,5 +137,4 @@ def __parse_tornettools_log(args):
                 info['num_tgen_onionservice_servers'] = int(match.groups()[1])
                 continue
 
-    outpath = f"{args.prefix}/tornet.plot.data/simulation_info.json"
-    dump_json_data(info, outpath, compress=False)
+    return info
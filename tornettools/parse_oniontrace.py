@@ -2,17 +2,17 @@ import os
 import logging
 import datetime
 import re
-import subprocess
 
-from tornettools.util import which, open_writeable_file, load_json_data, dump_json_data
+from tornettools.util import which, load_json_data, dump_json_data
 
-def parse_oniontrace_logs(args):
+def get_oniontrace_parse_command(args):
+    # returns the command that parses the oniontrace logs into oniontrace.analysis.json, or None
     otracetools_exe = which('oniontracetools')
 
     if otracetools_exe is None:
         logging.warning("Cannot find oniontracetools in your PATH. Is your python venv active? Do you have oniontracetools installed?")
         logging.warning("Unable to parse oniontrace simulation data.")
-        return
+        return None
 
     # oniontracetools supports a list of expressions that are used to search for oniontrace log filenames
     # the first -e expression matches the log file names for Shadow v3.x.x
@@ -28,14 +28,9 @@ def parse_oniontrace_logs(args):
 
     datestr = datetime.datetime.now().strftime("%Y-%m-%d.%H:%M:%S")
 
-    with open_writeable_file(f"{args.prefix}/oniontracetools.parse.{datestr}.log") as outf:
-        logging.info("Parsing oniontrace log data with oniontracetools now...")
-        comproc = subprocess.run(cmd, cwd=args.prefix, stdout=outf, stderr=subprocess.STDOUT)
-        logging.info(f"oniontracetools returned code {comproc.returncode}")
-
-    return comproc.returncode == 0
+    return {'args': cmd, 'cwd': args.prefix, 'stdout_path': f"{args.prefix}/oniontracetools.parse.{datestr}.log"}
 
-def extract_oniontrace_plot_data(args):
+def extract_oniontrace_plot_data(args, traced_relay_capacity_fraction=1.0):
     json_path = f"{args.prefix}/oniontrace.analysis.json"
 
     if not os.path.exists(json_path):
@@ -53,15 +48,18 @@ def extract_oniontrace_plot_data(args):
     for circuittype in ('exit', 'onionservice'):
         __extract_circuit_build_times(args, circuittype, data, startts, stopts)
 
-    __extract_relay_tput(args, data, startts, stopts)
+    __extract_relay_tput(args, data, startts, stopts, traced_relay_capacity_fraction)
 
 def __extract_circuit_build_times(args, circuittype, data, startts, stopts):
     cbt = __get_perfclient_cbt(data, circuittype, startts, stopts)
     outpath = f"{args.prefix}/tornet.plot.data/perfclient_circuit_build_time.{circuittype}.json"
     dump_json_data(cbt, outpath, compress=False)
 
-def __extract_relay_tput(args, data, startts, stopts):
-    tput = __get_relay_tput(data, startts, stopts)
+def __extract_relay_tput(args, data, startts, stopts, traced_relay_capacity_fraction):
+    if traced_relay_capacity_fraction < 1.0:
+        logging.info(f"Scaling relay goodput to the full network, since oniontrace only ran on "
+                     f"relays with {traced_relay_capacity_fraction} of the relay capacity")
+    tput = __get_relay_tput(data, startts, stopts, traced_relay_capacity_fraction)
     outpath = f"{args.prefix}/tornet.plot.data/relay_goodput.json"
     dump_json_data(tput, outpath, compress=False)
 
@@ -96,7 +94,7 @@ def __get_perfclient_cbt(data, circuittype, startts, stopts):
 
     return perf_cbt
 
-def __get_relay_tput(data, startts, stopts):
+def __get_relay_tput(data, startts, stopts, traced_relay_capacity_fraction=1.0):
     net_tput_sec = {}
 
     # resolution in 1 byte.
@@ -108,6 +106,9 @@ def __get_relay_tput(data, startts, stopts):
             if 'relay' not in name and '4uthority' not in name:
                 continue
 
+            # the authorities are always traced, but the relays may be a sample
+            scale = 1.0 if '4uthority' in name else 1.0 / traced_relay_capacity_fraction
+
             bw = data['data'][name]['oniontrace']['bandwidth']
             key = 'bytes_written'
             if bw is None or key not in bw:
@@ -118,7 +119,7 @@ def __get_relay_tput(data, startts, stopts):
             for secstr in tput:
                 sec = int(secstr) - 946684800
                 if sec >= startts and (stopts < 0 or sec < stopts):
-                    bytes = int(tput[secstr])
+                    bytes = int(round(int(tput[secstr]) * scale))
                     net_tput_sec.setdefault(sec, 0)
                     net_tput_sec[sec] += bytes
 
@@ -5,14 +5,77 @@ import re
 
 from numpy import mean
 
-from tornettools.util import open_readable_file, load_json_data, dump_json_data
+from tornettools.util import find_readable_file, open_readable_file, load_json_data, dump_json_data
+
+# shadow's C code didn't capitalize "process", shadow's rust code does
+SHADOW_HEARTBEAT_RE = re.compile("[Pp]rocess resource usage at simtime")
+# a cheap test for the raw lines that may match SHADOW_HEARTBEAT_RE
+SHADOW_HEARTBEAT_MARKER = b"rocess resource usage at simtime"
 
 def parse_resource_usage_logs(args):
-    logging.info("Parsing resource usage from free log")
-    if __parse_free_rusage(args):
-        logging.info("Parsing resource usage from shadow log")
-        return __parse_shadow_rusage(args)
+    # simulations that were run before we sampled /proc ourselves logged the output of 'free'
+    if os.path.exists(f"{args.prefix}/rusage.csv") or os.path.exists(f"{args.prefix}/rusage.csv.xz"):
+        logging.info("Parsing resource usage from rusage samples")
+        parsed = __parse_sampled_rusage(args)
     else:
+        logging.info("Parsing resource usage from free log")
+        parsed = __parse_free_rusage(args)
+
+    if not parsed:
+        return False
+
+    # simulations that were run before we sampled the shadow process tree don't have its samples
+    if os.path.exists(f"{args.prefix}/rusage_shadow_tree.csv") or os.path.exists(f"{args.prefix}/rusage_shadow_tree.csv.xz"):
+        logging.info("Parsing resource usage of the shadow process tree")
+        __parse_shadow_tree_rusage(args)
+
+    logging.info("Parsing resource usage from shadow log")
+    return __parse_shadow_rusage(args)
+
+def __parse_shadow_tree_rusage(args):
+    tree_filepath = f"{args.prefix}/rusage_shadow_tree.csv"
+    if not os.path.exists(tree_filepath):
+        tree_filepath += ".xz"
+
+    rusage = {}
+    with open_readable_file(tree_filepath) as inf:
+        header = inf.readline().strip().split(',')
+        for line in inf:
+            parts = line.strip().split(',')
+            # the last record may be incomplete if the simulation was killed
+            if len(parts) != len(header):
+                continue
+            rusage.setdefault(float(parts[0]), {header[i]: float(parts[i]) for i in range(1, len(header))})
+
+    if len(rusage) > 0:
+        outpath = f"{args.prefix}/shadow_tree_rusage.json.xz"
+        dump_json_data(rusage, outpath, compress=True)
+    else:
+        logging.warning(f"Unable to parse resource usage data from {tree_filepath}.")
+
+def __parse_sampled_rusage(args):
+    rusage_filepath = f"{args.prefix}/rusage.csv"
+    if not os.path.exists(rusage_filepath):
+        rusage_filepath += ".xz"
+
+    # we keep the memory columns, which have the same names as the values we parse from free logs
+    rusage = {}
+    with open_readable_file(rusage_filepath) as inf:
+        header = inf.readline().strip().split(',')
+        mem_columns = [(i, name) for i, name in enumerate(header) if name.startswith('mem_')]
+        for line in inf:
+            parts = line.strip().split(',')
+            # the last record may be incomplete if the simulation was killed
+            if len(parts) != len(header):
+                continue
+            rusage.setdefault(float(parts[0]), {name: int(parts[i]) for i, name in mem_columns})
+
+    if len(rusage) > 0:
+        outpath = f"{args.prefix}/free_rusage.json.xz"
+        dump_json_data(rusage, outpath, compress=True)
+        return True
+    else:
+        logging.warning(f"Unable to parse memory usage data from {rusage_filepath}.")
         return False
 
 def __parse_free_rusage(args):
@@ -55,36 +118,45 @@ def __parse_free_rusage(args):
         logging.warning(f"Unable to parse memory usage data from {free_filepath}.")
         return False
 
+def parse_shadow_heartbeat(line):
+    # returns (sim_secs, rund) if the line is a shadow resource usage heartbeat, where rund holds
+    # the key=value pairs of the line and the real time at which shadow logged it; else None
+    if SHADOW_HEARTBEAT_RE.search(line) is None:
+        return None
+
+    parts = line.strip().split()
+    if len(parts) < 13:
+        return None
+
+    sim_time = float(parts[12]) # nanos e.g. 2000000000
+    std = datetime.timedelta(microseconds=sim_time / 1000.0)
+    sim_secs = std.total_seconds()
+
+    real_time = parts[0] # time e.g. 00:00:15.436056
+    rt_parts = real_time.split(':')
+    rtd = datetime.timedelta(hours=int(rt_parts[0]), minutes=int(rt_parts[1]), seconds=float(rt_parts[2]))
+
+    rund = {keyval.split('=')[0]: keyval.split('=')[1] for keyval in parts if '=' in keyval}
+    rund['real_time'] = rtd.total_seconds()
+
+    return sim_secs, rund
+
 def __parse_shadow_rusage(args):
-    shadow_filepath = f"{args.prefix}/shadow.log"
-    if not os.path.exists(shadow_filepath):
-        shadow_filepath += ".xz"
+    # simulate writes the heartbeat lines to a small file next to the log, so that we don't
+    # need to scan the full log; simulations run with older tornettools only have the log
+    shadow_filepath = find_readable_file(f"{args.prefix}/shadow_heartbeat.log") or \
+        find_readable_file(f"{args.prefix}/shadow.log")
 
-    if not os.path.exists(shadow_filepath):
-        logging.warning(f"Unable to find cpu usage data at {shadow_filepath}")
+    if shadow_filepath is None:
+        logging.warning(f"Unable to find cpu usage data at {args.prefix}/shadow.log")
         return False
 
     rusage = {}
-    # shadow's C code didn't capitalize "process", shadow's rust code does
-    heartbeat = re.compile("[Pp]rocess resource usage at simtime")
     with open_readable_file(shadow_filepath) as inf:
         for line in inf:
-            if heartbeat.search(line) is not None:
-                parts = line.strip().split()
-                if len(parts) >= 13:
-                    sim_time = float(parts[12]) # nanos e.g. 2000000000
-                    std = datetime.timedelta(microseconds=sim_time / 1000.0)
-                    sim_secs = std.total_seconds()
-
-                    if sim_secs not in rusage:
-                        real_time = parts[0] # time e.g. 00:00:15.436056
-                        rt_parts = real_time.split(':')
-                        rtd = datetime.timedelta(hours=int(rt_parts[0]), minutes=int(rt_parts[1]), seconds=float(rt_parts[2]))
-
-                        rund = {keyval.split('=')[0]: keyval.split('=')[1] for keyval in parts if '=' in keyval}
-                        rund['real_time'] = rtd.total_seconds()
-
-                        rusage[sim_secs] = rund
+            heartbeat = parse_shadow_heartbeat(line)
+            if heartbeat is not None and heartbeat[0] not in rusage:
+                rusage[heartbeat[0]] = heartbeat[1]
 
     if len(rusage) > 0:
         outpath = f"{args.prefix}/shadow_rusage.json.xz"
@@ -116,13 +188,54 @@ def extract_resource_usage_plot_data(args):
     free_data = load_json_data(free_json_path)
     shadow_data = load_json_data(shadow_json_path)
 
-    __extract_resource_usage(args, free_data, shadow_data)
+    tree_json_path = f"{args.prefix}/shadow_tree_rusage.json"
 
-def __extract_resource_usage(args, free_data, shadow_data):
+    if not os.path.exists(tree_json_path):
+        tree_json_path += ".xz"
+
+    tree_data = load_json_data(tree_json_path) if os.path.exists(tree_json_path) else None
+
+    __extract_resource_usage(args, free_data, shadow_data, tree_data)
+
+def __extract_resource_usage(args, free_data, shadow_data, tree_data):
     rusage = {"ram": __get_ram_usage(free_data), "run_time": __get_run_time(shadow_data)}
+    if tree_data is not None and len(tree_data) > 1:
+        rusage["shadow_tree"] = __get_shadow_tree_usage(tree_data)
     outpath = f"{args.prefix}/tornet.plot.data/resource_usage.json"
     dump_json_data(rusage, outpath, compress=False)
 
+def __get_shadow_tree_usage(data):
+    # the resources used by shadow and the processes it ran, apart from the rest of the machine
+    samples = sorted([(float(ts), data[ts]) for ts in data])
+    ts_start, first = samples[0]
+    last = samples[-1][1]
+
+    # the cpu efficiency is the fraction of the cpu time that shadow could have used on the
+    # cpus that it was allowed to run on, which is what we tune the parallelism for
+    cpu_seconds = {k: last[k] - first[k] for k in ['cpu_user', 'cpu_system']}
+    cpu_capacity = sum([(t2 - t1) * s1['cpus_allowed'] for (t1, s1), (t2, _) in zip(samples, samples[1:])])
+    cpu_efficiency = (cpu_seconds['cpu_user'] + cpu_seconds['cpu_system']) / cpu_capacity if cpu_capacity > 0 else 0.0
+
+    cores_minute_bins, pss_minute_bins = {}, {}
+    for (t1, s1), (t2, s2) in zip(samples, samples[1:]):
+        minute = int((t2 - ts_start) / 60)
+        cores = (s2['cpu_user'] + s2['cpu_system'] - s1['cpu_user'] - s1['cpu_system']) / (t2 - t1)
+        cores_minute_bins.setdefault(minute, []).append(cores)
+        pss_minute_bins.setdefault(minute, []).append(s2['pss'] / (1024.0**3))
+
+    return {"cpu_user_seconds": cpu_seconds['cpu_user'],
+            "cpu_system_seconds": cpu_seconds['cpu_system'],
+            "cpu_efficiency": cpu_efficiency,
+            "cpu_cores_used_per_minute": {minute: mean(cores_minute_bins[minute]) for minute in cores_minute_bins},
+            "rss_bytes_max": max([s['rss'] for _, s in samples]),
+            "pss_bytes_max": max([s['pss'] for _, s in samples]),
+            "gib_pss_per_minute": {minute: mean(pss_minute_bins[minute]) for minute in pss_minute_bins},
+            "max_processes": max([s['num_processes'] for _, s in samples]),
+            "io_read_bytes": last['io_read_bytes'] - first['io_read_bytes'],
+            "io_write_bytes": last['io_write_bytes'] - first['io_write_bytes'],
+            "io_rchar": last['io_rchar'] - first['io_rchar'],
+            "io_wchar": last['io_wchar'] - first['io_wchar']}
+
 def __get_ram_usage(data):
     # get the ram used by the os during the simulation.
     # the best estimate is total-avail, but free may not always provide avail.
@@ -1,18 +1,18 @@
 import os
 import logging
 import datetime
-import subprocess
 import re
 
-from tornettools.util import which, open_writeable_file, load_json_data, dump_json_data, aka_int, tgen_stream_seconds_at_bytes
+from tornettools.util import which, load_json_data, dump_json_data, aka_int, tgen_stream_seconds_at_bytes
 
-def parse_tgen_logs(args):
+def get_tgen_parse_command(args):
+    # returns the command that parses the tgen logs into tgen.analysis.json, or None
     tgentools_exe = which('tgentools')
 
     if tgentools_exe is None:
         logging.warning("Cannot find tgentools in your PATH. Is your python venv active? Do you have tgentools installed?")
         logging.warning("Unable to parse tgen simulation data.")
-        return
+        return None
 
     # tgentools supports a list of expressions that are used to search for oniontrace log filenames
     # the first -e expression matches the log file names for Shadow v3.x.x
@@ -29,12 +29,7 @@ def parse_tgen_logs(args):
 
     datestr = datetime.datetime.now().strftime("%Y-%m-%d.%H:%M:%S")
 
-    with open_writeable_file(f"{args.prefix}/tgentools.parse.{datestr}.log") as outf:
-        logging.info("Parsing tgen log data with tgentools now...")
-        comproc = subprocess.run(cmd, cwd=args.prefix, stdout=outf, stderr=subprocess.STDOUT)
-        logging.info(f"tgentools returned code {comproc.returncode}")
-
-    return comproc.returncode == 0
+    return {'args': cmd, 'cwd': args.prefix, 'stdout_path': f"{args.prefix}/tgentools.parse.{datestr}.log"}
 
 def extract_tgen_plot_data(args):
     json_path = f"{args.prefix}/tgen.analysis.json"
@@ -50,6 +50,9 @@ def __plot_tornet(args):
     __plot_memory_usage_real_time(args, tornet_dbs)
     __plot_memory_usage_sim_time(args, tornet_dbs)
     __plot_run_time(args, tornet_dbs)
+    __plot_shadow_cpu_usage_real_time(args, tornet_dbs)
+    __plot_shadow_memory_usage_real_time(args, tornet_dbs)
+    __log_shadow_resource_usage(tornet_dbs)
 
     logging.info("Loading Tor metrics data")
     torperf_dbs = __load_torperf_datasets(args.tor_metrics_path)
@@ -183,6 +186,57 @@ def __plot_run_time(args, tornet_dbs):
                              xlabel="Simulation Time",
                              ylabel="Real Time")
 
+def __get_shadow_tree_per_real_time(tornet_db, key):
+    xy = {}
+    for d in tornet_db['dataset']:
+        if 'shadow_tree' not in d or key not in d['shadow_tree']:
+            continue
+        if 'run_time' not in d or 'seconds' not in d['run_time']:
+            continue
+        valued = d['shadow_tree'][key]
+        for real_minute in valued:
+            s = int(real_minute) * 60.0 # to seconds
+            # don't include usage after the sim end time
+            if s > d['run_time']['seconds']:
+                continue
+            xy.setdefault(s, []).append(valued[real_minute])
+    return xy
+
+def __plot_shadow_cpu_usage_real_time(args, tornet_dbs):
+    for tornet_db in tornet_dbs:
+        tornet_db['data'] = __get_shadow_tree_per_real_time(tornet_db, 'cpu_cores_used_per_minute')
+
+    dbs_to_plot = tornet_dbs
+
+    __plot_timeseries_figure(args, dbs_to_plot, "shadow_cpu_realtime",
+                             xtime=True,
+                             xlabel="Real Time",
+                             ylabel="Shadow CPU Cores Used")
+
+def __plot_shadow_memory_usage_real_time(args, tornet_dbs):
+    for tornet_db in tornet_dbs:
+        tornet_db['data'] = __get_shadow_tree_per_real_time(tornet_db, 'gib_pss_per_minute')
+
+    dbs_to_plot = tornet_dbs
+
+    __plot_timeseries_figure(args, dbs_to_plot, "shadow_pss_realtime",
+                             xtime=True,
+                             xlabel="Real Time",
+                             ylabel="Shadow RAM Used (PSS GiB)")
+
+def __log_shadow_resource_usage(tornet_dbs):
+    # the per-simulation summary of what shadow and its processes used
+    for tornet_db in tornet_dbs:
+        for i, d in enumerate(tornet_db['dataset']):
+            if 'shadow_tree' not in d:
+                continue
+            tree = d['shadow_tree']
+            logging.info("{} simulation {}: cpu efficiency {:.1f}%, peak RSS {:.2f} GiB, peak PSS {:.2f} GiB, "
+                         "storage io {:.2f} GiB read and {:.2f} GiB written".format(
+                             tornet_db['label'], i + 1, tree['cpu_efficiency'] * 100.0,
+                             tree['rss_bytes_max'] / (1024.0**3), tree['pss_bytes_max'] / (1024.0**3),
+                             tree['io_read_bytes'] / (1024.0**3), tree['io_write_bytes'] / (1024.0**3)))
+
 def __plot_relay_goodput(args, torperf_dbs, tornet_dbs, net_scale):
     # cache the corresponding data in the 'data' keyword for __plot_cdf_figure
     for tornet_db in tornet_dbs:
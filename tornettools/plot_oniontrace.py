@@ -1,9 +1,8 @@
 import os
 import logging
 import datetime
-import subprocess
 
-from tornettools.util import which, cmdsplit, find_matching_files_in_dir, open_writeable_file
+from tornettools.util import which, cmdsplit, find_matching_files_in_dir, run_commands
 
 def plot_oniontrace(args):
     oniontracetools_exe = which('oniontracetools')
@@ -13,7 +12,9 @@ def plot_oniontrace(args):
         logging.warning("Unable to plot oniontrace data.")
         return
 
-    # plot the tgen simulation data for each tgen json file in the tornet path
+    # plot the oniontrace simulation data for each oniontrace json file in the tornet path; each
+    # plot is written to its own directory, so we run all of the plot commands at the same time
+    commands = []
     cmd_prefix_str = f"{oniontracetools_exe} plot --expression 'relay|4uthority' --prefix 'relays'"
     for collection in args.tornet_collection_path:
         for json_path in find_matching_files_in_dir(collection, "oniontrace.analysis.json"):
@@ -25,7 +26,9 @@ def plot_oniontrace(args):
 
             datestr = datetime.datetime.now().strftime("%Y-%m-%d.%H:%M:%S")
 
-            with open_writeable_file(f"{dir_path}/oniontracetools.plot.{datestr}.log") as outf:
-                logging.info(f"Using oniontracetools to plot data from {json_path} now...")
-                comproc = subprocess.run(cmd, cwd=dir_path, stdout=outf, stderr=subprocess.STDOUT)
-                logging.info(f"oniontracetools returned code {comproc.returncode}")
+            logging.info(f"Using oniontracetools to plot data from {json_path} now...")
+            commands.append({'args': cmd, 'cwd': dir_path,
+                             'stdout_path': f"{dir_path}/oniontracetools.plot.{datestr}.log"})
+
+    for comproc in run_commands(commands):
+        logging.info(f"oniontracetools returned code {comproc.returncode}")
@@ -1,9 +1,8 @@
 import os
 import logging
 import datetime
-import subprocess
 
-from tornettools.util import which, cmdsplit, find_matching_files_in_dir, open_writeable_file
+from tornettools.util import which, cmdsplit, find_matching_files_in_dir, run_commands
 
 def plot_tgen(args):
     tgentools_exe = which('tgentools')
@@ -13,7 +12,9 @@ def plot_tgen(args):
         logging.warning("Unable to plot tgen data.")
         return
 
-    # plot the tgen simulation data for each tgen json file in the tornet path
+    # plot the tgen simulation data for each tgen json file in the tornet path; each plot is
+    # written to its own files, so we run all of the plot commands at the same time
+    commands = []
     for circuittype in ('exit', 'onionservice'):
         cmd_prefix_str = f"{tgentools_exe} plot --expression 'perfclient\\d+'{circuittype} --bytes --prefix perf.{circuittype}"
         for collection in args.tornet_collection_path:
@@ -26,7 +27,9 @@ def plot_tgen(args):
 
                 datestr = datetime.datetime.now().strftime("%Y-%m-%d.%H:%M:%S")
 
-                with open_writeable_file(f"{dir_path}/tgentools.plot.{circuittype}.{datestr}.log") as outf:
-                    logging.info(f"Using tgentools to plot data from {json_path} now...")
-                    comproc = subprocess.run(cmd, cwd=dir_path, stdout=outf, stderr=subprocess.STDOUT)
-                    logging.info(f"tgentools returned code {comproc.returncode}")
+                logging.info(f"Using tgentools to plot {circuittype} data from {json_path} now...")
+                commands.append({'args': cmd, 'cwd': dir_path,
+                                 'stdout_path': f"{dir_path}/tgentools.plot.{circuittype}.{datestr}.log"})
+
+    for comproc in run_commands(commands):
+        logging.info(f"tgentools returned code {comproc.returncode}")
@@ -0,0 +1,234 @@
+import os
+import logging
+import threading
+import time
+
+# The columns of the resource usage samples. Memory is in bytes, like 'free -b' reports it;
+# the cpu times (in USER_HZ ticks), context switches, page and swap counts, and disk counts
+# are the cumulative counters of the kernel, so that rates can be computed over any interval
+# when parsing.
+RUSAGE_COLUMNS = [
+    'time',
+    'mem_total', 'mem_used', 'mem_free', 'mem_shared', 'mem_buffers', 'mem_cache', 'mem_available',
+    'swap_total', 'swap_free',
+    'cpu_user', 'cpu_nice', 'cpu_system', 'cpu_idle', 'cpu_iowait', 'cpu_irq', 'cpu_softirq', 'cpu_steal',
+    'ctxt', 'procs_running', 'procs_blocked',
+    'pgfault', 'pgmajfault', 'pswpin', 'pswpout',
+    'disk_reads', 'disk_read_bytes', 'disk_writes', 'disk_write_bytes',
+]
+
+# The columns of the resource usage samples of a process tree. The cpu times are in seconds
+# and include the children that the processes already waited for; the memory is in bytes;
+# the context switch counts are those of the live threads; the io counts are the bytes read
+# and written through system calls (rchar, wchar) and from and to storage, and include the
+# children that the processes already waited for.
+PROCESS_TREE_RUSAGE_COLUMNS = [
+    'time',
+    'num_processes', 'num_threads', 'cpus_allowed',
+    'cpu_user', 'cpu_system',
+    'rss', 'pss',
+    'ctxt_voluntary', 'ctxt_involuntary',
+    'io_rchar', 'io_wchar', 'io_read_bytes', 'io_write_bytes',
+]
+
+# the lines of the files in /proc/<pid> that hold the values of the process tree columns
+PSS_NAMES = {'Pss:': 'pss'}
+IO_NAMES = {'rchar:': 'io_rchar', 'wchar:': 'io_wchar', 'read_bytes:': 'io_read_bytes', 'write_bytes:': 'io_write_bytes'}
+CTXT_NAMES = {'voluntary_ctxt_switches:': 'ctxt_voluntary', 'nonvoluntary_ctxt_switches:': 'ctxt_involuntary'}
+
+# Calls sample() at a fixed interval in a background thread, and appends each sample that it
+# returns to a CSV file with the given columns. The first column is the time of the sample.
+# The most recent sample is also kept in last_sample for other threads to read.
+class PeriodicSampler():
+    def __init__(self, path, columns, interval):
+        self.last_sample = None
+        self.__path = path
+        self.__columns = columns
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        self.__thread.join()
+
+    # returns a dict with a value for each column, or None to skip this sample
+    def sample(self):
+        raise NotImplementedError
+
+    def __run(self):
+        with open(self.__path, 'w', buffering=1) as outf:
+            print(','.join(self.__columns), file=outf)
+
+            next_time = time.monotonic()
+            while True:
+                try:
+                    sample = self.sample()
+                except (OSError, ValueError, KeyError) as e:
+                    logging.warning(f"Unable to sample resource usage from /proc, so we stop writing {self.__path}: {e}")
+                    return
+
+                if sample is not None:
+                    self.last_sample = sample
+                    print(','.join([f"{sample[self.__columns[0]]:.6f}"] + [str(sample[c]) for c in self.__columns[1:]]), file=outf)
+
+                # sample on a fixed schedule, skipping samples if we fell behind
+                next_time += self.__interval
+                now = time.monotonic()
+                if next_time < now:
+                    next_time = now
+                if self.__stop_event.wait(next_time - now):
+                    return
+
+# Samples the resource usage of the machine from /proc. This replaces running 'date' and 'free'
+# every second and running 'dstat' next to the simulation: reading a few files in /proc costs
+# no forks, and the records can be parsed without interpreting tool output.
+class ResourceUsageSampler(PeriodicSampler):
+    def __init__(self, path, interval=1.0):
+        super().__init__(path, RUSAGE_COLUMNS, interval)
+        self.__disks = self.__get_disk_names()
+
+    def sample(self):
+        sample = {'time': time.time()}
+
+        meminfo = {}
+        with open("/proc/meminfo", 'r') as inf:
+            for line in inf:
+                parts = line.split()
+                meminfo[parts[0].rstrip(':')] = int(parts[1]) * 1024
+
+        # the same values that 'free -w' reports
+        sample['mem_total'] = meminfo['MemTotal']
+        sample['mem_free'] = meminfo['MemFree']
+        sample['mem_shared'] = meminfo.get('Shmem', 0)
+        sample['mem_buffers'] = meminfo['Buffers']
+        sample['mem_cache'] = meminfo['Cached'] + meminfo.get('SReclaimable', 0)
+        sample['mem_available'] = meminfo.get('MemAvailable', sample['mem_free'])
+        sample['mem_used'] = sample['mem_total'] - sample['mem_free'] - sample['mem_buffers'] - sample['mem_cache']
+        sample['swap_total'] = meminfo.get('SwapTotal', 0)
+        sample['swap_free'] = meminfo.get('SwapFree', 0)
+
+        with open("/proc/stat", 'r') as inf:
+            for line in inf:
+                parts = line.split()
+                if parts[0] == 'cpu':
+                    names = ['cpu_user', 'cpu_nice', 'cpu_system', 'cpu_idle', 'cpu_iowait', 'cpu_irq', 'cpu_softirq', 'cpu_steal']
+                    for i, name in enumerate(names):
+                        sample[name] = int(parts[i + 1]) if i + 1 < len(parts) else 0
+                elif parts[0] in ('ctxt', 'procs_running', 'procs_blocked'):
+                    sample[parts[0]] = int(parts[1])
+
+        vmstat = {}
+        with open("/proc/vmstat", 'r') as inf:
+            for line in inf:
+                parts = line.split()
+                vmstat[parts[0]] = parts[1]
+        for name in ('pgfault', 'pgmajfault', 'pswpin', 'pswpout'):
+            sample[name] = int(vmstat.get(name, 0))
+
+        # disk sectors are always 512 bytes in /proc/diskstats
+        for name in ('disk_reads', 'disk_read_bytes', 'disk_writes', 'disk_write_bytes'):
+            sample[name] = 0
+        with open("/proc/diskstats", 'r') as inf:
+            for line in inf:
+                parts = line.split()
+                if parts[2] in self.__disks:
+                    sample['disk_reads'] += int(parts[3])
+                    sample['disk_read_bytes'] += int(parts[5]) * 512
+                    sample['disk_writes'] += int(parts[7])
+                    sample['disk_write_bytes'] += int(parts[9]) * 512
+
+        return sample
+
+    @staticmethod
+    def __get_disk_names():
+        # only count the physical disks, so that partitions and the loop, ram, device mapper,
+        # and raid devices built on top of them don't count the same io more than once
+        try:
+            return set([name for name in os.listdir("/sys/block") if os.path.exists(f"/sys/block/{name}/device")])
+        except OSError:
+            return set()
+
+# Samples the resource usage of a process and all of its descendants (e.g., shadow and the
+# processes that it runs) from /proc/<pid>. Reading the files of every process is not free
+# when shadow runs thousands of them, so this is meant to be sampled less often than the
+# machine. Processes that exit while we read them are skipped.
+class ProcessTreeSampler(PeriodicSampler):
+    def __init__(self, path, pid, interval=10.0):
+        super().__init__(path, PROCESS_TREE_RUSAGE_COLUMNS, interval)
+        self.__pid = pid
+        self.__clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.__page_size = os.sysconf('SC_PAGE_SIZE')
+
+    def sample(self):
+        sample = {'time': time.time()}
+
+        # the fields after the command name, which may contain spaces (see proc(5))
+        stats, children = {}, {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{name}/stat", 'r') as inf:
+                    fields = inf.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            pid, ppid = int(name), int(fields[1])
+            stats[pid] = fields
+            children.setdefault(ppid, []).append(pid)
+
+        if self.__pid not in stats:
+            return None
+
+        tree = [self.__pid]
+        for pid in tree:
+            tree.extend(children.get(pid, []))
+
+        try:
+            sample['cpus_allowed'] = len(os.sched_getaffinity(self.__pid))
+        except OSError:
+            return None
+
+        for name in PROCESS_TREE_RUSAGE_COLUMNS[4:]:
+            sample[name] = 0
+        sample['num_processes'] = len(tree)
+        sample['num_threads'] = 0
+
+        for pid in tree:
+            fields = stats[pid]
+            # utime, stime, cutime, cstime, num_threads, and rss are fields 14-17, 20, and 24
+            sample['cpu_user'] += (int(fields[11]) + int(fields[13])) / self.__clock_ticks
+            sample['cpu_system'] += (int(fields[12]) + int(fields[14])) / self.__clock_ticks
+            sample['num_threads'] += int(fields[17])
+            sample['rss'] += int(fields[21]) * self.__page_size
+
+            sample['pss'] += self.__read_values(f"/proc/{pid}/smaps_rollup", PSS_NAMES).get('pss', 0) * 1024
+            for key, value in self.__read_values(f"/proc/{pid}/io", IO_NAMES).items():
+                sample[key] += value
+
+            try:
+                tids = os.listdir(f"/proc/{pid}/task")
+            except OSError:
+                continue
+            for tid in tids:
+                for key, value in self.__read_values(f"/proc/{pid}/task/{tid}/status", CTXT_NAMES).items():
+                    sample[key] += value
+
+        return sample
+
+    @staticmethod
+    def __read_values(path, names):
+        # returns the integer values of the lines that start with one of the names
+        values = {}
+        try:
+            with open(path, 'r') as inf:
+                for line in inf:
+                    parts = line.split()
+                    if len(parts) >= 2 and parts[0] in names:
+                        values[names[parts[0]]] = int(parts[1])
+        except (OSError, ValueError):
+            pass
+        return values
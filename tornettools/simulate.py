@@ -1,31 +1,40 @@
+import os
 import logging
+import shutil
 import subprocess
+import tempfile
 import threading
+import yaml
 
-from time import sleep
+from math import ceil
+from multiprocessing import cpu_count
 
-from tornettools.util import which, cmdsplit, open_writeable_file
+from tornettools.converge import ConvergenceMonitor
+from tornettools.parse_rusage import SHADOW_HEARTBEAT_MARKER
+from tornettools.sample_rusage import ProcessTreeSampler, ResourceUsageSampler
+from tornettools.status import SimulationMonitor
+from tornettools.watchdog import SimulationWatchdog
+from tornettools.util import which, cmdsplit, get_machine_info, run_commands
+
+# how many copies we run at a time when syncing a scratch directory back to the prefix, and how
+# many paths each copy gets
+SCRATCH_SYNC_JOBS = 8
+SCRATCH_SYNC_PATHS_PER_COMMAND = 100
+# by default we run at most one shadow worker per this many hosts
+SHADOW_MIN_HOSTS_PER_WORKER = 8
 
 def run(args):
     logging.info("Starting a simulation from tornet prefix {}".format(args.prefix))
 
-    logging.info("Starting dstat")
-    dstat_subp = __start_dstat(args)
-
-    logging.info("Starting free loop")
-    free_stop_event = threading.Event()
-    free_thread = threading.Thread(target=__run_free_loop, args=(args, free_stop_event))
-    free_thread.start()
+    logging.info("Starting resource usage sampler")
+    sampler = ResourceUsageSampler(f"{args.prefix}/rusage.csv", interval=args.rusage_interval)
+    sampler.start()
 
     try:
         logging.info("Starting shadow")
-        comproc = __run_shadow(args)
-
-        logging.info("Cleaning up")
-        __cleanup_subprocess(dstat_subp)
+        comproc = __run_shadow(args, sampler)
     finally:
-        free_stop_event.set()
-        free_thread.join()
+        sampler.stop()
 
     if comproc is None:
         logging.warning("Simulation was not started")
@@ -38,13 +47,13 @@ def run(args):
 
     return comproc.returncode
 
-def __run_shadow(args):
+def __run_shadow(args, sampler):
     if args.shadow_exe is None:
         logging.warning("Cannot find shadow in your PATH. Do you have shadow installed? Did you update your PATH?")
         logging.warning("Unable to run simulation without shadow.")
         return None
 
-    shadow_cmd_str = f"{args.shadow_exe} {args.shadow_args} {args.shadow_config}"
+    shadow_cmd_str = f"{args.shadow_exe} {__get_shadow_args(args)} {args.shadow_config}"
 
     if args.use_realtime:
         # chrt manipulates the real-time attributes of a process (see `man chrt`)
@@ -58,41 +67,267 @@ def __run_shadow(args):
         # --fifo sets realtime scheduling policy to SCHED_FIFO
         shadow_cmd_str = f"{chrt_exe_path} --fifo 1 {shadow_cmd_str}"
 
-    with open_writeable_file(f"{args.prefix}/shadow.log", compress=args.do_compress) as outf:
+    scratch_dir = None
+    if args.scratch_path is not None:
+        scratch_dir = __create_scratch_dir(args)
+        if scratch_dir is None:
+            return None
+        # run shadow with its data directory in the scratch directory, and link to it from the
+        # prefix so that we can look at it while shadow runs
+        shadow_cmd_str = f"{shadow_cmd_str} --data-directory={scratch_dir}/shadow.data"
+        os.symlink(f"{scratch_dir}/shadow.data", f"{args.prefix}/shadow.data")
+
+    try:
+        return __run_shadow_cmd(args, sampler, shadow_cmd_str, scratch_dir)
+    finally:
+        if scratch_dir is not None:
+            __sync_scratch_dir(args, scratch_dir)
+
+def __run_shadow_cmd(args, sampler, shadow_cmd_str, scratch_dir):
+    monitor = SimulationMonitor(args.prefix, __get_stop_time_seconds(args), machine_sampler=sampler)
+    disk_paths = [args.prefix] if scratch_dir is None else [args.prefix, scratch_dir]
+    watchdog = SimulationWatchdog(disk_paths, monitor, min_ram_gib=args.watchdog_min_ram_gib,
+                                  min_disk_gib=args.watchdog_min_disk_gib, max_eta_hours=args.watchdog_max_eta_hours,
+                                  max_stall_minutes=args.watchdog_max_stall_minutes)
+    convergence = ConvergenceMonitor(args.prefix, monitor, tolerance=args.converge_tolerance,
+                                     window_seconds=args.converge_window, converge_time=args.converge_time)
+
+    log_path = f"{args.prefix}/shadow.log"
+    compressor = None
+    if args.do_compress:
+        compressor = __start_compressor(args, log_path)
+        if compressor is None:
+            return None
+        log_outf = compressor.stdin
+    else:
+        log_outf = open(log_path, 'wb')
+
+    with log_outf as outf, open(f"{args.prefix}/shadow_heartbeat.log", 'wb') as heartbeat_outf:
         shadow_cmd = cmdsplit(shadow_cmd_str)
-        comproc = subprocess.run(shadow_cmd, cwd=args.prefix, stdout=outf)
+        with subprocess.Popen(shadow_cmd, cwd=args.prefix, stdout=subprocess.PIPE) as shadow_subp:
+            splitter = threading.Thread(target=__split_shadow_output,
+                                        args=(shadow_subp.stdout, outf, heartbeat_outf, monitor), daemon=True)
+            splitter.start()
+
+            # track the resources that shadow and the processes it runs use, apart from anything
+            # else that runs on the machine
+            tree_sampler = ProcessTreeSampler(f"{args.prefix}/rusage_shadow_tree.csv", shadow_subp.pid,
+                                              interval=args.shadow_rusage_interval)
+            tree_sampler.start()
+            monitor.start(shadow_subp.pid, tree_sampler=tree_sampler)
+            watchdog.start(shadow_subp.pid)
+            convergence.start(shadow_subp.pid)
+            returncode = None
+            try:
+                returncode = shadow_subp.wait()
+            except BaseException:
+                # like subprocess.run, don't leave shadow running if we are interrupted
+                shadow_subp.kill()
+                raise
+            finally:
+                watchdog.stop()
+                convergence.stop()
+                # the splitter finishes once shadow's output is closed, and must finish writing
+                # before we close the logs
+                splitter.join()
+                converged = convergence.converged_sim_seconds is not None
+                monitor.stop(returncode, abort_reason=watchdog.reason, converged=converged)
+                tree_sampler.stop()
+
+    if watchdog.reason is not None:
+        logging.error(f"The watchdog stopped shadow early: {watchdog.reason}")
+    elif convergence.converged_sim_seconds is not None:
+        # we stopped shadow on purpose, and its output up to then is what we wanted
+        logging.info(f"Shadow was stopped after the performance metrics converged and returned code '{returncode}'")
+        returncode = 0
+
+    # the compressor exits once it has compressed everything that we wrote
+    if compressor is not None and compressor.wait() != 0:
+        logging.warning(f"Compressing the shadow log with {args.compressor} failed with code '{compressor.returncode}'")
+
+    return subprocess.CompletedProcess(shadow_cmd, returncode)
+
+def __start_compressor(args, log_path):
+    # compress the log in another process that uses several threads, so that a chatty shadow
+    # isn't slowed down by single-threaded compression
+    compressor_exe_path = which(args.compressor)
+    if compressor_exe_path is None:
+        logging.warning(f"Cannot find {args.compressor} in your PATH. Do you have {args.compressor} installed?")
+        logging.warning("Unable to run simulation with a compressed log without it.")
+        return None
+
+    extension = {'xz': ".xz", 'zstd': ".zst"}[args.compressor]
+    compressor_cmd = [compressor_exe_path, "--quiet", "--stdout", f"--threads={args.compress_threads}"]
+    with open(f"{log_path}{extension}", 'wb') as outf:
+        return subprocess.Popen(compressor_cmd, stdin=subprocess.PIPE, stdout=outf)
 
-    return comproc
+def __create_scratch_dir(args):
+    # shadow refuses to overwrite an existing data directory, and so do we
+    if os.path.lexists(f"{args.prefix}/shadow.data"):
+        logging.warning(f"Unable to run simulation with a scratch directory while {args.prefix}/shadow.data exists")
+        return None
+
+    # the tor and tgen logs make the data directory grow far beyond the template, by an amount
+    # that we can't predict, so we only check the free space if we are told how much is needed
+    free_bytes = shutil.disk_usage(args.scratch_path).free
+    if args.scratch_size_gib is not None and free_bytes < args.scratch_size_gib * (1024.0**3):
+        logging.warning("Unable to run simulation in scratch directory {}: it has {:.2f} GiB free and we need {:.2f} GiB".format(
+            args.scratch_path, free_bytes / (1024.0**3), args.scratch_size_gib))
+        return None
+    if args.scratch_size_gib is None and args.watchdog_min_disk_gib is None:
+        logging.warning(f"Not checking whether scratch directory {args.scratch_path} has enough space for the shadow data directory; "
+                        "set --scratch_size or --watchdog_min_disk to guard against filling it up")
+
+    scratch_dir = tempfile.mkdtemp(prefix=f"tornettools-{os.path.basename(os.path.abspath(args.prefix))}-", dir=args.scratch_path)
+    logging.info("Running shadow with its data directory in scratch directory {} ({:.2f} GiB free)".format(
+        scratch_dir, free_bytes / (1024.0**3)))
+    return scratch_dir
+
+def __sync_scratch_dir(args, scratch_dir):
+    # replace the link with the data directory, copying the host directories in parallel since
+    # there are many small files in them
+    data_path, scratch_data_path = f"{args.prefix}/shadow.data", f"{scratch_dir}/shadow.data"
+    if os.path.islink(data_path):
+        os.remove(data_path)
+    if not os.path.exists(scratch_data_path):
+        logging.warning(f"Shadow did not create its data directory in scratch directory {scratch_dir}")
+        shutil.rmtree(scratch_dir)
+        return
+
+    logging.info(f"Copying the shadow data directory from scratch directory {scratch_dir} to {data_path}")
+    os.makedirs(f"{data_path}/hosts")
+    sources = [(f"{scratch_data_path}/{name}", data_path) for name in os.listdir(scratch_data_path) if name != 'hosts']
+    if os.path.isdir(f"{scratch_data_path}/hosts"):
+        sources += [(f"{scratch_data_path}/hosts/{name}", f"{data_path}/hosts") for name in sorted(os.listdir(f"{scratch_data_path}/hosts"))]
+
+    commands = []
+    for i in range(0, len(sources), SCRATCH_SYNC_PATHS_PER_COMMAND):
+        for dst_path in sorted(set([dst for (_, dst) in sources[i:i + SCRATCH_SYNC_PATHS_PER_COMMAND]])):
+            src_paths = [src for (src, dst) in sources[i:i + SCRATCH_SYNC_PATHS_PER_COMMAND] if dst == dst_path]
+            commands.append({'args': ["cp", "-a"] + src_paths + [dst_path]})
+    results = run_commands(commands, max_parallel=SCRATCH_SYNC_JOBS)
+
+    if all([r.returncode == 0 for r in results]):
+        shutil.rmtree(scratch_dir)
+    else:
+        logging.critical(f"Unable to copy all of the shadow data directory to {data_path}; the data remains in {scratch_dir}")
+
+def __split_shadow_output(shadow_out, outf, heartbeat_outf, monitor):
+    # copies everything that shadow writes to the log, and also writes the heartbeat lines to a
+    # small file that parse reads instead of scanning the full log, and passes them to the monitor
+    partial = b''
+    try:
+        while True:
+            data = shadow_out.read1(1 << 20)
+            if not data:
+                break
+            outf.write(data)
+
+            data = partial + data
+            end = data.rfind(b'\n') + 1
+            partial = data[end:]
+            if data.find(SHADOW_HEARTBEAT_MARKER, 0, end) >= 0:
+                __write_heartbeats(data[:end].split(b'\n'), heartbeat_outf, monitor)
+        __write_heartbeats([partial], heartbeat_outf, monitor)
+    except OSError as e:
+        logging.critical(f"Unable to write the shadow log: {e}")
+        # keep reading so that shadow does not block on a full pipe
+        while shadow_out.read1(1 << 20):
+            pass
+
+def __write_heartbeats(lines, heartbeat_outf, monitor):
+    for line in lines:
+        if SHADOW_HEARTBEAT_MARKER in line:
+            heartbeat_outf.write(line + b'\n')
+            monitor.handle_line(line.decode('utf-8', errors='replace'))
 
-def __run_free_loop(args, stop_event):
-    date_exe_path = which('date')
-    free_exe_path = which('free')
+def __get_shadow_args(args):
+    if args.shadow_args is not None:
+        return args.shadow_args
 
-    with open(f"{args.prefix}/free.log", 'w') as outf:
-        while not stop_event.is_set():
-            if date_exe_path is not None:
-                date_cmd = cmdsplit(f"{date_exe_path} --utc '+%s.%N %Z seconds since epoch'")
-                subprocess.run(date_cmd, cwd=args.prefix, stdout=outf, stderr=subprocess.STDOUT)
+    # The template directory is also set to the same value in the configuration file.
+    # It is set here as well so that old shadow simulations that don't have it set in
+    # the configuration file will still run correctly. This option can be removed from
+    # these default shadow options in the future.
+    shadow_args = "--seed=666 --template-directory=shadow.data.template"
 
-            if free_exe_path is not None:
-                free_cmd = cmdsplit(f"{free_exe_path} -w -b -l")
-                subprocess.run(free_cmd, cwd=args.prefix, stdout=outf, stderr=subprocess.STDOUT)
+    # if we may only run on some of the CPUs (e.g., in simulate-batch or under taskset), shadow's
+    # own pinning could choose CPUs outside of our set
+    machine = get_machine_info()
+    if machine['num_cpus'] < cpu_count():
+        shadow_args = f"--use-cpu-pinning=false {shadow_args}"
 
-            sleep(1)
+    # the parallelism may be set in the config with generate's '--shadow_option', and command
+    # line options would override it
+    config_path = f"{args.prefix}/{args.shadow_config}"
+    if 'parallelism' in __read_shadow_config_general(config_path):
+        return shadow_args
 
-def __start_dstat(args):
-    dstat_exe_path = which('dstat')
+    # We run one worker per physical core that we may use, since we observed that cpu_count / 2
+    # can run up to 3 times faster than cpu_count on machines with Intel hyperthreading enabled.
+    # A worker with too few hosts spends most of each round waiting for the others, so small
+    # networks get fewer workers.
+    parallelism = machine['num_cores']
+    num_hosts = __count_shadow_config_hosts(config_path)
+    if num_hosts is not None:
+        parallelism = max(1, min(parallelism, ceil(num_hosts / SHADOW_MIN_HOSTS_PER_WORKER)))
+    logging.info(f"Running shadow with {parallelism} workers on the {machine['num_cores']} physical cores "
+                 f"({machine['num_cpus']} CPUs) that we may use for {num_hosts} hosts")
+    return f"--parallelism={parallelism} {shadow_args}"
 
-    if dstat_exe_path is None:
+def __get_stop_time_seconds(args):
+    # the stop time is the total simulated time, which we need to estimate the time remaining
+    general = __read_shadow_config_general(f"{args.prefix}/{args.shadow_config}")
+    if 'stop_time' not in general:
         return None
 
-    dstat_cmd = cmdsplit(f"{dstat_exe_path} -cmstTy --fs --output dstat.log")
-    dstat_subp = subprocess.Popen(dstat_cmd, cwd=args.prefix, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # shadow accepts an integer number of seconds or a number with a time unit, e.g., '1 hour'
+    value = str(general['stop_time']).strip()
+    units = {
+        'ns': 1e-9, 'nanosecond': 1e-9, 'nanoseconds': 1e-9,
+        'us': 1e-6, 'microsecond': 1e-6, 'microseconds': 1e-6,
+        'ms': 1e-3, 'millisecond': 1e-3, 'milliseconds': 1e-3,
+        's': 1, 'sec': 1, 'secs': 1, 'second': 1, 'seconds': 1,
+        'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60,
+        'h': 3600, 'hr': 3600, 'hrs': 3600, 'hour': 3600, 'hours': 3600,
+    }
+    number = value.rstrip('abcdefghijklmnopqrstuvwxyz').strip()
+    unit = value[len(number):].strip() or 's'
+    try:
+        return float(number) * units[unit]
+    except (ValueError, KeyError):
+        logging.warning(f"Unable to parse the shadow stop_time '{value}', so we can't estimate the time remaining")
+        return None
+
+def __count_shadow_config_hosts(config_path):
+    # generate writes each host as a key at the first indent level under 'hosts', so we can
+    # count them without parsing the config of a large network
+    if not config_path.endswith(".yaml") or not os.path.exists(config_path):
+        return None
+
+    num_hosts, in_hosts = 0, False
+    with open(config_path, 'r') as infile:
+        for line in infile:
+            if not line.startswith(' '):
+                in_hosts = line.startswith('hosts:')
+            elif in_hosts and line[2:3] != ' ' and line.rstrip().endswith(':'):
+                num_hosts += 1
+    return num_hosts
+
+def __read_shadow_config_general(config_path):
+    # the config of a large network is slow to parse, so only parse its top-level 'general' section
+    if not config_path.endswith(".yaml") or not os.path.exists(config_path):
+        return {}
 
-    return dstat_subp
+    lines = []
+    with open(config_path, 'r') as infile:
+        for line in infile:
+            if line.startswith('general:'):
+                lines.append(line)
+            elif len(lines) > 0 and (line.startswith(' ') or len(line.strip()) == 0):
+                lines.append(line)
+            elif len(lines) > 0:
+                break
 
-def __cleanup_subprocess(subp):
-    # if subp exists but has yet to receive a return code, then we kill it
-    if subp is not None and subp.poll() is None:
-        subp.terminate()
-        subp.wait()
+    config = yaml.safe_load(''.join(lines)) if len(lines) > 0 else None
+    return (config or {}).get('general') or {}
@@ -0,0 +1,236 @@
+import os
+import logging
+import signal
+import subprocess
+import sys
+import time
+
+from tornettools.estimate import fit_ram_model, get_ram_gib_used, predict_ram_gib
+from tornettools.status import STATUS_FILENAME
+from tornettools.util import which, get_machine_info, load_json_data
+
+# how often we check for finished simulations and try to start the queued ones
+POLL_SECONDS = 10.0
+
+def run(args):
+    machine = get_machine_info()
+
+    taskset_exe_path = None
+    if args.cores_per_simulation > 0:
+        if args.cores_per_simulation > machine['num_cores']:
+            logging.critical(f"Unable to give {args.cores_per_simulation} cores to each simulation, "
+                             f"we may only use {machine['num_cores']} cores")
+            return 1
+        # taskset sets the CPU affinity of a process (see `man taskset`)
+        taskset_exe_path = which('taskset')
+        if taskset_exe_path is None:
+            logging.critical("Cannot find taskset in your PATH. Do you have taskset installed?")
+            logging.critical("Unable to pin simulations to cores without taskset.")
+            return 1
+
+    model = None
+    if args.ram_gib is None and args.estimate_paths is not None:
+        model = fit_ram_model(args.estimate_paths)
+        if model is None:
+            logging.warning("Unable to find any parsed simulations to predict RAM usage from")
+
+    queue = []
+    for path in args.tornet_config_paths:
+        ram_gib = __predict_ram_gib(args, model, path)
+        if ram_gib is None:
+            logging.warning(f"Unable to predict the RAM usage of {path}, so we only start it when no other simulation is running")
+        else:
+            logging.info(f"Predicted that {path} will use {ram_gib:.2f} GiB of RAM")
+        queue.append({'path': path, 'ram_bytes': None if ram_gib is None else ram_gib * args.ram_margin * (1024.0**3)})
+
+    numa_nodes = None if taskset_exe_path is None else machine['numa_nodes']
+    scheduler = BatchScheduler(args, queue, numa_nodes, taskset_exe_path)
+    return scheduler.run()
+
+def __predict_ram_gib(args, model, path):
+    if args.ram_gib is not None:
+        return args.ram_gib
+    if model is not None:
+        ram_gib = predict_ram_gib(model, path)
+        if ram_gib is not None:
+            return ram_gib
+    # the network may have been simulated before
+    rusage_path = f"{path}/tornet.plot.data/resource_usage.json"
+    if os.path.exists(rusage_path):
+        return get_ram_gib_used(load_json_data(rusage_path))
+    return None
+
+# Starts the queued simulations when the machine has enough free memory and cores for them,
+# and tracks them until they finish. A simulation is only started if its predicted RAM fits in
+# the available memory, less a reserve and less the memory that the running simulations are
+# predicted to use but have not used yet. Simulations may start out of order if they fit.
+class BatchScheduler():
+    def __init__(self, args, queue, numa_nodes, taskset_exe_path):
+        self.__args = args
+        self.__queue = queue
+        self.__taskset_exe_path = taskset_exe_path
+        # the cores of each NUMA node that no simulation is pinned to
+        self.__free_cores = None if numa_nodes is None else {n: list(node['core_cpus']) for (n, node) in numa_nodes.items()}
+        self.__running = []
+        self.__results = {}
+
+    def run(self):
+        logging.info(f"Scheduling {len(self.__queue)} simulations")
+        try:
+            while len(self.__queue) > 0 or len(self.__running) > 0:
+                self.__reap()
+                self.__admit()
+                if len(self.__queue) > 0 or len(self.__running) > 0:
+                    time.sleep(POLL_SECONDS)
+        except KeyboardInterrupt:
+            # each simulate stops its own shadow when interrupted; they already got the signal if
+            # it came from the terminal, so only signal those that are still running a bit later
+            logging.warning(f"Interrupted, stopping {len(self.__running)} running simulations")
+            time.sleep(5)
+            for sim in self.__running:
+                if sim['process'].poll() is None:
+                    sim['process'].send_signal(signal.SIGINT)
+            for sim in self.__running:
+                sim['process'].wait()
+            raise
+
+        num_failed = len([rc for rc in self.__results.values() if rc != 0])
+        logging.info(f"Finished {len(self.__results)} simulations ({num_failed} failed)")
+        for (path, returncode) in self.__results.items():
+            logging.info(f"{path}: simulate returned code '{returncode}'")
+        return 0 if num_failed == 0 else 1
+
+    def __reap(self):
+        for sim in list(self.__running):
+            returncode = sim['process'].poll()
+            if returncode is None:
+                continue
+            self.__running.remove(sim)
+            self.__results[sim['path']] = returncode
+            for (node, cores) in sim['cores'].items():
+                self.__free_cores[node] = sorted(self.__free_cores[node] + cores)
+            elapsed = time.monotonic() - sim['start_time']
+            logging.info(f"Simulation {sim['path']} finished with code '{returncode}' after {elapsed / 3600.0:.2f} hours; "
+                         f"{len(self.__running)} running and {len(self.__queue)} queued")
+
+    def __admit(self):
+        for sim in list(self.__queue):
+            if not self.__fits_memory(sim):
+                continue
+
+            cores = {}
+            if self.__free_cores is not None:
+                cores = self.__allocate_cores()
+                if cores is None:
+                    # we're out of cores, so nothing else fits either
+                    return
+
+            self.__queue.remove(sim)
+            self.__start(sim, cores)
+
+    def __fits_memory(self, sim):
+        running_unknown = any([s['ram_bytes'] is None for s in self.__running])
+        if sim['ram_bytes'] is None or running_unknown:
+            return len(self.__running) == 0
+
+        # the running simulations keep growing toward their predicted memory usage
+        remaining_bytes = 0
+        for running in self.__running:
+            used_bytes = self.__get_used_bytes(running)
+            remaining_bytes += max(0, running['ram_bytes'] - used_bytes)
+
+        available_bytes = self.__get_available_bytes() - remaining_bytes - self.__args.ram_reserve_gib * (1024.0**3)
+        if sim['ram_bytes'] <= available_bytes:
+            return True
+        elif len(self.__running) == 0:
+            logging.warning(f"Starting {sim['path']} even though it is predicted to need {sim['ram_bytes'] / (1024.0**3):.2f} GiB "
+                            f"of RAM and only {available_bytes / (1024.0**3):.2f} GiB are available")
+            return True
+        return False
+
+    def __allocate_cores(self):
+        # returns the cores that we took from each NUMA node, or None if not enough are free.
+        # we prefer to keep a simulation on one node so that its memory stays local, and take
+        # the node with the fewest free cores that fits so that larger gaps remain; a simulation
+        # that doesn't fit on any node takes cores from the nodes with the most free cores
+        num_cores = self.__args.cores_per_simulation
+        if sum([len(cores) for cores in self.__free_cores.values()]) < num_cores:
+            return None
+
+        nodes = sorted(self.__free_cores, key=lambda n: len(self.__free_cores[n]))
+        fitting = [node for node in nodes if len(self.__free_cores[node]) >= num_cores]
+        if len(fitting) > 0:
+            nodes = fitting[:1]
+        else:
+            nodes.reverse()
+
+        taken = {}
+        for node in nodes:
+            count = min(num_cores - sum([len(cores) for cores in taken.values()]), len(self.__free_cores[node]))
+            if count > 0:
+                taken[node] = self.__free_cores[node][:count]
+                self.__free_cores[node] = self.__free_cores[node][count:]
+        return taken
+
+    def __start(self, sim, cores):
+        cmd = [sys.executable, os.path.abspath(sys.argv[0]), 'simulate'] + self.__get_simulate_args() + [sim['path']]
+        if len(cores) > 0:
+            cpus = ','.join([str(cpu) for node_cores in cores.values() for core_cpus in node_cores for cpu in core_cpus])
+            cmd = [self.__taskset_exe_path, '--cpu-list', cpus] + cmd
+            nodes = ','.join([str(node) for node in cores])
+            logging.info(f"Starting simulation {sim['path']} on CPUs {cpus} (NUMA node {nodes})")
+        else:
+            logging.info(f"Starting simulation {sim['path']}")
+
+        # each simulate logs to a file in its tornet directory
+        sim['process'] = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        sim['cores'] = cores
+        sim['start_time'] = time.monotonic()
+        sim['start_wall_time'] = time.time()
+        self.__running.append(sim)
+
+    def __get_simulate_args(self):
+        args = self.__args
+        simulate_args = ['--filename', args.shadow_config,
+                         '--rusage_interval', str(args.rusage_interval),
+                         '--shadow_rusage_interval', str(args.shadow_rusage_interval)]
+        if args.shadow_exe is not None:
+            simulate_args += ['--shadow', args.shadow_exe]
+        if args.shadow_args is not None:
+            # the shadow args start with '-', so they must be attached to the option
+            simulate_args += [f"--args={args.shadow_args}"]
+        if args.do_compress:
+            simulate_args += ['--compress', '--compressor', args.compressor, '--compress_threads', str(args.compress_threads)]
+        optional_args = {'--scratch': args.scratch_path, '--scratch_size': args.scratch_size_gib,
+                         '--watchdog_min_ram': args.watchdog_min_ram_gib, '--watchdog_min_disk': args.watchdog_min_disk_gib,
+                         '--watchdog_max_eta': args.watchdog_max_eta_hours, '--watchdog_max_stall': args.watchdog_max_stall_minutes}
+        for (option, value) in optional_args.items():
+            if value is not None:
+                simulate_args += [option, str(value)]
+        if args.converge_tolerance is not None:
+            simulate_args += ['--converge_tolerance', str(args.converge_tolerance),
+                              '--converge_window', str(args.converge_window), '--converge_time', str(args.converge_time)]
+        if args.use_realtime:
+            simulate_args += ['--use-realtime']
+        return simulate_args
+
+    @staticmethod
+    def __get_used_bytes(sim):
+        # simulate keeps the PSS of shadow and its processes in its status file; ignore the file
+        # of an earlier run until simulate replaces it
+        status_path = f"{sim['path']}/{STATUS_FILENAME}"
+        if not os.path.exists(status_path):
+            return 0
+        status = load_json_data(status_path)
+        if status['start_time'] < sim['start_wall_time']:
+            return 0
+        return status['shadow_pss_bytes'] or 0
+
+    @staticmethod
+    def __get_available_bytes():
+        with open("/proc/meminfo", 'r') as inf:
+            for line in inf:
+                parts = line.split()
+                if parts[0] == 'MemAvailable:':
+                    return int(parts[1]) * 1024
+        return 0
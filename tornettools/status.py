@@ -0,0 +1,211 @@
+import os
+import datetime
+import glob
+import json
+import logging
+import threading
+import time
+
+from collections import deque
+
+from tornettools.parse_rusage import parse_shadow_heartbeat
+from tornettools.util import load_json_data
+
+# the file in the tornet prefix that simulate keeps updated while shadow runs
+STATUS_FILENAME = "simulation_status.json"
+# how often simulate rewrites the status file
+STATUS_UPDATE_SECONDS = 5.0
+# the window of real time over which we compute the recent simulation speed for the ETA
+RATE_WINDOW_SECONDS = 300.0
+# a running simulation whose status was not updated for this long has probably died
+STALE_SECONDS = 600.0
+
+def run(args):
+    paths = []
+    for path in args.tornet_collection_path:
+        if os.path.exists(f"{path}/{STATUS_FILENAME}"):
+            paths.append(f"{path}/{STATUS_FILENAME}")
+        else:
+            # e.g., the prefix of a sweep; don't walk into the shadow.data of every simulation
+            paths.extend(sorted(glob.glob(f"{path}/*/{STATUS_FILENAME}")))
+
+    # the same simulation may be found through more than one of the given paths
+    paths = list(dict.fromkeys([os.path.abspath(path) for path in paths]))
+
+    if len(paths) == 0:
+        logging.warning("Unable to find the {} file of any simulation in {}".format(STATUS_FILENAME, ', '.join(args.tornet_collection_path)))
+        return 1
+
+    now = time.time()
+    counts = {}
+    for path in paths:
+        status = load_json_data(path)
+        state = status['state']
+        if state == 'running' and now - status['update_time'] > STALE_SECONDS:
+            state = 'stale'
+        counts[state] = counts.get(state, 0) + 1
+        logging.info(__format_status(status, state, now))
+
+    logging.info("{} simulations: {}".format(len(paths), ', '.join([f"{counts[state]} {state}" for state in sorted(counts)])))
+
+def __format_status(status, state, now):
+    msg = f"{status['prefix']}: {state}"
+    if state == 'stale':
+        msg += f" (not updated for {__format_seconds(now - status['update_time'])}; did simulate die?)"
+    elif state == 'aborted':
+        msg += f" ({status['abort_reason']})"
+    elif state == 'converged':
+        msg += " (stopped once the performance metrics converged)"
+    elif state != 'running' and status['returncode'] is not None:
+        msg += f" (shadow returned code {status['returncode']})"
+
+    if status['progress'] is not None:
+        sim_str = __format_seconds(status['sim_seconds'])
+        stop_str = __format_seconds(status['stop_time_seconds'])
+        msg += ", {:.1f}% ({} of {} simulated)".format(status['progress'] * 100.0, sim_str, stop_str)
+    else:
+        msg += f", {__format_seconds(status['sim_seconds'])} simulated"
+    msg += f" in {__format_seconds(status['real_seconds'])}"
+
+    if status['sim_seconds_per_real_second'] is not None:
+        msg += ", {:.3f} sim seconds per real second".format(status['sim_seconds_per_real_second'])
+    if state == 'running' and status['eta_seconds'] is not None:
+        eta_str = datetime.datetime.fromtimestamp(status['eta_time']).strftime("%Y-%m-%d %H:%M")
+        msg += f", ETA {__format_seconds(status['eta_seconds'])} ({eta_str})"
+
+    if status['memory_used_bytes'] is not None:
+        msg += ", {:.1f} GiB RAM used".format(status['memory_used_bytes'] / (1024.0**3))
+    if status['shadow_pss_bytes'] is not None:
+        msg += " (shadow PSS {:.1f} GiB)".format(status['shadow_pss_bytes'] / (1024.0**3))
+
+    msg += f", updated {__format_seconds(now - status['update_time'])} ago"
+    return msg
+
+def __format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+# Follows a running simulation and keeps a small JSON status file in the tornet prefix up to
+# date: the simulated time from the heartbeats that shadow logs, the recent simulation speed
+# and the ETA to the stop time, and the current memory usage from the resource usage samplers.
+# simulate passes every heartbeat line to handle_line() as shadow writes it, and a background
+# thread rewrites the status file periodically. The status file is replaced atomically, so that
+# 'tornettools status' never reads a partial file.
+class SimulationMonitor():
+    def __init__(self, prefix, stop_time_seconds, machine_sampler=None):
+        self.__status_path = f"{prefix}/{STATUS_FILENAME}"
+        self.__stop_time_seconds = stop_time_seconds
+        self.__machine_sampler = machine_sampler
+        self.__tree_sampler = None
+        self.__prefix = os.path.abspath(prefix)
+        self.__pid = None
+        self.__start_time = time.time()
+        self.__heartbeats = deque() # (real seconds, sim seconds)
+        self.__heartbeat_time = None
+        self.__lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self, pid, tree_sampler=None):
+        self.__pid = pid
+        self.__tree_sampler = tree_sampler
+        self.__write('running')
+        self.__thread.start()
+
+    # returncode is None if shadow did not exit on its own; abort_reason is set if we stopped
+    # shadow early because the simulation was not going to finish well, and converged is set if
+    # we stopped it because its performance metrics converged
+    def stop(self, returncode, abort_reason=None, converged=False):
+        self.__stop_event.set()
+        self.__thread.join()
+
+        if abort_reason is not None:
+            state = 'aborted'
+        elif converged:
+            state = 'converged'
+        elif returncode is None:
+            state = 'interrupted'
+        elif returncode == 0:
+            state = 'finished'
+        else:
+            state = 'failed'
+        self.__write(state, returncode, abort_reason)
+
+    # may be called from another thread than the one that writes the status
+    def handle_line(self, line):
+        heartbeat = parse_shadow_heartbeat(line)
+        if heartbeat is None:
+            return
+
+        sim_secs, rund = heartbeat
+        with self.__lock:
+            self.__heartbeat_time = time.time()
+            self.__heartbeats.append((rund['real_time'], sim_secs))
+            while len(self.__heartbeats) > 2 and self.__heartbeats[-1][0] - self.__heartbeats[0][0] > RATE_WINDOW_SECONDS:
+                self.__heartbeats.popleft()
+
+    def __run(self):
+        while not self.__stop_event.wait(STATUS_UPDATE_SECONDS):
+            self.__write('running')
+
+    def __write(self, state, returncode=None, abort_reason=None):
+        status = self.get_status(state, returncode)
+        status['abort_reason'] = abort_reason
+
+        tmp_path = f"{self.__status_path}.tmp"
+        with open(tmp_path, 'w') as outf:
+            json.dump(status, outf, sort_keys=True, separators=(',', ': '), indent=2)
+        os.replace(tmp_path, self.__status_path)
+
+    # the status of the simulation as we would write it now; may be called from any thread
+    def get_status(self, state='running', returncode=None):
+        now = time.time()
+        status = {
+            'prefix': self.__prefix,
+            'pid': self.__pid,
+            'state': state,
+            'returncode': returncode,
+            'start_time': self.__start_time,
+            'update_time': now,
+            'heartbeat_time': None,
+            'real_seconds': now - self.__start_time,
+            'sim_seconds': 0.0,
+            'stop_time_seconds': self.__stop_time_seconds,
+            'progress': None,
+            'sim_seconds_per_real_second': None,
+            'eta_seconds': None,
+            'eta_time': None,
+            'memory_used_bytes': None,
+            'memory_available_bytes': None,
+            'shadow_pss_bytes': None,
+            'shadow_rss_bytes': None,
+        }
+
+        with self.__lock:
+            heartbeats = list(self.__heartbeats)
+            status['heartbeat_time'] = self.__heartbeat_time
+
+        if len(heartbeats) > 0:
+            (real0, sim0), (real1, sim1) = heartbeats[0], heartbeats[-1]
+            status['sim_seconds'] = sim1
+            if real1 > real0:
+                status['sim_seconds_per_real_second'] = (sim1 - sim0) / (real1 - real0)
+            elif real1 > 0:
+                status['sim_seconds_per_real_second'] = sim1 / real1
+
+        if self.__stop_time_seconds:
+            status['progress'] = min(1.0, status['sim_seconds'] / self.__stop_time_seconds)
+            rate = status['sim_seconds_per_real_second']
+            if state == 'running' and rate is not None and rate > 0:
+                status['eta_seconds'] = max(0.0, self.__stop_time_seconds - status['sim_seconds']) / rate
+                status['eta_time'] = now + status['eta_seconds']
+
+        machine = self.__machine_sampler.last_sample if self.__machine_sampler is not None else None
+        if machine is not None:
+            status['memory_used_bytes'] = machine['mem_total'] - machine['mem_available']
+            status['memory_available_bytes'] = machine['mem_available']
+        tree = self.__tree_sampler.last_sample if self.__tree_sampler is not None else None
+        if tree is not None:
+            status['shadow_pss_bytes'] = tree['pss']
+            status['shadow_rss_bytes'] = tree['rss']
+
+        return status
@@ -1,10 +1,34 @@
 import os
+import asyncio
+import contextlib
+import fcntl
+import glob
+import hashlib
 import logging
 import json
 import lzma
+import queue
 import re
 import shutil
 import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from functools import lru_cache
+from numpy.random import default_rng
+
+# the zstandard module is only needed to read files compressed with zstd (e.g., 'simulate -c --compressor zstd')
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the extensions of the compressed files that open_readable_file can read
+COMPRESSED_EXTENSIONS = (".xz", ".zst")
+# the ioctl that asks the file system for a copy-on-write clone of a file (see ioctl_ficlone(2))
+FICLONE = 0x40049409
 
 def make_directories(path):
     p = os.path.abspath(os.path.expanduser(path))
@@ -30,15 +54,54 @@ def open_writeable_file(filepath, compress=False):
         outfile = open(filepath, 'w')
     return outfile
 
+def find_readable_file(filepath):
+    # returns the path of filepath or of a compressed version of it, or None if neither exists
+    for path in [filepath] + [filepath + ext for ext in COMPRESSED_EXTENSIONS]:
+        if os.path.exists(path):
+            return path
+    return None
+
 def open_readable_file(filepath):
-    if not os.path.exists(filepath) and not filepath.endswith('.xz'):
-        filepath += ".xz" # look for the compressed version
+    if not os.path.exists(filepath) and not filepath.endswith(COMPRESSED_EXTENSIONS):
+        # look for the compressed version
+        filepath = find_readable_file(filepath) or filepath + ".xz"
     if filepath.endswith('.xz'):
         infile = lzma.open(filepath, 'rt')
+    elif filepath.endswith('.zst'):
+        if zstandard is None:
+            logging.critical(f"Couldn't import the zstandard python module; needed to read {filepath}")
+            sys.exit(1)
+        infile = zstandard.open(filepath, 'rt')
     else:
         infile = open(filepath, 'r')
     return infile
 
+def link_or_copy_file(src_path, dst_path):
+    # share the data of src_path with dst_path instead of copying it if we can; reflinks are
+    # copy-on-write clones (e.g., on btrfs and xfs) and hard links share the file, but both
+    # only work within a file system. returns the method we used.
+    if os.path.exists(dst_path):
+        os.remove(dst_path)
+
+    # open the source first, so that a missing source raises before we create dst_path
+    with open(src_path, 'rb') as infile:
+        try:
+            with open(dst_path, 'wb') as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            return 'reflink'
+        except OSError:
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+
+    try:
+        os.link(src_path, dst_path)
+        return 'hard link'
+    except OSError:
+        pass
+
+    shutil.copyfile(src_path, dst_path)
+    return 'copy'
+
 def dump_json_data(output, outfile_path, compress=False):
     with open_writeable_file(outfile_path, compress) as outfile:
         json.dump(output, outfile, sort_keys=True, separators=(',', ': '), indent=2)
@@ -48,6 +111,224 @@ def load_json_data(infile_path):
         data = json.load(infile)
     return data
 
+# Writes many small files (e.g., the per-host files of a generated network) with a pool of
+# threads, so that the file system latency of the writes and of creating their directories
+# overlaps. Jobs wait in a bounded queue, so that we do not hold all of the pending data in
+# memory at once. The first error raised by a job is raised again by the next call to submit()
+# or close(), and the remaining jobs are skipped.
+class ParallelFileWriter():
+    def __init__(self, num_threads=16, max_queued_jobs=1024):
+        self.__queue = queue.Queue(maxsize=max_queued_jobs)
+        self.__lock = threading.Lock()
+        self.__error = None
+        self.__num_files = 0
+        self.__start_time = time.monotonic()
+        self.__threads = [threading.Thread(target=self.__run, daemon=True) for _ in range(max(1, num_threads))]
+        for thread in self.__threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the exception that is already in flight
+            self.__join()
+
+    # writes str or bytes data to path, creating the parent directory with dir_mode if needed
+    def write(self, path, data, dir_mode=0o777):
+        self.submit(self.__write_file, path, data, dir_mode)
+
+    # runs func(*args) in a writer thread; num_files is the number of files that func writes,
+    # or None if func returns the number of files that it wrote
+    def submit(self, func, *args, num_files=1):
+        self.__raise_error()
+        self.__queue.put((func, args, num_files))
+
+    def close(self):
+        self.__join()
+        self.__raise_error()
+
+        elapsed = max(time.monotonic() - self.__start_time, 1e-9)
+        logging.info("Wrote {} files in {:.2f} seconds ({:.1f} files/s) with {} threads".format(
+            self.__num_files, elapsed, self.__num_files / elapsed, len(self.__threads)))
+
+    def __join(self):
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+    def __raise_error(self):
+        with self.__lock:
+            error = self.__error
+        if error is not None:
+            raise error
+
+    def __run(self):
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                return
+
+            func, args, num_files = job
+            with self.__lock:
+                if self.__error is not None:
+                    continue
+
+            try:
+                result = func(*args)
+            except Exception as e:
+                with self.__lock:
+                    if self.__error is None:
+                        self.__error = e
+            else:
+                with self.__lock:
+                    self.__num_files += result if num_files is None else num_files
+
+    @staticmethod
+    def __write_file(path, data, dir_mode):
+        os.makedirs(os.path.dirname(path), mode=dir_mode, exist_ok=True)
+        with open(path, 'wb' if isinstance(data, bytes) else 'w') as outfile:
+            outfile.write(data)
+
+# Runs external commands concurrently in asyncio subprocesses, at most max_parallel at a time,
+# and returns a subprocess.CompletedProcess for each command in the order they were given.
+# Each command is a dict with the 'args' list and optionally:
+#   'cwd': the directory to run the command in
+#   'stdin_path': a file that the command reads its stdin from
+#   'stdout_path': a file that the command writes its stdout and stderr to; if not given, the
+#                  output is captured in the stdout of the result and logged if the command fails
+# A command that runs longer than timeout seconds is killed. If we are interrupted (e.g., with
+# Ctrl-C) or a command can not be started, the commands that are still running are killed.
+def run_commands(commands, max_parallel=None, timeout=None):
+    if len(commands) == 0:
+        return []
+    if max_parallel is None or max_parallel < 1:
+        max_parallel = os.cpu_count()
+
+    start_time = time.monotonic()
+    results = asyncio.run(__run_commands(commands, min(max_parallel, len(commands)), timeout))
+    elapsed = time.monotonic() - start_time
+
+    num_failed = len([r for r in results if r.returncode != 0])
+    logging.info("Ran {} commands in {:.2f} seconds with up to {} at a time ({} failed)".format(
+        len(commands), elapsed, min(max_parallel, len(commands)), num_failed))
+    return results
+
+async def __run_commands(commands, max_parallel, timeout):
+    semaphore = asyncio.Semaphore(max_parallel)
+    tasks = [asyncio.ensure_future(__run_command(command, semaphore, timeout)) for command in commands]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # stop the commands that are still running before giving up
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def __run_command(command, semaphore, timeout):
+    args = [str(arg) for arg in command['args']]
+    stdin_path = command.get('stdin_path')
+    stdout_path = command.get('stdout_path')
+
+    async with semaphore:
+        start_time = time.monotonic()
+        with contextlib.ExitStack() as stack:
+            stdin = stack.enter_context(open(stdin_path, 'rb')) if stdin_path is not None else asyncio.subprocess.DEVNULL
+            stdout = stack.enter_context(open(stdout_path, 'wb')) if stdout_path is not None else asyncio.subprocess.PIPE
+
+            # if we are cancelled while the command is starting, asyncio would wait for it to
+            # exit on its own; finish starting it instead so that we can kill it below
+            start = asyncio.ensure_future(asyncio.create_subprocess_exec(*args, cwd=command.get('cwd'), stdin=stdin,
+                                                                         stdout=stdout, stderr=asyncio.subprocess.STDOUT))
+            try:
+                proc = await asyncio.shield(start)
+                output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Killing command '{}' after it ran for {} seconds".format(' '.join(args), timeout))
+                proc.kill()
+                output, _ = await proc.communicate()
+            except asyncio.CancelledError:
+                # we were cancelled, don't leave the command running behind us
+                proc = await start
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        elapsed = time.monotonic() - start_time
+
+    if proc.returncode != 0:
+        logging.warning("Command '{}' failed with code {} after {:.2f} seconds".format(' '.join(args), proc.returncode, elapsed))
+        if output:
+            logging.warning("Output of the failed command:\n{}".format(output.decode('utf-8', errors='replace').rstrip()))
+    else:
+        logging.debug("Command '{}' finished in {:.2f} seconds".format(' '.join(args), elapsed))
+
+    return subprocess.CompletedProcess(args, proc.returncode, stdout=output)
+
+# The CPUs that this process may run on, how they map to physical cores and NUMA nodes (the
+# 'core_cpus' of a node list the CPUs of each of its cores), and the memory of the machine.
+# Falls back to treating every CPU as its own core on one node if the topology is not
+# available in sysfs.
+def get_machine_info():
+    cpus = sorted(os.sched_getaffinity(0))
+
+    cores = {}
+    for cpu in cpus:
+        topology_path = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        try:
+            with open(f"{topology_path}/physical_package_id") as package_file, open(f"{topology_path}/core_id") as core_file:
+                core = (int(package_file.read()), int(core_file.read()))
+        except (OSError, ValueError):
+            core = (0, cpu)
+        cores.setdefault(core, []).append(cpu)
+
+    numa_nodes = {}
+    for node_path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*")):
+        with open(f"{node_path}/cpulist") as cpulist_file:
+            node_cpus = [cpu for cpu in __parse_cpu_list(cpulist_file.read()) if cpu in cpus]
+        if len(node_cpus) > 0:
+            node_cores = sorted([core_cpus for core_cpus in cores.values() if core_cpus[0] in node_cpus])
+            numa_nodes[int(node_path.rsplit('node', 1)[1])] = {'num_cpus': len(node_cpus), 'num_cores': len(node_cores),
+                                                               'core_cpus': node_cores}
+    if len(numa_nodes) == 0:
+        numa_nodes[0] = {'num_cpus': len(cpus), 'num_cores': len(cores), 'core_cpus': sorted(cores.values())}
+
+    return {
+        'num_cpus': len(cpus),
+        'num_cores': len(cores),
+        'numa_nodes': numa_nodes,
+        'memory_bytes': os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'),
+    }
+
+def __parse_cpu_list(cpu_list):
+    # e.g., '0-3,8-11'
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            (start, end) = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif len(part) > 0:
+            cpus.append(int(part))
+    return cpus
+
+# Like load_json_data, but each path is only read once per process. The returned
+# object is shared between all callers, so callers must not modify it.
+@lru_cache(maxsize=None)
+def load_json_data_cached(infile_path):
+    return load_json_data(infile_path)
+
+# Returns a PRNG for one random decision (e.g., 'placement') about one host. The stream only
+# depends on the seed, the host name, and the purpose, so hosts get the same values no matter
+# in which order (or in which process) we generate them.
+def get_host_rng(seed, hostname, purpose):
+    digest = hashlib.sha256("{}/{}".format(hostname, purpose).encode()).digest()
+    return default_rng([seed] + [int.from_bytes(digest[i:i + 4], 'little') for i in range(0, len(digest), 4)])
+
 def find_matching_files_in_dir(search_dir, filepattern):
     if isinstance(filepattern, str):
         # Interpret as a literal string
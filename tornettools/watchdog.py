@@ -0,0 +1,100 @@
+import os
+import logging
+import shutil
+import signal
+import threading
+import time
+
+# how often we check the simulation against the thresholds
+WATCHDOG_INTERVAL_SECONDS = 10.0
+# the speed of a simulation changes a lot while the network bootstraps, so we only judge its
+# ETA once it has simulated this fraction of the stop time
+WATCHDOG_MIN_ETA_PROGRESS = 0.05
+# how long shadow may take to exit after we ask it to before we kill it
+WATCHDOG_KILL_SECONDS = 60.0
+
+# Watches a running simulation in a background thread and stops shadow early if the simulation
+# is not going to finish well: if the available memory, or the free disk space in any of the
+# disk paths (e.g., the tornet prefix), falls below a threshold, if the estimated time to finish
+# grows too long, or if shadow stops making progress. Shadow is asked to exit with SIGTERM, and
+# killed if it doesn't exit in time. Each threshold is optional; the reason that we stopped
+# shadow is kept in reason.
+class SimulationWatchdog():
+    def __init__(self, disk_paths, monitor, min_ram_gib=None, min_disk_gib=None, max_eta_hours=None, max_stall_minutes=None):
+        self.reason = None
+        self.__disk_paths = disk_paths
+        self.__monitor = monitor
+        self.__min_ram_bytes = None if min_ram_gib is None else min_ram_gib * (1024.0**3)
+        self.__min_disk_bytes = None if min_disk_gib is None else min_disk_gib * (1024.0**3)
+        self.__max_eta_seconds = None if max_eta_hours is None else max_eta_hours * 3600.0
+        self.__max_stall_seconds = None if max_stall_minutes is None else max_stall_minutes * 60.0
+        self.__pid = None
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def is_enabled(self):
+        thresholds = [self.__min_ram_bytes, self.__min_disk_bytes, self.__max_eta_seconds, self.__max_stall_seconds]
+        return any([t is not None for t in thresholds])
+
+    def start(self, pid):
+        self.__pid = pid
+        if self.is_enabled():
+            self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+
+    def __run(self):
+        while not self.__stop_event.wait(WATCHDOG_INTERVAL_SECONDS):
+            self.reason = self.__check()
+            if self.reason is not None:
+                break
+
+        if self.reason is None:
+            return
+
+        logging.critical(f"Stopping shadow early: {self.reason}")
+        self.__signal(signal.SIGTERM)
+        if not self.__stop_event.wait(WATCHDOG_KILL_SECONDS):
+            logging.critical(f"Killing shadow, which did not exit within {WATCHDOG_KILL_SECONDS} seconds")
+            self.__signal(signal.SIGKILL)
+
+    def __check(self):
+        # returns the reason to stop the simulation, or None if it may continue
+        status = self.__monitor.get_status()
+
+        available_bytes = status['memory_available_bytes']
+        if self.__min_ram_bytes is not None and available_bytes is not None and available_bytes < self.__min_ram_bytes:
+            return "only {:.2f} GiB of RAM are available, less than the minimum of {:.2f} GiB".format(
+                available_bytes / (1024.0**3), self.__min_ram_bytes / (1024.0**3))
+
+        if self.__min_disk_bytes is not None:
+            for path in self.__disk_paths:
+                free_bytes = shutil.disk_usage(path).free
+                if free_bytes < self.__min_disk_bytes:
+                    return "only {:.2f} GiB of disk are free in {}, less than the minimum of {:.2f} GiB".format(
+                        free_bytes / (1024.0**3), path, self.__min_disk_bytes / (1024.0**3))
+
+        eta_seconds = status['eta_seconds']
+        progress = status['progress'] or 0.0
+        if self.__max_eta_seconds is not None and eta_seconds is not None and progress >= WATCHDOG_MIN_ETA_PROGRESS \
+                and eta_seconds > self.__max_eta_seconds:
+            return "the simulation is predicted to take another {:.2f} hours at {:.4f} sim seconds per real second, more than the maximum of {:.2f} hours".format(
+                eta_seconds / 3600.0, status['sim_seconds_per_real_second'], self.__max_eta_seconds / 3600.0)
+
+        if self.__max_stall_seconds is not None:
+            last_progress_time = status['heartbeat_time'] or status['start_time']
+            stall_seconds = time.time() - last_progress_time
+            if stall_seconds > self.__max_stall_seconds:
+                return "shadow has not logged a heartbeat for {:.1f} minutes, more than the maximum of {:.1f} minutes".format(
+                    stall_seconds / 60.0, self.__max_stall_seconds / 60.0)
+
+        return None
+
+    def __signal(self, signum):
+        try:
+            os.kill(self.__pid, signum)
+        except ProcessLookupError:
+            pass